@@ -1,9 +1,9 @@
 import os
 from flask import Flask, render_template, request, jsonify
-import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from gaussian_ch4 import preprocess_and_invert
+from csv_ingest import SUPPORTED_EXTENSIONS, load_dataset
 import json
 
 app = Flask(__name__)
@@ -28,42 +28,10 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'No selected file'})
     
-    if file and file.filename.endswith('.csv'):
-        # Leer el CSV
-        df = pd.read_csv(file)
-        
+    if file and file.filename.lower().endswith(SUPPORTED_EXTENSIONS):
         try:
-            # Normalizar nombres de columnas (eliminar espacios extras y convertir a minúsculas)
-            df.columns = df.columns.str.strip()
-            
-            # Las columnas ya vienen correctamente nombradas, solo validar
-            # Si no existen, intentar mapearlas
-            required_columns = {
-                'lat': ['lat', 'latitude', 'latitud'],
-                'lon': ['lon', 'longitude', 'longitud'],
-                'z_m': ['z_m', 'z', 'altura', 'height'],
-                'ch4_ppm': ['ch4_ppm', 'ch4', 'metano'],
-                'background_ppm': ['background_ppm', 'background', 'fondo'],
-                'wind_speed_ms': ['wind_speed_ms', 'wind_speed', 'velocidad_viento'],
-                'wind_dir_from_deg': ['wind_dir_from_deg', 'wind_dir', 'direccion_viento'],
-                'stability': ['stability', 'estabilidad'],
-                'source_lat': ['source_lat', 'lat_fuente'],
-                'source_lon': ['source_lon', 'lon_fuente'],
-                'source_height_m': ['source_height_m', 'altura_fuente'],
-                'Q_true_gps': ['Q_true_gps', 'q_true']
-            }
-            
-            # Intentar mapear columnas si no coinciden exactamente
-            column_mapping = {}
-            for target_col, possible_names in required_columns.items():
-                if target_col not in df.columns:
-                    for possible_name in possible_names:
-                        if possible_name in df.columns:
-                            column_mapping[possible_name] = target_col
-                            break
-            
-            if column_mapping:
-                df.rename(columns=column_mapping, inplace=True)
+            # Solo las columnas requeridas, con tipos fijos y leídas por bloques
+            df = load_dataset(file, filename=file.filename)
             
             # Procesar los datos usando el modelo gaussiano
             results = preprocess_and_invert(df)
@@ -0,0 +1,165 @@
+"""
+csv_ingest.py — Schema-driven loading of pre-merged datasets for preprocess_and_invert.
+
+Column aliases are resolved from the header alone (no data read), then only the
+needed columns are parsed, in a single pass with fixed dtypes, so extra columns are
+never materialized, pandas does not have to infer types and no intermediate chunks
+have to be concatenated (which would double the peak memory).
+Parquet and Arrow IPC/Feather inputs are read column-wise through pyarrow, which also
+speeds up CSV parsing when installed (optional: only required for those formats).
+
+Usage:
+    df = load_dataset(path_or_file, filename='campaign.parquet')
+    stats = preprocess_and_invert(df)
+"""
+
+from typing import Dict, IO, List, Union
+
+import numpy as np
+import pandas as pd
+
+# Canonical column -> accepted names in the file (compared ignoring case and surrounding spaces)
+COLUMN_ALIASES: Dict[str, List[str]] = {
+    'lat': ['lat', 'latitude', 'latitud'],
+    'lon': ['lon', 'longitude', 'longitud'],
+    'z_m': ['z_m', 'z', 'altura', 'height'],
+    'ch4_ppm': ['ch4_ppm', 'ch4', 'metano'],
+    'background_ppm': ['background_ppm', 'background', 'fondo'],
+    'wind_speed_ms': ['wind_speed_ms', 'wind_speed', 'velocidad_viento'],
+    'wind_dir_from_deg': ['wind_dir_from_deg', 'wind_dir', 'direccion_viento'],
+    'stability': ['stability', 'estabilidad'],
+    'source_lat': ['source_lat', 'lat_fuente'],
+    'source_lon': ['source_lon', 'lon_fuente'],
+    'source_height_m': ['source_height_m', 'altura_fuente'],
+    'Q_true_gps': ['Q_true_gps', 'q_true'],
+}
+OPTIONAL_COLUMNS = ('Q_true_gps',)
+STRING_COLUMNS = ('stability',)
+
+CSV_EXTENSIONS = ('.csv',)
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+ARROW_EXTENSIONS = ('.arrow', '.feather', '.ipc')
+SUPPORTED_EXTENSIONS = CSV_EXTENSIONS + PARQUET_EXTENSIONS + ARROW_EXTENSIONS
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def resolve_columns(header: List[str]) -> Dict[str, str]:
+    """
+    Map file column names to canonical names using only the header.
+    Raises ValueError listing the missing required columns.
+    """
+    by_key = {}
+    for name in header:
+        by_key.setdefault(str(name).strip().lower(), name)
+
+    mapping = {}
+    missing = []
+    for target, aliases in COLUMN_ALIASES.items():
+        for alias in [target] + aliases:
+            source = by_key.get(alias.lower())
+            if source is not None and source not in mapping:
+                mapping[source] = target
+                break
+        else:
+            if target not in OPTIONAL_COLUMNS:
+                missing.append(target)
+    if missing:
+        raise ValueError(f"Faltan columnas requeridas: {', '.join(missing)}. "
+                         f"Columnas en el archivo: {', '.join(map(str, header))}")
+    return mapping
+
+
+def _dtypes(mapping: Dict[str, str]) -> Dict[str, object]:
+    return {source: ('category' if target in STRING_COLUMNS else np.float64)
+            for source, target in mapping.items()}
+
+
+def _finish(df: pd.DataFrame, mapping: Dict[str, str]) -> pd.DataFrame:
+    # Renombrar en sitio: sin copiar las columnas ya leídas
+    df.columns = [mapping[c] for c in df.columns]
+    for col in STRING_COLUMNS:
+        categories = df[col].cat.categories if isinstance(df[col].dtype, pd.CategoricalDtype) else None
+        if categories is not None and categories.astype(str).str.strip().is_unique:
+            df[col] = df[col].cat.rename_categories(categories.astype(str).str.strip())
+        else:
+            df[col] = df[col].astype(str).str.strip().astype('category')
+    return df
+
+
+# -----------------------------
+# Readers
+# -----------------------------
+
+def read_csv(source: Union[str, IO]) -> pd.DataFrame:
+    """
+    CSV -> canonical frame, reading only the required columns in one pass: pyarrow's
+    multithreaded CSV reader when installed, else the pandas C parser.
+    """
+    header = list(pd.read_csv(source, nrows=0).columns)
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    mapping = resolve_columns(header)
+
+    pa = _pyarrow()
+    if pa is not None:
+        import pyarrow.csv as pacsv
+
+        column_types = {source_col: (pa.dictionary(pa.int32(), pa.string()) if target in STRING_COLUMNS
+                                     else pa.float64())
+                        for source_col, target in mapping.items()}
+        table = pacsv.read_csv(source, convert_options=pacsv.ConvertOptions(
+            include_columns=list(mapping), column_types=column_types))
+        return _finish(table.to_pandas(), mapping)
+
+    df = pd.read_csv(source, usecols=list(mapping), dtype=_dtypes(mapping), engine='c')
+    return _finish(df, mapping)
+
+
+def read_parquet(source: Union[str, IO]) -> pd.DataFrame:
+    """Parquet -> canonical frame, reading only the required column chunks."""
+    pa = _pyarrow()
+    if pa is None:
+        raise ValueError("Para leer archivos Parquet instale pyarrow (pip install pyarrow)")
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(source)
+    mapping = resolve_columns(parquet.schema_arrow.names)
+    table = parquet.read(columns=list(mapping))
+    return _finish(table.to_pandas(), mapping)
+
+
+def read_arrow(source: Union[str, IO]) -> pd.DataFrame:
+    """Arrow IPC / Feather v2 -> canonical frame (memory-mapped when given a path)."""
+    pa = _pyarrow()
+    if pa is None:
+        raise ValueError("Para leer archivos Arrow/Feather instale pyarrow (pip install pyarrow)")
+    import pyarrow.feather as feather
+    import pyarrow.ipc as ipc
+
+    if isinstance(source, str):
+        with pa.memory_map(source) as f:
+            mapping = resolve_columns(ipc.open_file(f).schema.names)
+    else:
+        mapping = resolve_columns(ipc.open_file(source).schema.names)
+        source.seek(0)
+    table = feather.read_table(source, columns=list(mapping), memory_map=isinstance(source, str))
+    return _finish(table.to_pandas(), mapping)
+
+
+def load_dataset(source: Union[str, IO], filename: str = '') -> pd.DataFrame:
+    """Dispatch on the file extension (of `filename`, or of `source` when it is a path)."""
+    name = (filename or (source if isinstance(source, str) else '')).lower()
+    if name.endswith(PARQUET_EXTENSIONS):
+        return read_parquet(source)
+    if name.endswith(ARROW_EXTENSIONS):
+        return read_arrow(source)
+    if name.endswith(CSV_EXTENSIONS):
+        return read_csv(source)
+    raise ValueError(f"Formato no soportado: use {', '.join(SUPPORTED_EXTENSIONS)}")
@@ -0,0 +1,323 @@
+"""
+anemometer.py — High-rate sonic anemometer logs -> measured wind and Pasquill class.
+
+A 10-20 Hz sonic log (u, v[, w] components, or speed/direction from a 2-D sonic) is read
+in chunks and reduced on the fly to additive per-block sums, so the raw samples are never
+held in memory. Two levels of averaging:
+
+    blocks    block_s long (the analyzer rate, ~1 s): mean wind speed and vector-mean
+              direction, aligned to the analyzer samples by align_to_samples()
+    windows   window_s long (default 10 min): turbulence statistics over the blocks
+              sigma_theta  Yamartino std of the horizontal direction
+              sigma_w      std of the vertical velocity (no tilt correction)
+              sigma_e      vertical direction std ~ sigma_w / U
+              and the Pasquill-Gifford class from sigma_e (sigma_theta when there is no w),
+              EPA-454/R-99-005 tables 6-8 / 6-9, with the wind-speed adjustment of the
+              unstable classes for daytime windows and the nighttime one (A-C become D-F)
+              for the others. Day is a solar elevation above 0 at the window midpoint
+              when the site position is given, else a local hour between 6 and 18.
+
+Column conventions: u / v are the east / north components of the velocity (the direction
+the air moves towards), w positive upwards, in m/s; dir_offset_deg rotates the computed
+direction when the sonic's north mark is not aligned with true north. Campbell TOA5 files
+(4 header lines, TIMESTAMP / Ux / Uy / Uz) are recognized.
+
+Usage:
+    met = read_anemometer('sonic_20hz.csv', block_s=1.0, window_s=600.0, tz=UTC_MINUS_5,
+                          lat=7.13, lon=-73.12)
+    rows = align_to_samples(met['blocks'], t_ns, block_s=1.0)   # t_ns: analyzer epoch ns
+"""
+
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+CHUNK_ROWS = int(os.environ.get('ANEMOMETER_CHUNK_ROWS', 50_000))
+WINDOW_S = 600.0
+
+# Columna canónica -> nombres aceptados en el archivo (sin distinguir mayúsculas)
+COLUMN_ALIASES: Dict[str, List[str]] = {
+    'timestamp': ['timestamp', 'time', 'datetime', 'date_time', 'fecha_hora'],
+    'u': ['u', 'u_ms', 'ux'],
+    'v': ['v', 'v_ms', 'uy'],
+    'w': ['w', 'w_ms', 'uz'],
+    'speed': ['wind_speed', 'wind_speed_ms', 'speed', 'ws', 'velocidad_viento'],
+    'dir': ['wind_dir', 'wind_dir_from_deg', 'dir', 'wd', 'direccion_viento'],
+}
+
+# Umbrales inferiores de cada clase (grados), EPA-454/R-99-005 tablas 6-8 y 6-9
+SIGMA_THETA_CLASSES = ((22.5, 'A'), (17.5, 'B'), (12.5, 'C'), (7.5, 'D'), (3.8, 'E'))
+SIGMA_E_CLASSES = ((11.5, 'A'), (10.0, 'B'), (7.8, 'C'), (5.0, 'D'), (2.4, 'E'))
+# Ajuste diurno por velocidad del viento: (clase inicial, velocidad mínima m/s, clase final)
+DAYTIME_SPEED_ADJUSTMENT = (
+    ('A', 6.0, 'D'), ('A', 4.0, 'C'), ('A', 3.0, 'B'),
+    ('B', 6.0, 'D'), ('B', 4.0, 'C'),
+    ('C', 6.0, 'D'),
+)
+# Ajuste nocturno: las clases inestables pasan a D, E o F según la velocidad del viento
+NIGHTTIME_SPEED_ADJUSTMENT = (
+    ('A', 3.6, 'D'), ('A', 2.9, 'E'), ('A', 0.0, 'F'),
+    ('B', 3.0, 'D'), ('B', 2.4, 'E'), ('B', 0.0, 'F'),
+    ('C', 2.4, 'D'), ('C', 0.0, 'E'),
+)
+# Horas locales del día cuando no se conoce la posición del sitio
+DAY_HOURS = (6, 18)
+
+_SUMS = ('n', 'n_dir', 'sum_e', 'sum_n', 'sum_speed', 'sum_sin', 'sum_cos', 'n_w', 'sum_w', 'sum_w2')
+
+
+def _resolve_columns(header: List[str]) -> Dict[str, str]:
+    by_key = {}
+    for name in header:
+        by_key.setdefault(str(name).strip().lower(), name)
+    mapping = {}
+    for target, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in by_key:
+                mapping[target] = by_key[alias]
+                break
+    if 'timestamp' not in mapping or not ({'u', 'v'} <= set(mapping) or {'speed', 'dir'} <= set(mapping)):
+        raise ValueError("El registro del anemómetro necesita una columna de tiempo y las componentes "
+                         f"u, v (o velocidad y dirección). Columnas en el archivo: {', '.join(map(str, header))}")
+    if {'u', 'v'} <= set(mapping):
+        mapping.pop('speed', None)
+        mapping.pop('dir', None)
+    return mapping
+
+
+def _read_options(path: str) -> Dict[str, Any]:
+    """Separator and header rows, from the first lines of the file."""
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        first = f.readline()
+        second = f.readline()
+    toa5 = first.lstrip('"').startswith('TOA5')
+    header = second if toa5 else first
+    sep = max((',', ';', '\t'), key=header.count)
+    if header.count(sep) == 0:
+        sep = r'\s+'
+    # TOA5: línea de metadatos, nombres, unidades y tipo de procesamiento
+    return {'sep': sep, 'skiprows': [0, 2, 3] if toa5 else None}
+
+
+def _epoch_ns(ts: pd.Series, tz) -> np.ndarray:
+    ts = pd.to_datetime(ts, errors='coerce')
+    if ts.dt.tz is None and tz is not None:
+        ts = ts.dt.tz_localize(tz, ambiguous='NaT', nonexistent='NaT')
+    if ts.dt.tz is not None:
+        ts = ts.dt.tz_convert('UTC').dt.tz_localize(None)
+    return ts.to_numpy(dtype='datetime64[ns]').astype(np.int64)
+
+
+def _chunk_sums(chunk: pd.DataFrame, mapping: Dict[str, str], block_ns: int, tz,
+                dir_offset_deg: float) -> pd.DataFrame:
+    t = _epoch_ns(chunk[mapping['timestamp']], tz)
+    if 'u' in mapping:
+        east = pd.to_numeric(chunk[mapping['u']], errors='coerce').to_numpy(dtype=float)
+        north = pd.to_numeric(chunk[mapping['v']], errors='coerce').to_numpy(dtype=float)
+        speed = np.hypot(east, north)
+        # Dirección de donde viene el viento (meteorológica)
+        dir_from = np.degrees(np.arctan2(-east, -north))
+    else:
+        speed = pd.to_numeric(chunk[mapping['speed']], errors='coerce').to_numpy(dtype=float)
+        dir_from = pd.to_numeric(chunk[mapping['dir']], errors='coerce').to_numpy(dtype=float)
+    theta = np.radians(dir_from + dir_offset_deg)
+    # Componentes hacia donde va el aire (para la dirección media vectorial)
+    east, north = -speed * np.sin(theta), -speed * np.cos(theta)
+    w = (pd.to_numeric(chunk[mapping['w']], errors='coerce').to_numpy(dtype=float)
+         if 'w' in mapping else np.full(len(chunk), np.nan))
+
+    ok = (t != np.iinfo(np.int64).min) & np.isfinite(speed) & np.isfinite(theta)
+    calm = speed <= 0
+    has_w = ok & np.isfinite(w)
+    w0 = np.where(has_w, w, 0.0)
+    sums = pd.DataFrame({
+        'n': ok.astype(np.int64),
+        'n_dir': (ok & ~calm).astype(np.int64),
+        'sum_e': np.where(ok, east, 0.0),
+        'sum_n': np.where(ok, north, 0.0),
+        'sum_speed': np.where(ok, speed, 0.0),
+        'sum_sin': np.where(ok & ~calm, np.sin(theta), 0.0),
+        'sum_cos': np.where(ok & ~calm, np.cos(theta), 0.0),
+        'n_w': has_w.astype(np.int64),
+        'sum_w': w0,
+        'sum_w2': w0 * w0,
+    })
+    block = np.where(ok, t // block_ns, 0)
+    return sums[ok].groupby(block[ok]).sum()
+
+
+def yamartino_sigma_theta(sum_sin: np.ndarray, sum_cos: np.ndarray, n: np.ndarray) -> np.ndarray:
+    """Std of the wind direction (degrees) from the sums of its sine and cosine."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sa, ca = sum_sin / n, sum_cos / n
+        eps = np.sqrt(np.clip(1.0 - (sa * sa + ca * ca), 0.0, 1.0))
+        return np.degrees(np.arcsin(eps) * (1.0 + (2.0 / np.sqrt(3.0) - 1.0) * eps ** 3))
+
+
+def solar_elevation_deg(t_ns: np.ndarray, lat_deg: float, lon_deg: float) -> np.ndarray:
+    """Approximate solar elevation (degrees, low-precision almanac formulas, ~0.5 deg) at epoch ns (UTC)."""
+    days = np.asarray(t_ns, dtype=np.int64) / 86400e9 - 10957.5  # días desde J2000.0
+    g = np.radians((357.529 + 0.98560028 * days) % 360.0)
+    q = (280.459 + 0.98564736 * days) % 360.0
+    ecl_lon = np.radians(q + 1.915 * np.sin(g) + 0.020 * np.sin(2.0 * g))
+    obliquity = np.radians(23.439 - 0.00000036 * days)
+    decl = np.arcsin(np.sin(obliquity) * np.sin(ecl_lon))
+    ra = np.arctan2(np.cos(obliquity) * np.sin(ecl_lon), np.cos(ecl_lon))
+    gmst_deg = ((18.697374558 + 24.06570982441908 * days) % 24.0) * 15.0
+    hour_angle = np.radians(gmst_deg + lon_deg) - ra
+    lat = np.radians(lat_deg)
+    return np.degrees(np.arcsin(np.sin(lat) * np.sin(decl) + np.cos(lat) * np.cos(decl) * np.cos(hour_angle)))
+
+
+def is_daytime(t_ns: np.ndarray, lat: Optional[float] = None, lon: Optional[float] = None,
+               tz=None) -> np.ndarray:
+    """Sun above the horizon at (lat, lon); without a position, local hour (tz, else UTC) in DAY_HOURS."""
+    t_ns = np.asarray(t_ns, dtype=np.int64)
+    if lat is not None and lon is not None:
+        return solar_elevation_deg(t_ns, lat, lon) > 0.0
+    times = pd.DatetimeIndex(t_ns, tz='UTC')
+    hours = (times.tz_convert(tz) if tz is not None else times).hour.to_numpy()
+    return (hours >= DAY_HOURS[0]) & (hours < DAY_HOURS[1])
+
+
+def pasquill_class(sigma_theta_deg: np.ndarray, sigma_e_deg: np.ndarray,
+                   wind_speed_ms: np.ndarray, daytime=True) -> np.ndarray:
+    """
+    Pasquill-Gifford class per interval: sigma_e when finite, else sigma_theta; F below the
+    last threshold. daytime (bool per interval) picks the day or night wind-speed adjustment.
+    """
+    use_e = np.isfinite(sigma_e_deg)
+    sigma = np.where(use_e, sigma_e_deg, sigma_theta_deg)
+    classes = np.full(sigma.shape, 'F', dtype=object)
+    for table, rows in ((SIGMA_E_CLASSES, use_e), (SIGMA_THETA_CLASSES, ~use_e)):
+        # De la clase más estable a la más inestable: el último umbral superado gana
+        for threshold, cls in reversed(table):
+            classes[rows & (sigma >= threshold)] = cls
+    initial = classes.copy()
+    day = np.broadcast_to(np.asarray(daytime, dtype=bool), classes.shape)
+    for table, rows in ((DAYTIME_SPEED_ADJUSTMENT, day), (NIGHTTIME_SPEED_ADJUSTMENT, ~day)):
+        # De la velocidad menor a la mayor: el último umbral superado gana
+        for cls, min_speed, adjusted in reversed(table):
+            classes[rows & (initial == cls) & (wind_speed_ms >= min_speed)] = adjusted
+    classes[~np.isfinite(sigma)] = None
+    return classes
+
+
+def _wind_from(sum_e: np.ndarray, sum_n: np.ndarray) -> np.ndarray:
+    return (np.degrees(np.arctan2(-sum_e, -sum_n)) + 360.0) % 360.0
+
+
+def read_anemometer(path: str, block_s: float = 1.0, window_s: float = WINDOW_S, tz=None,
+                    dir_offset_deg: float = 0.0, chunk_rows: int = CHUNK_ROWS,
+                    lat: Optional[float] = None, lon: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Stream a sonic log into block averages and turbulence windows.
+    tz: timezone of naive timestamps (aware ones are converted). lat / lon: site position,
+    for the day / night split of the stability classes (see is_daytime). Returns
+    {'blocks': frame indexed by block start (epoch ns), 'windows': frame indexed by window
+    start, 'n_samples', 'rate_hz', 'block_s', 'window_s'}. Raises ValueError on unusable files.
+    """
+    options = _read_options(path)
+    header = list(pd.read_csv(path, nrows=0, **options).columns)
+    mapping = _resolve_columns(header)
+    block_ns = max(int(round(block_s * 1e9)), 1)
+
+    parts = []
+    reader = pd.read_csv(path, usecols=list(mapping.values()), dtype={mapping['timestamp']: str},
+                         chunksize=chunk_rows, **options)
+    for chunk in reader:
+        parts.append(_chunk_sums(chunk, mapping, block_ns, tz, dir_offset_deg))
+    # Un bloque puede quedar repartido entre dos fragmentos: volver a sumar por bloque
+    sums = pd.concat(parts).groupby(level=0).sum() if parts else pd.DataFrame(columns=_SUMS)
+    if sums.empty or sums['n'].sum() == 0:
+        raise ValueError("El registro del anemómetro no tiene muestras válidas")
+
+    blocks = pd.DataFrame(index=pd.Index(sums.index.to_numpy(dtype=np.int64) * block_ns, name='t_ns'))
+    blocks['n_samples'] = sums['n'].to_numpy()
+    blocks['wind_speed_ms'] = sums['sum_speed'].to_numpy() / sums['n'].to_numpy()
+    blocks['wind_dir_from_deg'] = _wind_from(sums['sum_e'].to_numpy(), sums['sum_n'].to_numpy())
+
+    window_ns = max(int(round(window_s * 1e9)), block_ns)
+    window_id = blocks.index.to_numpy() // window_ns
+    w = sums.groupby(window_id).sum()
+    n = w['n'].to_numpy(dtype=float)
+    n_w = w['n_w'].to_numpy(dtype=float)
+    speed = w['sum_speed'].to_numpy() / n
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_w = w['sum_w'].to_numpy() / n_w
+        sigma_w = np.where(n_w > 1, np.sqrt(np.maximum(w['sum_w2'].to_numpy() / n_w - mean_w ** 2, 0.0)), np.nan)
+        sigma_e = np.where(speed > 0, np.degrees(sigma_w / speed), np.nan)
+    sigma_theta = yamartino_sigma_theta(w['sum_sin'].to_numpy(), w['sum_cos'].to_numpy(),
+                                        w['n_dir'].to_numpy(dtype=float))
+    start_ns = w.index.to_numpy(dtype=np.int64) * window_ns
+    daytime = is_daytime(start_ns + window_ns // 2, lat, lon, tz)
+    windows = pd.DataFrame({
+        'n_samples': w['n'].to_numpy(),
+        'wind_speed_ms': speed,
+        'wind_dir_from_deg': _wind_from(w['sum_e'].to_numpy(), w['sum_n'].to_numpy()),
+        'sigma_theta_deg': sigma_theta,
+        'sigma_w_ms': sigma_w,
+        'sigma_e_deg': sigma_e,
+        'daytime': daytime,
+        'stability': pasquill_class(sigma_theta, sigma_e, speed, daytime),
+    }, index=pd.Index(start_ns, name='t_ns'))
+
+    # Cada bloque hereda la turbulencia y la clase de su ventana
+    for col in ('sigma_theta_deg', 'sigma_w_ms', 'stability'):
+        blocks[col] = windows[col].reindex(window_id * window_ns).to_numpy()
+
+    n_samples = int(sums['n'].sum())
+    span_s = (blocks.index[-1] - blocks.index[0]) / 1e9 + block_s
+    return {
+        'blocks': blocks,
+        'windows': windows,
+        'n_samples': n_samples,
+        'rate_hz': float(n_samples / span_s) if span_s > 0 else 0.0,
+        'block_s': float(block_s),
+        'window_s': float(window_ns / 1e9),
+    }
+
+
+def sample_period_s(t_ns: np.ndarray) -> float:
+    """Median spacing of the analyzer samples (the block length for read_anemometer)."""
+    dt = np.diff(np.sort(np.asarray(t_ns, dtype=np.int64)))
+    dt = dt[dt > 0]
+    return float(np.median(dt) / 1e9) if dt.size else 1.0
+
+
+def align_to_samples(blocks: pd.DataFrame, t_ns: np.ndarray, block_s: float) -> pd.DataFrame:
+    """
+    Block values for each analyzer sample (the block that contains its timestamp); NaN
+    where the log has no data. Rows stay aligned with t_ns.
+    """
+    block_ns = max(int(round(block_s * 1e9)), 1)
+    start = (np.asarray(t_ns, dtype=np.int64) // block_ns) * block_ns
+    starts = blocks.index.to_numpy(dtype=np.int64)
+    pos = np.clip(np.searchsorted(starts, start), 0, max(len(starts) - 1, 0))
+    found = starts[pos] == start if len(starts) else np.zeros(len(start), dtype=bool)
+    out = blocks.iloc[pos].reset_index(drop=True)
+    out.loc[~found, :] = np.nan
+    return out
+
+
+def _number(value) -> Optional[float]:
+    return None if pd.isna(value) else float(value)
+
+
+def summarize_windows(windows: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Turbulence windows as JSON-friendly rows (start time in UTC ISO format)."""
+    rows = []
+    for t, row in windows.iterrows():
+        rows.append({
+            'start': pd.Timestamp(t, tz='UTC').isoformat(),
+            'n_samples': int(row['n_samples']),
+            'wind_speed_ms': _number(row['wind_speed_ms']),
+            'wind_dir_from_deg': _number(row['wind_dir_from_deg']),
+            'sigma_theta_deg': _number(row['sigma_theta_deg']),
+            'sigma_w_ms': _number(row['sigma_w_ms']),
+            'daytime': bool(row['daytime']),
+            'stability': None if pd.isna(row['stability']) else str(row['stability']),
+        })
+    return rows
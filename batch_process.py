@@ -0,0 +1,231 @@
+"""
+batch_process.py — Process a directory tree of drives (.data + .gpx pairs) in parallel.
+
+Each drive is run through pipeline.run_pipeline on its own worker process and one
+summary row per drive is written to CSV or Parquet (Parquet needs pyarrow, checked
+before any drive is processed). A manifest of input hashes (manifest.json in the
+output directory) lets re-runs skip drives whose files and options are unchanged; it
+is saved after every finished drive, so an interrupted run resumes where it stopped.
+A worker that dies (e.g. out of memory) yields an error row for its drive, which is
+not kept in the manifest and is retried on the next run.
+
+Usage:
+    python batch_process.py DATA_DIR --out results/ --gas CH4 --format csv
+    python batch_process.py DATA_DIR --out results/ --workers 4 --force
+
+Pairing: inside each directory, a .data file is paired with the only .gpx file,
+or with the .gpx whose name ends with the same instrument/serial number
+(e.g. "... s-n 1183.data" with "... s-n 1183.gpx").
+"""
+
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple, Any
+
+import pandas as pd
+
+import columnar_export
+from pipeline import PipelineConfig, PipelineError, file_sha256, run_pipeline
+
+MANIFEST_NAME = 'manifest.json'
+_TRAILING_NUMBER = re.compile(r'(\d+)\s*$')
+
+
+def config_hash(config: PipelineConfig) -> str:
+    return hashlib.sha256(json.dumps(config.to_dict(), sort_keys=True).encode()).hexdigest()
+
+
+def _serial_number(filename: str) -> Optional[str]:
+    m = _TRAILING_NUMBER.search(os.path.splitext(filename)[0])
+    return m.group(1) if m else None
+
+
+def find_drives(root: str) -> List[Tuple[str, str]]:
+    """Walk `root` and return (data_path, gpx_path) pairs, one per drive."""
+    pairs = []
+    for dirpath, _, filenames in os.walk(root):
+        datas = sorted(f for f in filenames if f.endswith('.data'))
+        gpxs = sorted(f for f in filenames if f.endswith('.gpx'))
+        if not datas or not gpxs:
+            continue
+        for data_name in datas:
+            if len(gpxs) == 1:
+                gpx_name = gpxs[0]
+            else:
+                serial = _serial_number(data_name)
+                matches = [g for g in gpxs if serial and _serial_number(g) == serial]
+                if len(matches) != 1:
+                    print(f"[skip] {os.path.join(dirpath, data_name)}: no se pudo emparejar con un .gpx")
+                    continue
+                gpx_name = matches[0]
+            pairs.append((os.path.join(dirpath, data_name), os.path.join(dirpath, gpx_name)))
+    return pairs
+
+
+def process_drive(data_path: str, gpx_path: str, config: PipelineConfig) -> Dict[str, Any]:
+    """Run the pipeline for one drive and flatten the outcome into a summary row."""
+    row: Dict[str, Any] = {
+        'data_path': data_path,
+        'gpx_path': gpx_path,
+        'gas_type': config.gas_type,
+        'status': 'ok',
+        'error': '',
+    }
+    try:
+        out = run_pipeline(data_path, gpx_path, config)
+    except PipelineError as e:
+        row.update(status='error', error=e.message)
+        return row
+    except Exception as e:
+        row.update(status='error', error=f'{type(e).__name__}: {e}')
+        return row
+
+    params = out['params']
+    row.update({
+        'merged_points': len(out['merged_df']),
+        'analyzer_lag_s': out['merge_info']['analyzer_lag_s'],
+        'filtered_points': len(out['model_df']),
+        'background': params['background'],
+        'source_lat': params['source_lat'],
+        'source_lon': params['source_lon'],
+        'wind_dir_from_deg': params['wind_dir_from_deg'],
+        'wind_speed_ms': params['wind_speed_ms'],
+    })
+    combined = out['transects']['combined']
+    row.update({
+        'n_transects': len(out['transects']['transects']),
+        'n_transects_accepted': combined['n_transects'],
+        'Q_transects_gph': combined.get('Q_hat_gph'),
+        'Q_transects_spread_gph': combined.get('Q_spread_gph'),
+        'Q_mass_balance_gph': combined.get('Q_mb_median_gph'),
+    })
+    results = out['results']
+    if results is None:
+        row.update(status='no_fit', error=out['last_error'])
+        return row
+    for key in ('Q_hat_gps', 'Q_std_gps', 'Q_hat_gph', 'Q_std_gph', 'R2', 'Q2_kfold', 'Q2_loo',
+                'n_points', 'stability_used'):
+        row[key] = results[key]
+    for key, value in results['metrics'].items():
+        row[key] = value
+    return row
+
+
+def load_manifest(out_dir: str) -> Dict[str, Any]:
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(out_dir: str, manifest: Dict[str, Any]) -> None:
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(tmp, path)
+
+
+def check_format(fmt: str) -> None:
+    """Fail before processing anything if the output format cannot be written."""
+    if fmt not in ('csv', 'parquet'):
+        raise ValueError(f"Formato de salida no válido: {fmt} (use csv o parquet)")
+    if fmt == 'parquet' and not columnar_export.available():
+        raise ValueError("--format parquet requiere pyarrow (pip install pyarrow); use --format csv")
+
+
+def write_results(rows: List[Dict[str, Any]], out_dir: str, fmt: str = 'csv') -> str:
+    df = pd.DataFrame(rows)
+    if fmt == 'parquet':
+        path = os.path.join(out_dir, 'results.parquet')
+        df.to_parquet(path, index=False)
+    else:
+        path = os.path.join(out_dir, 'results.csv')
+        df.to_csv(path, index=False)
+    return path
+
+
+def run_batch(root: str, out_dir: str, config: Optional[PipelineConfig] = None,
+              workers: Optional[int] = None, fmt: str = 'csv', force: bool = False) -> str:
+    """
+    Process every drive under `root`, reusing manifest rows for drives whose
+    input hashes and options are unchanged. Returns the results file path.
+    Raises ValueError if `fmt` cannot be written (see check_format).
+    """
+    check_format(fmt)
+    config = config or PipelineConfig(verbose=False)
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {} if force else load_manifest(out_dir)
+    cfg_hash = config_hash(config)
+
+    drives = find_drives(root)
+    new_manifest: Dict[str, Any] = {}
+    pending = []
+    for data_path, gpx_path in drives:
+        key = os.path.relpath(data_path, root)
+        entry = {
+            'data_sha256': file_sha256(data_path),
+            'gpx_sha256': file_sha256(gpx_path),
+            'gpx_path': os.path.relpath(gpx_path, root),
+            'config_hash': cfg_hash,
+        }
+        old = manifest.get(key)
+        # Sin 'row' el recorrido quedó pendiente en una ejecución interrumpida
+        if old and 'row' in old and all(old.get(k) == entry[k] for k in ('data_sha256', 'gpx_sha256', 'gpx_path', 'config_hash')):
+            new_manifest[key] = old
+        else:
+            new_manifest[key] = entry
+            pending.append((key, data_path, gpx_path))
+
+    print(f"{len(drives)} recorridos encontrados, {len(pending)} por procesar, "
+          f"{len(drives) - len(pending)} sin cambios")
+
+    # Filas de trabajadores caídos: van a los resultados pero no al manifiesto (se reintentan)
+    crashed: Dict[str, Dict[str, Any]] = {}
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            futures = {pool.submit(process_drive, data_path, gpx_path, config): (key, data_path, gpx_path)
+                       for key, data_path, gpx_path in pending}
+            for fut in as_completed(futures):
+                key, data_path, gpx_path = futures[fut]
+                try:
+                    row = fut.result()
+                except Exception as e:
+                    crashed[key] = {'data_path': data_path, 'gpx_path': gpx_path, 'gas_type': config.gas_type,
+                                    'status': 'error', 'error': f'{type(e).__name__}: {e}'}
+                    print(f"[error] {key}: {crashed[key]['error']}")
+                    continue
+                new_manifest[key]['row'] = row
+                save_manifest(out_dir, new_manifest)
+                print(f"[{row['status']}] {key}")
+    save_manifest(out_dir, new_manifest)
+
+    rows = [crashed[key] if key in crashed else entry['row']
+            for key, entry in sorted(new_manifest.items()) if 'row' in entry or key in crashed]
+    return write_results(rows, out_dir, fmt)
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="Batch Gaussian-plume analysis of LI-7810 + GPX drives.")
+    ap.add_argument("root", help="Directory tree containing .data/.gpx drives.")
+    ap.add_argument("--out", default="batch_results", help="Output directory (results + manifest).")
+    ap.add_argument("--gas", default="CH4", choices=["CH4", "CO2", "H2O"])
+    ap.add_argument("--format", default="csv", choices=["csv", "parquet"])
+    ap.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores).")
+    ap.add_argument("--force", action="store_true", help="Ignore the manifest and reprocess every drive.")
+    ap.add_argument("--selection", default="loo", choices=["kfold", "loo", "r2"],
+                    help="Configuration selection: blocked k-fold CV, leave-one-out CV or in-sample R².")
+    args = ap.parse_args()
+    try:
+        check_format(args.format)
+    except ValueError as e:
+        ap.error(str(e))
+    config = PipelineConfig(gas_type=args.gas, selection_criterion=args.selection, verbose=False)
+    path = run_batch(args.root, args.out, config,
+                     workers=args.workers, fmt=args.format, force=args.force)
+    print(f"Resultados: {path}")
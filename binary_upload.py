@@ -0,0 +1,132 @@
+"""
+binary_upload.py — Compact binary upload of pre-parsed LI-7810 + GPX drives.
+
+static/js/parse_worker.js parses the .data and .gpx files in the browser (Web Worker)
+and uploads only the columns the pipeline uses, as little-endian typed arrays. The
+server reads them with np.frombuffer: no text parsing at all.
+
+Layout (all little-endian):
+    b'GEA1'                      magic
+    uint32                       length of the JSON header in bytes
+    JSON header (UTF-8)          {"version": 1, "gas_type": "CH4",
+                                  "data_filename": "...", "gpx_filename": "...",
+                                  "arrays": [{"name": "gas_t_ms", "dtype": "f8", "n": N}, ...]}
+    zero padding to a multiple of 8
+    arrays, in header order, each zero-padded to a multiple of 8 bytes
+
+Arrays:
+    gas_t_ms  f8  analyzer DATE + TIME as milliseconds, wall clock read as if UTC (the
+                  file's local time, America/Bogota = UTC-5, as in parse_data_file)
+    gas       f8  concentration of gas_type in the file's units (CH4 ppb, CO2/H2O ppm)
+    gps_t_ms  f8  GPX <time> as epoch milliseconds (UTC)
+    lat, lon  f8  degrees
+    ele       f8  GPX <ele> (m; 0 when missing)
+
+Every column is f8, so the decoded frames equal the text parsers' bit for bit. Payloads
+from older clients with gas / ele as f4 are still accepted (float32 rounding: ~1e-4 ppb on
+CH4 near 2000 ppb).
+
+Usage:
+    gps_df, gas_df, info = decode(payload_bytes, tz)
+    payload = encode(gas_t_ms, gas, gps_t_ms, lat, lon, ele, gas_type='CH4')   # Python clients
+"""
+
+import json
+import struct
+from typing import Any, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+MAGIC = b'GEA1'
+VERSION = 1
+DTYPES = {'f4': '<f4', 'f8': '<f8'}
+# Columnas esperadas y su tipo
+SCHEMA = {'gas_t_ms': 'f8', 'gas': 'f8', 'gps_t_ms': 'f8', 'lat': 'f8', 'lon': 'f8', 'ele': 'f8'}
+# Tipos aceptados además del de SCHEMA (clientes anteriores enviaban gas y ele en f4)
+LEGACY_DTYPES = {'gas': ('f4',), 'ele': ('f4',)}
+GAS_ARRAYS = ('gas_t_ms', 'gas')
+GPS_ARRAYS = ('gps_t_ms', 'lat', 'lon', 'ele')
+
+
+def _pad8(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def encode(gas_t_ms, gas, gps_t_ms, lat, lon, ele, gas_type: str = 'CH4',
+           data_filename: str = '', gpx_filename: str = '') -> bytes:
+    """Build a payload (same layout as parse_worker.js)."""
+    arrays = {'gas_t_ms': gas_t_ms, 'gas': gas, 'gps_t_ms': gps_t_ms, 'lat': lat, 'lon': lon, 'ele': ele}
+    header = {'version': VERSION, 'gas_type': gas_type, 'data_filename': data_filename,
+              'gpx_filename': gpx_filename, 'arrays': []}
+    blobs = []
+    for name, dtype in SCHEMA.items():
+        values = np.ascontiguousarray(arrays[name], dtype=DTYPES[dtype])
+        header['arrays'].append({'name': name, 'dtype': dtype, 'n': int(values.size)})
+        raw = values.tobytes()
+        blobs.append(raw + b'\0' * (_pad8(len(raw)) - len(raw)))
+    head = json.dumps(header).encode('utf-8')
+    prefix = MAGIC + struct.pack('<I', len(head)) + head
+    return prefix + b'\0' * (_pad8(len(prefix)) - len(prefix)) + b''.join(blobs)
+
+
+def decode_arrays(payload: bytes) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    """Validate the layout and return (header, {name: array}) as zero-copy views."""
+    if len(payload) < 8 or payload[:4] != MAGIC:
+        raise ValueError("El archivo binario no tiene el formato esperado (GEA1)")
+    (head_len,) = struct.unpack_from('<I', payload, 4)
+    if 8 + head_len > len(payload):
+        raise ValueError("Cabecera del archivo binario incompleta")
+    header = json.loads(payload[8:8 + head_len].decode('utf-8'))
+    if header.get('version') != VERSION:
+        raise ValueError(f"Versión de formato binario no soportada: {header.get('version')}")
+
+    offset = _pad8(8 + head_len)
+    arrays = {}
+    for spec in header.get('arrays', []):
+        name, dtype, n = spec['name'], spec['dtype'], int(spec['n'])
+        if name not in SCHEMA or (dtype != SCHEMA[name] and dtype not in LEGACY_DTYPES.get(name, ())):
+            raise ValueError(f"Columna binaria no válida: {name} ({dtype})")
+        dt = np.dtype(DTYPES[dtype])
+        nbytes = n * dt.itemsize
+        if n < 0 or offset + nbytes > len(payload):
+            raise ValueError(f"Datos incompletos en la columna {name}")
+        arrays[name] = np.frombuffer(payload, dtype=dt, count=n, offset=offset)
+        offset += _pad8(nbytes)
+    missing = [name for name in SCHEMA if name not in arrays]
+    if missing:
+        raise ValueError(f"Faltan columnas en el archivo binario: {', '.join(missing)}")
+    if len({arrays[name].size for name in GAS_ARRAYS}) != 1 or len({arrays[name].size for name in GPS_ARRAYS}) != 1:
+        raise ValueError("Las columnas del archivo binario tienen longitudes distintas")
+    return header, arrays
+
+
+def decode(payload: bytes, tz) -> Tuple[pd.DataFrame, pd.DataFrame, Dict[str, Any]]:
+    """
+    Payload -> (gps_df, gas_df, info) with the same columns as parse_gpx_file /
+    parse_data_file, timestamps in `tz` (the analyzer's local zone). info holds
+    gas_type and the original file names.
+    """
+    header, arrays = decode_arrays(payload)
+    gas_type = header.get('gas_type', 'CH4')
+
+    gps_df = pd.DataFrame({
+        'lat': arrays['lat'].astype(float),
+        'lon': arrays['lon'].astype(float),
+        'elevation': arrays['ele'].astype(float),
+        'timestamp': pd.to_datetime(arrays['gps_t_ms'], unit='ms', utc=True).tz_convert(tz),
+    })
+    gps_df = gps_df[np.isfinite(arrays['gps_t_ms'])].reset_index(drop=True)
+
+    gas_df = pd.DataFrame({
+        'timestamp': pd.to_datetime(arrays['gas_t_ms'], unit='ms').tz_localize(tz),
+        'gas_concentration': arrays['gas'].astype(float),
+    })
+    gas_df['gas_type'] = gas_type
+    gas_df = gas_df.dropna().reset_index(drop=True)
+
+    info = {'gas_type': gas_type,
+            'data_filename': header.get('data_filename', ''),
+            'gpx_filename': header.get('gpx_filename', ''),
+            'bytes': len(payload)}
+    return gps_df, gas_df, info
@@ -0,0 +1,74 @@
+"""
+build_assets.py — Fingerprint static assets so browsers can cache them immutably.
+
+Copies every file under static/ (except static/dist/) to
+static/dist/<dir>/<name>.<sha256[:10]><ext>, rewrites /static/... references inside
+CSS/JS to the fingerprinted names, writes precompressed .gz (and .br when the
+`brotli` package is installed) copies of text assets, and records the mapping in
+static/dist/manifest.json. http_cache.asset_url() reads the manifest at startup.
+
+Run it as part of the deploy build (after pip install):
+    python build_assets.py
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+from http_cache import DIST_DIR, MANIFEST_NAME, _brotli
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(_HERE, 'static')
+TEXT_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.html')
+
+
+def _fingerprinted(rel: str, content: bytes) -> str:
+    root, ext = os.path.splitext(rel)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:10]}{ext}"
+
+
+def build(static_dir: str = STATIC_DIR) -> dict:
+    """Rebuild static/dist; returns the manifest {original: fingerprinted} (paths relative to static/)."""
+    dist = os.path.join(static_dir, DIST_DIR)
+    shutil.rmtree(dist, ignore_errors=True)
+    sources = sorted(os.path.relpath(os.path.join(dirpath, f), static_dir).replace(os.sep, '/')
+                     for dirpath, _, files in os.walk(static_dir)
+                     for f in files)
+    # Primero binarios (imágenes), después texto: así CSS/JS pueden apuntar a los nombres con hash
+    sources.sort(key=lambda rel: rel.endswith(TEXT_EXTENSIONS))
+
+    manifest = {}
+    brotli = _brotli()
+    for rel in sources:
+        with open(os.path.join(static_dir, rel), 'rb') as f:
+            content = f.read()
+        if rel.endswith(TEXT_EXTENSIONS):
+            text = content.decode('utf-8')
+            for original, hashed in manifest.items():
+                text = text.replace(f'/static/{original}', f'/static/{hashed}')
+            content = text.encode('utf-8')
+        target = f"{DIST_DIR}/{_fingerprinted(rel, content)}"
+        out = os.path.join(static_dir, target)
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        with open(out, 'wb') as f:
+            f.write(content)
+        if rel.endswith(TEXT_EXTENSIONS):
+            with open(out + '.gz', 'wb') as f:
+                f.write(gzip.compress(content, compresslevel=9))
+            if brotli is not None:
+                with open(out + '.br', 'wb') as f:
+                    f.write(brotli.compress(content, quality=11))
+        manifest[rel] = target
+
+    with open(os.path.join(dist, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+if __name__ == "__main__":
+    result = build(sys.argv[1] if len(sys.argv) > 1 else STATIC_DIR)
+    for original, hashed in sorted(result.items()):
+        print(f"{original} -> {hashed}")
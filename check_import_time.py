@@ -0,0 +1,83 @@
+"""
+check_import_time.py — Import-time budget for the Flask app.
+
+Runs `python -X importtime -c "import codigo_HTML_Gausiana"` in a clean subprocess,
+reports the slowest imports, then times create_app() (which warms the heavy
+modules). Exits with status 1 when a budget is exceeded or when a module that
+must stay off the import path (sklearn, pandas, plotly) is imported eagerly.
+
+Usage:
+    python check_import_time.py
+    IMPORT_BUDGET_MS=400 CREATE_APP_BUDGET_MS=2500 python check_import_time.py
+"""
+
+import os
+import subprocess
+import sys
+
+IMPORT_BUDGET_MS = float(os.environ.get('IMPORT_BUDGET_MS', 500))
+CREATE_APP_BUDGET_MS = float(os.environ.get('CREATE_APP_BUDGET_MS', 3000))
+# Módulos que no deben cargarse al importar la app (se importan bajo demanda)
+FORBIDDEN_AT_IMPORT = ('sklearn', 'pandas', 'plotly')
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _importtime(module: str):
+    """Return [(cumulative_us, self_us, name)] parsed from -X importtime."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=_HERE, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr[-2000:])
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cum_us, name = (p.strip() for p in line[len('import time:'):].split('|'))
+        rows.append((int(cum_us), int(self_us), name))
+    return rows
+
+
+def _create_app_ms() -> float:
+    code = ('import time, tempfile, os\n'
+            'os.chdir(tempfile.mkdtemp())\n'
+            't = time.perf_counter()\n'
+            'import codigo_HTML_Gausiana as m\n'
+            'm.create_app()\n'
+            'print((time.perf_counter() - t) * 1000)\n')
+    proc = subprocess.run([sys.executable, '-c', code], cwd=_HERE, capture_output=True, text=True,
+                          env={**os.environ, 'PYTHONPATH': _HERE})
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr[-2000:])
+    return float(proc.stdout.strip().splitlines()[-1])
+
+
+def main() -> int:
+    rows = _importtime('codigo_HTML_Gausiana')
+    total_ms = next(cum for cum, _, name in rows if name.strip() == 'codigo_HTML_Gausiana') / 1000.0
+    loaded = {name.strip().split('.')[0] for _, _, name in rows}
+    eager = [m for m in FORBIDDEN_AT_IMPORT if m in loaded]
+
+    print("=== Importaciones más lentas (acumulado) ===")
+    for cum, _, name in sorted(rows, reverse=True)[:10]:
+        print(f"{cum / 1000:8.1f} ms  {name}")
+    print(f"\nimport codigo_HTML_Gausiana: {total_ms:.1f} ms (presupuesto {IMPORT_BUDGET_MS:.0f} ms)")
+
+    create_ms = _create_app_ms()
+    print(f"import + create_app() (con precarga): {create_ms:.1f} ms (presupuesto {CREATE_APP_BUDGET_MS:.0f} ms)")
+
+    ok = True
+    if total_ms > IMPORT_BUDGET_MS:
+        print("ERROR: se excedió el presupuesto de importación")
+        ok = False
+    if create_ms > CREATE_APP_BUDGET_MS:
+        print("ERROR: se excedió el presupuesto de create_app()")
+        ok = False
+    if eager:
+        print(f"ERROR: módulos pesados importados al cargar la app: {', '.join(eager)}")
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
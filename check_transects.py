@@ -0,0 +1,69 @@
+"""
+check_transects.py — Regression check for the transect acceptance rules.
+
+Writes the synthetic drive that used to break the combined estimate (loadtest seed 1,
+3000 points: a crossing that only sees the far tails of the plume, sum G^2 ~ 1e-29,
+gave Q ~ 1e15 g/s with a tiny Q_std and pooled to ~1e18 g/h), runs the pipeline and
+checks that every accepted transect passes transect_accepted() and that the combined
+least-squares rate is finite and within a factor of 100 of the full fit. The degenerate
+sufficient statistics recorded from that drive are also checked directly. Exits with
+status 1 on failure.
+
+Usage:
+    python check_transects.py
+"""
+
+import math
+import os
+import sys
+import tempfile
+
+# Estadísticos del cruce 5 de la semilla 1 (3000 puntos) antes del arreglo
+DEGENERATE_STATS = {'H_m': 2.0, 'stability': 'C', 'n': 4, 'sum_gg': 3.73e-29,
+                    'sum_gy': 9.02e-14, 'sum_y': 40.0, 'sum_yy': 600.0}
+MAX_RATIO = 100.0
+
+
+def main() -> int:
+    from gaussian_ch4 import StreamingEmissionEstimator
+    from loadtest import write_synthetic_drive
+    from pipeline import PipelineConfig, run_pipeline, transect_accepted
+
+    config = PipelineConfig(verbose=False, mc_samples=0)
+    errors = []
+
+    est = StreamingEmissionEstimator(**DEGENERATE_STATS)
+    if math.isfinite(est.Q_std) or transect_accepted(est, 1e-9, config):
+        errors.append(f"cruce degenerado aceptado: Q={est.Q_hat:.3g} g/s, Q_std={est.Q_std:.3g} g/s")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path, gpx_path = write_synthetic_drive(os.path.join(tmp, 'drive'), n_points=3000, seed=1)
+        result = run_pipeline(data_path, gpx_path, config)
+
+    if result['results'] is None:
+        print(f"ERROR: sin ajuste para el recorrido sintético ({result['last_error']})")
+        return 1
+    q_fit = result['results']['Q_hat_gph']
+    transects = result['transects']['transects']
+    combined = result['transects']['combined']
+    accepted = [t for t in transects if t['accepted']]
+    print(f"Ajuste completo: Q = {q_fit:.4g} g/h")
+    print(f"Cruces: {len(transects)}, aceptados: {len(accepted)}")
+    for t in accepted:
+        if t['Q_std_gph'] is None or t['Q_std_gph'] > config.transect_max_rel_std * t['Q_hat_gph']:
+            errors.append(f"cruce {t['transect']} aceptado con Q_std/Q fuera de límite")
+    if 'Q_hat_gph' in combined:
+        q_comb = combined['Q_hat_gph']
+        print(f"Combinado: Q = {q_comb:.4g} g/h con {combined['n_transects']} cruces")
+        if not (math.isfinite(q_comb) and q_fit / MAX_RATIO <= q_comb <= q_fit * MAX_RATIO):
+            errors.append(f"Q combinado {q_comb:.3g} g/h incompatible con el ajuste completo {q_fit:.3g} g/h")
+    else:
+        print("Combinado: ningún cruce aceptado")
+
+    for e in errors:
+        print(f"ERROR: {e}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
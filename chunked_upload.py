@@ -0,0 +1,275 @@
+"""
+chunked_upload.py — Chunked, resumable uploads of large analyzer logs and GPS tracks.
+
+Protocol (routes in codigo_HTML_Gausiana.py):
+    POST /uploads                      {"filename", "size", "kind": "data"|"gpx"}
+                                       -> {"upload_id", "chunk_size", "offset": 0}
+    GET  /uploads/<id>                 -> {"offset", "size", "complete", "parsed_rows"}
+    PUT  /uploads/<id>?offset=N        body = bytes [N, N + len), header X-Chunk-CRC32 (hex)
+                                       -> {"offset", "complete", "parsed_rows"}
+                                       409 + current offset when N is not the server's offset
+                                       (resume from there), 400 when the checksum fails
+    POST /upload  dataUploadId=...&gpxUploadId=...   runs the analysis on completed uploads
+
+A session lives in UPLOAD_FOLDER/chunked/<id>/ (meta.json, file.part and, for .data
+files, the parsed columns t.i8 / gas.f8), so any gunicorn worker can take the next
+chunk; a file lock serializes writers. Every accepted chunk of a .data file is parsed
+right away up to its last complete line and the rows are appended to the column
+files: when the last chunk arrives the analyzer log is already parsed.
+
+Sessions older than SESSION_TTL_S are removed when a new one is created.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from pipeline import (
+    PipelineConfig, PipelineError, check_parsed_inputs, data_header_columns, data_row_fields,
+    data_rows_frame, file_sha256, gas_frame, merge_inputs, parse_gpx_file,
+)
+
+CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_BYTES', 4 * 1024 * 1024))
+MAX_CHUNK_SIZE = 4 * CHUNK_SIZE
+SESSION_TTL_S = float(os.environ.get('UPLOAD_SESSION_TTL_S', 24 * 3600))
+KINDS = ('data', 'gpx')
+# Columnas de gas guardadas al parsear (el gas se elige al analizar)
+GAS_COLUMNS = ('H2O', 'CO2', 'CH4')
+
+
+class UploadError(Exception):
+    """Protocol error; status is the HTTP code to answer with."""
+
+    def __init__(self, message: str, status: int = 400, **extra):
+        super().__init__(message)
+        self.status = status
+        self.extra = extra
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'error': str(self), **self.extra}
+
+
+class ChunkedUploadStore:
+    """Upload sessions on disk, shared by all workers."""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    # -- sessions --------------------------------------------------------
+
+    def _dir(self, upload_id: str) -> str:
+        if not upload_id or not all(c in '0123456789abcdef' for c in upload_id):
+            raise UploadError(f'Identificador de carga no válido: {upload_id}', 404)
+        return os.path.join(self.root, upload_id)
+
+    def _read_meta(self, upload_id: str) -> Dict[str, Any]:
+        path = os.path.join(self._dir(upload_id), 'meta.json')
+        if not os.path.exists(path):
+            raise UploadError(f'No existe la carga {upload_id} (puede haber expirado)', 404)
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_meta(self, meta: Dict[str, Any]) -> None:
+        path = os.path.join(self._dir(meta['upload_id']), 'meta.json')
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp, path)
+
+    @contextmanager
+    def _locked(self, upload_id: str):
+        with open(os.path.join(self._dir(upload_id), 'lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def create(self, filename: str, size: int, kind: str) -> Dict[str, Any]:
+        if kind not in KINDS:
+            raise UploadError(f'Tipo de archivo no válido: {kind} (data o gpx)')
+        if size < 0:
+            raise UploadError('El tamaño del archivo no es válido')
+        self.purge_expired()
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._dir(upload_id))
+        open(os.path.join(self._dir(upload_id), 'file.part'), 'wb').close()
+        meta = {'upload_id': upload_id, 'filename': filename, 'kind': kind, 'size': int(size),
+                'offset': 0, 'complete': size == 0, 'sha256': None, 'created_at': time.time(),
+                # Estado del parseo incremental (.data)
+                'parsed_offset': 0, 'columns': None, 'parsed_rows': 0}
+        self._write_meta(meta)
+        return self.status(upload_id)
+
+    def status(self, upload_id: str) -> Dict[str, Any]:
+        meta = self._read_meta(upload_id)
+        return {'upload_id': upload_id, 'filename': meta['filename'], 'kind': meta['kind'],
+                'size': meta['size'], 'offset': meta['offset'], 'complete': meta['complete'],
+                'parsed_rows': meta['parsed_rows'], 'chunk_size': CHUNK_SIZE}
+
+    def purge_expired(self) -> None:
+        now = time.time()
+        for name in os.listdir(self.root):
+            meta_path = os.path.join(self.root, name, 'meta.json')
+            try:
+                expired = now - os.path.getmtime(meta_path) > SESSION_TTL_S
+            except OSError:
+                continue
+            if expired:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    # -- chunks ----------------------------------------------------------
+
+    def append(self, upload_id: str, offset: int, chunk: bytes, crc32: Optional[str]) -> Dict[str, Any]:
+        """Append one chunk at `offset` after checking it; parses completed .data lines."""
+        if len(chunk) > MAX_CHUNK_SIZE:
+            raise UploadError(f'Fragmento demasiado grande ({len(chunk)} bytes, máximo {MAX_CHUNK_SIZE})', 413)
+        if crc32 is None:
+            raise UploadError('Falta la cabecera X-Chunk-CRC32')
+        try:
+            expected = int(crc32, 16)
+        except ValueError:
+            raise UploadError('X-Chunk-CRC32 debe ser hexadecimal')
+        if expected != zlib.crc32(chunk):
+            raise UploadError('El fragmento llegó dañado (CRC32 no coincide); reenvíalo', 400)
+        self._read_meta(upload_id)  # 404 si no existe
+        with self._locked(upload_id):
+            meta = self._read_meta(upload_id)
+            if offset != meta['offset']:
+                # El cliente debe continuar desde el offset que tiene el servidor
+                raise UploadError('Offset fuera de orden', 409, offset=meta['offset'])
+            if meta['offset'] + len(chunk) > meta['size']:
+                raise UploadError('El fragmento excede el tamaño declarado del archivo', 400,
+                                  offset=meta['offset'])
+            part = os.path.join(self._dir(upload_id), 'file.part')
+            with open(part, 'r+b') as f:
+                f.seek(offset)
+                f.write(chunk)
+                f.truncate()
+            meta['offset'] = offset + len(chunk)
+            meta['complete'] = meta['offset'] == meta['size']
+            if meta['kind'] == 'data':
+                self._parse_available(meta)
+            if meta['complete']:
+                meta['sha256'] = file_sha256(part)
+            self._write_meta(meta)
+        return self.status(upload_id)
+
+    # -- incremental parsing of .data -------------------------------------
+
+    def _parse_available(self, meta: Dict[str, Any]) -> None:
+        """Parse from parsed_offset to the last complete line (to the end once complete)."""
+        directory = self._dir(meta['upload_id'])
+        with open(os.path.join(directory, 'file.part'), 'rb') as f:
+            f.seek(meta['parsed_offset'])
+            data = f.read(meta['offset'] - meta['parsed_offset'])
+        cut = len(data) if meta['complete'] else data.rfind(b'\n') + 1
+        if cut <= 0:
+            return
+        lines = data[:cut].decode('utf-8', errors='replace').splitlines()
+        meta['parsed_offset'] += cut
+
+        if meta['columns'] is None:
+            for i, line in enumerate(lines):
+                if line.startswith('DATAH'):
+                    meta['columns'] = data_header_columns(line)
+                    lines = lines[i + 1:]
+                    break
+            else:
+                return
+        columns = meta['columns']
+        # Mismo tratamiento de filas que parse_data_file: las incompletas se rellenan con None
+        keep = [i for i, col in enumerate(columns) if col in ('DATE', 'TIME') + GAS_COLUMNS]
+        rows = [data_row_fields(line, keep) for line in lines if line.startswith('DATA\t')]
+        if not rows:
+            return
+        df = data_rows_frame(rows, [columns[i] for i in keep])
+        t = df['timestamp'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+        gas = np.column_stack([df[c].to_numpy(dtype=float) if c in df.columns else np.full(len(df), np.nan)
+                               for c in GAS_COLUMNS])
+        # Truncar a lo ya registrado en meta.json: un worker caído a mitad no duplica filas
+        n = meta['parsed_rows']
+        _append_at(os.path.join(directory, 't.i8'), n * 8, t.astype('<i8').tobytes())
+        _append_at(os.path.join(directory, 'gas.f8'), n * 8 * len(GAS_COLUMNS), gas.astype('<f8').tobytes())
+        meta['parsed_rows'] += len(rows)
+
+    # -- completed uploads ---------------------------------------------------
+
+    def completed(self, upload_id: str, kind: str) -> Dict[str, Any]:
+        meta = self._read_meta(upload_id)
+        if meta['kind'] != kind:
+            raise UploadError(f'La carga {upload_id} no es un archivo {kind}')
+        if not meta['complete']:
+            raise UploadError(f"La carga de {meta['filename']} no ha terminado "
+                              f"({meta['offset']} de {meta['size']} bytes)", 409, offset=meta['offset'])
+        return meta
+
+    def path(self, upload_id: str) -> str:
+        return os.path.join(self._dir(upload_id), 'file.part')
+
+    def gas_frame(self, upload_id: str, gas_type: str) -> pd.DataFrame:
+        """Parsed analyzer samples of a completed .data upload (same frame as parse_data_file)."""
+        meta = self.completed(upload_id, 'data')
+        if meta['columns'] is None:
+            raise ValueError("No se encontró el header DATAH en el archivo")
+        directory = self._dir(upload_id)
+        t = np.fromfile(os.path.join(directory, 't.i8'), dtype='<i8') if meta['parsed_rows'] else np.array([], np.int64)
+        gas = (np.fromfile(os.path.join(directory, 'gas.f8'), dtype='<f8').reshape(-1, len(GAS_COLUMNS))
+               if meta['parsed_rows'] else np.empty((0, len(GAS_COLUMNS))))
+        # iNaT vuelve a NaT al convertir a datetime64
+        df = pd.DataFrame({'timestamp': pd.to_datetime(t.astype('datetime64[ns]'))})
+        for i, col in enumerate(GAS_COLUMNS):
+            if col in meta['columns']:
+                df[col] = gas[:, i]
+        return gas_frame(df, gas_type)
+
+
+def completed_pair(store: ChunkedUploadStore, data_upload_id: str, gpx_upload_id: str):
+    """Session metadata (with the SHA-256 of each file) of two completed uploads, or PipelineError."""
+    try:
+        return store.completed(data_upload_id, 'data'), store.completed(gpx_upload_id, 'gpx')
+    except UploadError as e:
+        raise PipelineError(str(e), 'Termina (o reanuda) la carga de ambos archivos antes de analizar.')
+
+
+def load_and_merge_uploads(store: ChunkedUploadStore, data_upload_id: str, gpx_upload_id: str,
+                           config: Optional[PipelineConfig] = None):
+    """
+    load_and_merge for two completed chunked uploads: the analyzer log was parsed while it
+    arrived, only the GPX is parsed here. Returns (gps_df, gas_df, merged_df, merge_info)
+    with the original file names and SHA-256 of both files in merge_info.
+    """
+    config = config or PipelineConfig()
+    data_meta, gpx_meta = completed_pair(store, data_upload_id, gpx_upload_id)
+    try:
+        gps_df = parse_gpx_file(store.path(gpx_upload_id))
+    except Exception as e:
+        raise PipelineError(f'Error al leer el archivo GPS: {str(e)}',
+                            'Asegúrate de que el archivo .gpx esté en formato válido GPX 1.1')
+    try:
+        gas_df = store.gas_frame(data_upload_id, config.gas_type)
+    except ValueError as e:
+        raise PipelineError(f'Error al leer el archivo del analizador: {str(e)}',
+                            'Asegúrate de que el archivo .data sea del formato LI-7810 con header DATAH.')
+    check_parsed_inputs(gps_df, gas_df, config.gas_type)
+
+    gps_df, gas_df, merged_df, merge_info = merge_inputs(gps_df, gas_df, config)
+    merge_info.update(data_filename=data_meta['filename'], gpx_filename=gpx_meta['filename'],
+                      data_sha256=data_meta['sha256'], gpx_sha256=gpx_meta['sha256'])
+    return gps_df, gas_df, merged_df, merge_info
+
+
+def _append_at(path: str, length: int, data: bytes) -> None:
+    with open(path, 'ab') as f:
+        f.truncate(length)
+        f.write(data)
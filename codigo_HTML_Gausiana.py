@@ -1,163 +1,199 @@
+"""
+Aplicación Flask del analizador de emisiones (LI-7810 + GPX).
+
+Estructura preparada para gunicorn --preload:
+    - create_app() construye la app (sin efectos secundarios al importar el módulo).
+    - Las dependencias pesadas (pandas, plotly, pipeline) se importan de forma diferida
+      dentro de las vistas; warm_up() las carga y ejercita una vez en el proceso maestro
+      para que los workers las compartan copy-on-write tras el fork.
+    - `codigo_HTML_Gausiana:app` sigue funcionando: el atributo se crea bajo demanda.
+"""
+
 import os
-from flask import Flask, render_template, request, jsonify
-import pandas as pd
-import numpy as np
-import plotly.express as px
-import plotly.graph_objects as go
-from gaussian_ch4 import preprocess_and_invert
-import json
-import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta
-import pytz
-from sklearn.metrics import pairwise_distances
-
-app = Flask(__name__)
-
-# Asegurarse de que existe el directorio para subir archivos
-UPLOAD_FOLDER = 'uploads'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-
-# Zona horaria UTC-5
-UTC_MINUS_5 = pytz.timezone('America/Bogota')
-
-def parse_gpx_file(gpx_file):
-    """Parse GPX file and extract trackpoints with timestamps"""
-    tree = ET.parse(gpx_file)
-    root = tree.getroot()
-    
-    # Namespace para GPX
-    ns = {'gpx': 'http://www.topografix.com/GPX/1/1'}
-    
-    trackpoints = []
-    for trkpt in root.findall('.//gpx:trkpt', ns):
-        lat = float(trkpt.get('lat'))
-        lon = float(trkpt.get('lon'))
-        
-        ele_elem = trkpt.find('gpx:ele', ns)
-        ele = float(ele_elem.text) if ele_elem is not None else 0.0
-        
-        time_elem = trkpt.find('gpx:time', ns)
-        if time_elem is not None:
-            # Parse ISO format timestamp and convert to UTC-5
-            timestamp = datetime.fromisoformat(time_elem.text.replace('Z', '+00:00'))
-            timestamp = timestamp.astimezone(UTC_MINUS_5)
-            
-            trackpoints.append({
-                'lat': lat,
-                'lon': lon,
-                'elevation': ele,
-                'timestamp': timestamp
-            })
-    
-    return pd.DataFrame(trackpoints)
+import uuid
+from flask import Blueprint, Flask, current_app, render_template, request, jsonify
 
-def parse_data_file(data_file, gas_type='CH4'):
-    """Parse .data file from LI-7810 analyzer"""
-    # Leer el archivo buscando la línea que empieza con DATAH (header)
-    with open(data_file, 'r') as f:
-        lines = f.readlines()
-    
-    # Encontrar índice del header
-    header_idx = None
-    for i, line in enumerate(lines):
-        if line.startswith('DATAH'):
-            header_idx = i
-            break
-    
-    if header_idx is None:
-        raise ValueError("No se encontró el header DATAH en el archivo")
-    
-    # Leer columnas del header
-    header_line = lines[header_idx].strip().split('\t')
-    header_cols = [col.strip() for col in header_line]
-    
-    # Leer datos
-    data_rows = []
-    for line in lines[header_idx + 2:]:  # Saltar DATAH y DATAU
-        if line.startswith('DATA\t'):
-            row = line.strip().split('\t')
-            data_rows.append(row[1:])  # Quitar 'DATA' del inicio
-    
-    # Crear DataFrame
-    df = pd.DataFrame(data_rows, columns=header_cols[1:])
-    
-    # Convertir columnas numéricas
-    numeric_cols = ['SECONDS', 'H2O', 'CO2', 'CH4']
-    for col in numeric_cols:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-    
-    # Combinar DATE y TIME para crear timestamp
-    df['timestamp'] = pd.to_datetime(df['DATE'] + ' ' + df['TIME'], errors='coerce')
-    
-    # Convertir a UTC-5 (el archivo dice America/Bogota que es UTC-5)
-    df['timestamp'] = df['timestamp'].dt.tz_localize(UTC_MINUS_5)
-    
-    # Seleccionar columna de gas
-    gas_column_map = {
-        'CH4': 'CH4',  # ppb (lo mantendremos en ppb)
-        'CO2': 'CO2',  # ppm
-        'H2O': 'H2O'   # ppm
-    }
-    
-    if gas_type not in gas_column_map:
-        raise ValueError(f"Tipo de gas no válido: {gas_type}")
-    
-    gas_col = gas_column_map[gas_type]
-    
-    # Mantener las unidades originales
-    df['gas_concentration'] = df[gas_col]
-    df['gas_type'] = gas_type
-    
-    # Guardar las unidades
-    if gas_type == 'CH4':
-        df['gas_units'] = 'ppb'
-    else:
-        df['gas_units'] = 'ppm'
-    
-    # Debug: imprimir algunos valores
-    print(f"\n=== DEBUG: Parseo de archivo .data para {gas_type} ===")
-    print(f"Total de filas antes de dropna: {len(df)}")
-    print(f"Valores no nulos de {gas_col}: {df[gas_col].notna().sum()}")
-    print(f"Primeros 10 valores de {gas_col}:")
-    print(df[gas_col].head(10))
-    print("="*50)
-    
-    result_df = df[['timestamp', 'gas_concentration', 'gas_type', 'gas_units']].dropna()
-    print(f"Total de filas después de dropna: {len(result_df)}")
-    if len(result_df) > 0:
-        print(f"Primeros 5 valores gas_concentration: {result_df['gas_concentration'].head().tolist()}")
-    
-    return result_df
+import http_cache
+import memory_profile
+from results_store import ResultsStore, DEFAULT_DB_PATH
+from result_cache import (ResultCache, ARTIFACT_CACHE_PATH, ARTIFACT_MAX_BYTES, ARTIFACT_MAX_ENTRIES,
+                          ARTIFACT_TTL_S, DEFAULT_CACHE_PATH, make_cache_key)
 
-def merge_gps_and_gas_data(gps_df, gas_df):
-    """Merge GPS and gas analyzer data by matching timestamps"""
-    # Asegurarse de que ambos timestamps estén en UTC-5
-    gps_df['timestamp'] = pd.to_datetime(gps_df['timestamp'])
-    gas_df['timestamp'] = pd.to_datetime(gas_df['timestamp'])
-    
-    # Merge asof (nearest timestamp matching)
-    merged_df = pd.merge_asof(
-        gps_df.sort_values('timestamp'),
-        gas_df.sort_values('timestamp'),
-        on='timestamp',
-        direction='nearest',
-        tolerance=pd.Timedelta('5s')  # Tolerancia de 5 segundos
+bp = Blueprint('analyzer', __name__)
+
+
+def create_app(test_config=None):
+    """App factory. Con WARM_CACHES (por defecto activo) precarga los módulos pesados."""
+    app = Flask(__name__)
+    app.config.from_mapping(
+        UPLOAD_FOLDER=os.environ.get('UPLOAD_FOLDER', 'uploads'),
+        RESULTS_DB=DEFAULT_DB_PATH,
+        RESULT_CACHE_DB=DEFAULT_CACHE_PATH,
+        ARTIFACT_CACHE_DB=ARTIFACT_CACHE_PATH,
+        WARM_CACHES=os.environ.get('WARM_CACHES', '1') == '1',
+        # Pico de memoria por etapa con tracemalloc y límite por solicitud (ver memory_profile.py)
+        MEMORY_PROFILE=os.environ.get('MEMORY_PROFILE', '0') == '1',
+        MEMORY_BUDGET_MB=memory_profile.MEMORY_BUDGET_MB,
     )
-    
-    return merged_df.dropna()
+    if test_config:
+        app.config.update(test_config)
+
+    # Asegurarse de que existe el directorio para subir archivos
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    # Historial de análisis (SQLite local, ver results_store.py)
+    app.extensions['results_store'] = ResultsStore(app.config['RESULTS_DB'])
+    # Caché de respuestas de /upload compartida entre workers (ver result_cache.py)
+    app.extensions['result_cache'] = ResultCache(app.config['RESULT_CACHE_DB'])
+    # Puntos y celdas del mapa y tablas de exportación: caché propia con sus límites, independiente de la de respuestas
+    app.extensions['artifact_cache'] = ResultCache(app.config['ARTIFACT_CACHE_DB'], ARTIFACT_TTL_S,
+                                                   ARTIFACT_MAX_BYTES, ARTIFACT_MAX_ENTRIES)
+
+    app.register_blueprint(bp)
+    # Compresión gzip/brotli, ETags y estáticos con hash (ver http_cache.py y build_assets.py)
+    http_cache.init_app(app)
+
+    if app.config['WARM_CACHES']:
+        warm_up()
+    return app
+
+
+def warm_up():
+    """
+    Importar pandas/numpy/plotly y ejecutar una inversión y figuras mínimas, de modo que
+    los módulos, validadores de trazas de plotly y tablas de zona horaria queden cargados
+    antes del fork de los workers.
+    """
+    import plotly.graph_objects as go
+    import pipeline  # noqa: F401  (pandas, numpy, pytz)
+    from gaussian_ch4 import simulate_dataset, preprocess_and_invert
+
+    preprocess_and_invert(simulate_dataset(n_points=200), wind_sector_half_width_deg=180.0)
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=[0.0], y=[0.0]))
+    fig.add_trace(go.Scattergl(x=[0.0], y=[0.0]))
+    fig.add_trace(go.Densitymapbox(lat=[0.0], lon=[0.0], z=[0.0]))
+    fig.add_trace(go.Scattermapbox(lat=[0.0], lon=[0.0]))
+    fig.add_trace(go.Barpolar(r=[1.0], theta=[0.0]))
+    fig.to_json()
+
+
+def __getattr__(name):
+    # Compatibilidad con `gunicorn codigo_HTML_Gausiana:app`: crear la app solo cuando se pide
+    if name == 'app':
+        app = create_app()
+        globals()['app'] = app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _results_store():
+    return current_app.extensions['results_store']
+
+
+def _result_cache():
+    return current_app.extensions['result_cache']
+
+
+def _artifact_cache():
+    return current_app.extensions['artifact_cache']
+
+
+def _chunked_uploads():
+    # Se crea al primer uso: chunked_upload importa pandas (ver check_import_time.py)
+    if 'chunked_uploads' not in current_app.extensions:
+        from chunked_upload import ChunkedUploadStore
+        current_app.extensions['chunked_uploads'] = ChunkedUploadStore(
+            os.path.join(current_app.config['UPLOAD_FOLDER'], 'chunked'))
+    return current_app.extensions['chunked_uploads']
+
 
-@app.route('/')
+@bp.route('/')
 def home():
     return render_template('index.html')
 
-@app.route('/upload', methods=['POST'])
+def _cleanup_uploads(*paths):
+    """Eliminar archivos temporales subidos (ignora errores)."""
+    for path in paths:
+        try:
+            if path and os.path.exists(path):
+                os.remove(path)
+        except Exception as cleanup_error:
+            print(f"Error al limpiar archivos temporales: {cleanup_error}")
+
+def map_cell_hover(cells, gas_type, gas_units):
+    """Texto de hover de cada celda agregada del mapa."""
+    return [f"<b>{gas_type} medio:</b> {mean:.1f} {gas_units}<br><b>Máximo:</b> {vmax:.1f} {gas_units}"
+            f"<br><b>Incremento medio:</b> {enh:.1f} {gas_units}<br><b>Puntos:</b> {n}"
+            for mean, vmax, enh, n in zip(cells['mean'], cells['max'], cells['enhancement_mean'], cells['count'])]
+
+def iso_timestamps(timestamps):
+    """
+    Tiempos como texto ISO 8601 con su desfase horario (el mismo instante que
+    Timestamp.isoformat()), en bloque con np.datetime_as_string: sin un pd.Timestamp por muestra.
+    """
+    import numpy as np
+
+    tz = timestamps.dt.tz
+    wall = (timestamps.dt.tz_localize(None) if tz is not None else timestamps).to_numpy(dtype='datetime64[us]')
+    # Segundos enteros salvo que alguna muestra tenga fracción
+    unit = 's' if not (wall.view(np.int64) % 1_000_000).any() else 'us'
+    text = np.datetime_as_string(wall, unit=unit)
+    if tz is not None:
+        utc = timestamps.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy(dtype='datetime64[us]')
+        offsets, inverse = np.unique((wall - utc).astype('timedelta64[m]').astype(np.int64), return_inverse=True)
+        suffixes = np.array([f"{'+' if m >= 0 else '-'}{abs(m) // 60:02d}:{abs(m) % 60:02d}" for m in offsets])
+        text = np.char.add(text, suffixes[inverse])
+    return text.tolist()
+
+def _check_memory_budget(predicted_bytes, what):
+    """PipelineError si la memoria prevista supera MEMORY_BUDGET_MB (ver memory_profile.py)."""
+    from pipeline import PipelineError
+    budget_mb = current_app.config['MEMORY_BUDGET_MB']
+    if memory_profile.over_budget(predicted_bytes, budget_mb):
+        raise PipelineError(
+            f'El análisis necesitaría unos {predicted_bytes / 2**20:.0f} MB de memoria ({what}), '
+            f'más que el límite de {budget_mb:g} MB por solicitud.',
+            'Divide el recorrido en archivos más cortos o pide al administrador que aumente MEMORY_BUDGET_MB.',
+            details={'predicted_mb': round(predicted_bytes / 2**20, 1), 'budget_mb': budget_mb})
+
+def _json_payload(response_data, figures):
+    """
+    Respuesta JSON en bytes con las figuras ya serializadas (fig.to_json()) insertadas tal
+    cual: evita reconstruir cada figura como objetos Python (json.loads) para volver a
+    serializarla.
+    """
+    head = current_app.json.dumps(response_data).encode('utf-8')
+    parts = [head[:-1]]
+    for name, fig_json in figures.items():
+        parts.append(f',"{name}":'.encode('utf-8'))
+        parts.append(fig_json.encode('utf-8') if fig_json is not None else b'null')
+    parts.append(b'}')
+    return b''.join(parts)
+
+@bp.route('/upload', methods=['POST'])
+@bp.route('/upload/binary', methods=['POST'])
 def upload_file():
+    """
+    Archivos .data + .gpx, binaryFile con el recorrido pre-procesado en el navegador,
+    o mergedFile con una combinación exportada (.parquet/.arrow) para re-analizarla.
+    Con cualquiera de ellos, anemometerFile (opcional) aporta el viento y la estabilidad medidos.
+    """
+    import gc
     import sys
-    
+    import numpy as np
+    import plotly.graph_objects as go
+    from pipeline import (
+        PipelineConfig, PipelineError, GAS_UNITS, load_and_merge, load_and_merge_binary, load_saved_merge,
+        estimate_model_parameters, estimate_background, build_model_frame, measured_meteorology,
+        has_measured_meteorology, estimate_heights, search_best_configuration, compute_fit_metrics,
+        analyze_transects, file_sha256,
+    )
+    from map_aggregation import AGGREGATE_MIN_POINTS, aggregate_cells, cached_cells, store_points
+    from chunked_upload import completed_pair, load_and_merge_uploads
+    import columnar_export
+    from uncertainty import monte_carlo_emission
+
     # Escribir a archivo de log
     with open('debug_log.txt', 'w', encoding='utf-8') as f:
         f.write("="*60 + "\n")
@@ -171,264 +207,234 @@ def upload_file():
     print("="*60, flush=True)
     sys.stdout.flush()
     
-    # Verificar que se hayan subido los archivos necesarios
-    if 'dataFile' not in request.files or 'gpxFile' not in request.files:
-        return jsonify({'error': 'Se requieren ambos archivos: .data y .gpx'})
-    
-    data_file = request.files['dataFile']
-    gpx_file = request.files['gpxFile']
     gas_type = request.form.get('gasType', 'CH4')
+    # Recorrido pre-procesado en el navegador: columnas en arreglos binarios (ver binary_upload.py)
+    binary_file = request.files.get('binaryFile')
+    # Combinación GPS + analizador exportada antes (ver columnar_export.py)
+    merged_file = request.files.get('mergedFile')
+    if merged_file is not None and not merged_file.filename:
+        merged_file = None
+    # Archivos subidos por fragmentos (ver chunked_upload.py)
+    data_upload_id = request.form.get('dataUploadId')
+    gpx_upload_id = request.form.get('gpxUploadId')
+    # Registro del anemómetro sónico (opcional, ver anemometer.py)
+    anemometer_file = request.files.get('anemometerFile')
+    if anemometer_file is not None and not anemometer_file.filename:
+        anemometer_file = None
+
+    if merged_file is not None:
+        data_file = gpx_file = None
+        merged_ext = os.path.splitext(merged_file.filename)[1].lower()
+        if merged_ext not in ('.parquet', '.arrow', '.feather'):
+            return jsonify({'error': f'El archivo "{merged_file.filename}" no es una combinación guardada (.parquet o .arrow).'})
+        print(f"Combinación guardada: {merged_file.filename}", flush=True)
+    elif binary_file is not None:
+        data_file = gpx_file = None
+        print(f"Carga binaria pre-procesada: {binary_file.filename}", flush=True)
+    elif data_upload_id or gpx_upload_id:
+        if not (data_upload_id and gpx_upload_id):
+            return jsonify({'error': 'Se requieren ambas cargas por fragmentos: dataUploadId y gpxUploadId'})
+        data_file = gpx_file = None
+        print(f"Cargas por fragmentos: {data_upload_id} (.data), {gpx_upload_id} (.gpx)", flush=True)
+    else:
+        # Verificar que se hayan subido los archivos necesarios
+        if 'dataFile' not in request.files or 'gpxFile' not in request.files:
+            return jsonify({'error': 'Se requieren ambos archivos: .data y .gpx'})
+        
+        data_file = request.files['dataFile']
+        gpx_file = request.files['gpxFile']
+        
+        with open('debug_log.txt', 'a', encoding='utf-8') as f:
+            f.write(f"Archivo .data: {data_file.filename}\n")
+            f.write(f"Archivo .gpx: {gpx_file.filename}\n")
+            f.write(f"Tipo de gas: {gas_type}\n")
+        
+        print(f"Archivo .data: {data_file.filename}", flush=True)
+        print(f"Archivo .gpx: {gpx_file.filename}", flush=True)
+        print(f"Tipo de gas: {gas_type}", flush=True)
+        sys.stdout.flush()
+        
+        if data_file.filename == '' or gpx_file.filename == '':
+            return jsonify({'error': 'Por favor seleccione ambos archivos (.data y .gpx)'})
+        
+        # Validar extensiones de archivo
+        if not data_file.filename.endswith('.data'):
+            return jsonify({'error': f'El archivo "{data_file.filename}" no es un archivo .data válido. Por favor seleccione un archivo del analizador LI-7810.'})
+        
+        if not gpx_file.filename.endswith('.gpx'):
+            return jsonify({'error': f'El archivo "{gpx_file.filename}" no es un archivo .gpx válido. Por favor seleccione un archivo GPS válido.'})
     
-    with open('debug_log.txt', 'a', encoding='utf-8') as f:
-        f.write(f"Archivo .data: {data_file.filename}\n")
-        f.write(f"Archivo .gpx: {gpx_file.filename}\n")
-        f.write(f"Tipo de gas: {gas_type}\n")
-    
-    print(f"Archivo .data: {data_file.filename}", flush=True)
-    print(f"Archivo .gpx: {gpx_file.filename}", flush=True)
-    print(f"Tipo de gas: {gas_type}", flush=True)
-    sys.stdout.flush()
-    
-    if data_file.filename == '' or gpx_file.filename == '':
-        return jsonify({'error': 'Por favor seleccione ambos archivos (.data y .gpx)'})
-    
-    # Validar extensiones de archivo
-    if not data_file.filename.endswith('.data'):
-        return jsonify({'error': f'El archivo "{data_file.filename}" no es un archivo .data válido. Por favor seleccione un archivo del analizador LI-7810.'})
-    
-    if not gpx_file.filename.endswith('.gpx'):
-        return jsonify({'error': f'El archivo "{gpx_file.filename}" no es un archivo .gpx válido. Por favor seleccione un archivo GPS válido.'})
-    
+    data_path = gpx_path = anemometer_path = None
+    mem = memory_profile.StageMemory(current_app.config['MEMORY_PROFILE'])
     try:
-        # Guardar archivos temporalmente
-        data_path = os.path.join(app.config['UPLOAD_FOLDER'], data_file.filename)
-        gpx_path = os.path.join(app.config['UPLOAD_FOLDER'], gpx_file.filename)
-        data_file.save(data_path)
-        gpx_file.save(gpx_path)
+        # Guardar archivos temporalmente (nombre único: varias solicitudes/workers a la vez)
+        upload_id = uuid.uuid4().hex
+        if merged_file is not None:
+            data_path = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{upload_id}{merged_ext}")
+            merged_file.save(data_path)
+        elif binary_file is not None:
+            data_path = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{upload_id}.bin")
+            binary_file.save(data_path)
+        elif data_upload_id:
+            pass  # Ya están en disco; se conservan para repetir el análisis con otras opciones
+        else:
+            data_path = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{upload_id}.data")
+            gpx_path = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{upload_id}.gpx")
+            data_file.save(data_path)
+            gpx_file.save(gpx_path)
+        if anemometer_file is not None:
+            anemometer_ext = os.path.splitext(anemometer_file.filename)[1].lower() or '.csv'
+            anemometer_path = os.path.join(current_app.config['UPLOAD_FOLDER'], f"{upload_id}_anemometer{anemometer_ext}")
+            anemometer_file.save(anemometer_path)
+            print(f"Registro del anemómetro: {anemometer_file.filename}", flush=True)
         
         print("Archivos guardados temporalmente")
         
-        # Parsear archivos con manejo de errores
-        try:
-            gps_df = parse_gpx_file(gpx_path)
+        merge_mode = request.form.get('mergeMode', 'nearest')
+        if merge_mode not in ('nearest', 'interpolate'):
+            raise PipelineError(f'Modo de combinación no válido: {merge_mode}')
+        background_mode = request.form.get('backgroundMode', 'global')
+        if background_mode not in ('global', 'time', 'distance'):
+            raise PipelineError(f'Modo de background no válido: {background_mode}')
+        robust_loss = request.form.get('robustLoss', 'l2')
+        if robust_loss not in ('l2', 'huber', 'tukey'):
+            raise PipelineError(f'Tipo de ajuste no válido: {robust_loss}')
+        selection_criterion = request.form.get('selectionCriterion', 'loo')
+        if selection_criterion not in ('kfold', 'loo', 'r2'):
+            raise PipelineError(f'Criterio de selección no válido: {selection_criterion}')
+        config = PipelineConfig(gas_type=gas_type, merge_mode=merge_mode, background_mode=background_mode,
+                                robust_loss=robust_loss, selection_criterion=selection_criterion)
+        gas_units = GAS_UNITS.get(gas_type, 'ppm')
+        if data_upload_id:
+            # El hash de cada archivo se calculó al recibir su último fragmento
+            data_meta, gpx_meta = completed_pair(_chunked_uploads(), data_upload_id, gpx_upload_id)
+            data_hash, gpx_hash = data_meta['sha256'], gpx_meta['sha256']
+        else:
+            data_hash = file_sha256(data_path)
+            # La carga binaria y la combinación guardada contienen ambos recorridos:
+            # su hash identifica la entrada completa
+            if gpx_path:
+                gpx_hash = file_sha256(gpx_path)
+            else:
+                gpx_hash = 'merged' if merged_file is not None else 'binary'
+        inputs_hash = data_hash[:32] + gpx_hash[:32]
+
+        # Misma entrada y mismas opciones: devolver la respuesta cacheada
+        options = config.to_dict()
+        if anemometer_path:
+            options['anemometer_sha256'] = file_sha256(anemometer_path)
+        cache_key = make_cache_key(data_hash, gpx_hash, gas_type, options)
+        cached = _result_cache().get(cache_key)
+        if cached is not None:
+            print("Respuesta servida desde caché")
+            _cleanup_uploads(data_path, gpx_path, anemometer_path)
+            return current_app.response_class(cached, mimetype='application/json')
+
+        # Límite de memoria: el parseo de texto crece con el tamaño de los archivos
+        if data_upload_id:
+            _check_memory_budget(memory_profile.predict_parse_bytes(data_meta['size'] + gpx_meta['size']),
+                                 'lectura de los archivos')
+        elif gpx_path:
+            _check_memory_budget(memory_profile.predict_parse_bytes(
+                os.path.getsize(data_path) + os.path.getsize(gpx_path)), 'lectura de los archivos')
+
+        # Parsear y combinar archivos (ver pipeline.py)
+        mem.stage('parse_merge')
+        if merged_file is not None:
+            gps_df, gas_df, merged_df, merge_info = load_saved_merge(data_path, config)
+            data_filename = merge_info.get('data_filename') or merged_file.filename
+            gpx_filename = merge_info.get('gpx_filename') or merged_file.filename
+        elif binary_file is not None:
+            gps_df, gas_df, merged_df, merge_info = load_and_merge_binary(data_path, config)
+            data_filename, gpx_filename = merge_info['data_filename'], merge_info['gpx_filename']
+        elif data_upload_id:
+            gps_df, gas_df, merged_df, merge_info = load_and_merge_uploads(
+                _chunked_uploads(), data_upload_id, gpx_upload_id, config)
+            data_filename, gpx_filename = merge_info['data_filename'], merge_info['gpx_filename']
+        else:
+            gps_df, gas_df, merged_df, merge_info = load_and_merge(data_path, gpx_path, config)
+            data_filename, gpx_filename = data_file.filename, gpx_file.filename
+        print(f"Retardo del analizador aplicado: {merge_info['analyzer_lag_s']:.1f} s")
+
+        if gps_df is not None:
             print(f"GPS DataFrame: {len(gps_df)} puntos")
-            
-            if len(gps_df) == 0:
-                return jsonify({
-                    'error': 'El archivo GPS no contiene puntos de rastreo válidos.',
-                    'suggestion': 'Verifica que el archivo .gpx contenga datos de track válidos con coordenadas y timestamps.'
-                })
-        except Exception as e:
-            return jsonify({
-                'error': f'Error al leer el archivo GPS: {str(e)}',
-                'suggestion': 'Asegúrate de que el archivo .gpx esté en formato válido GPX 1.1'
-            })
-        
-        try:
-            gas_df = parse_data_file(data_path, gas_type)
             print(f"Gas DataFrame: {len(gas_df)} puntos")
-            print(f"Primeros valores de gas: {gas_df['gas_concentration'].head().tolist()}")
-            
-            if len(gas_df) == 0:
-                return jsonify({
-                    'error': f'El archivo .data no contiene mediciones válidas de {gas_type}.',
-                    'suggestion': f'Verifica que el archivo contenga datos de {gas_type} del analizador LI-7810.'
-                })
-        except ValueError as e:
-            return jsonify({
-                'error': f'Error al leer el archivo del analizador: {str(e)}',
-                'suggestion': 'Asegúrate de que el archivo .data sea del formato LI-7810 con header DATAH.'
-            })
-        except Exception as e:
-            return jsonify({
-                'error': f'Error inesperado al procesar el archivo .data: {str(e)}',
-                'suggestion': 'Verifica que el archivo esté completo y no esté corrupto.'
-            })
-        
-        with open('debug_log.txt', 'a', encoding='utf-8') as f:
-            f.write(f"GPS DataFrame: {len(gps_df)} puntos\n")
-            f.write(f"Gas DataFrame: {len(gas_df)} puntos\n")
-            f.write(f"Primeros valores de gas: {gas_df['gas_concentration'].head().tolist()}\n")
-        
-        # Combinar datos
-        merged_df = merge_gps_and_gas_data(gps_df, gas_df)
-        
         print(f"Merged DataFrame: {len(merged_df)} puntos")
-        print(f"Primeros valores de gas en merged: {merged_df['gas_concentration'].head().tolist()}")
-        
         with open('debug_log.txt', 'a', encoding='utf-8') as f:
+            if gps_df is not None:
+                f.write(f"GPS DataFrame: {len(gps_df)} puntos\n")
+                f.write(f"Gas DataFrame: {len(gas_df)} puntos\n")
             f.write(f"Merged DataFrame: {len(merged_df)} puntos\n")
-            f.write(f"Primeros valores de gas en merged: {merged_df['gas_concentration'].head().tolist()}\n")
-        
-        if len(merged_df) == 0:
-            return jsonify({
-                'error': 'No se pudieron combinar los datos GPS y del analizador. Verifica que los archivos correspondan al mismo período de tiempo.',
-                'details': {
-                    'gps_points': len(gps_df),
-                    'gas_points': len(gas_df),
-                    'gps_time_range': f"{gps_df['timestamp'].min()} a {gps_df['timestamp'].max()}" if len(gps_df) > 0 else 'N/A',
-                    'gas_time_range': f"{gas_df['timestamp'].min()} a {gas_df['timestamp'].max()}" if len(gas_df) > 0 else 'N/A'
-                }
-            })
-        
-        # Validar que hay suficientes puntos
-        if len(merged_df) < 10:
-            return jsonify({
-                'error': f'Insuficientes puntos combinados ({len(merged_df)}). Se necesitan al menos 10 puntos para el análisis.',
-                'suggestion': 'Verifica que los archivos GPS y del analizador se hayan grabado al mismo tiempo.'
-            })
-        
-        # Preparar datos para análisis gaussiano - VERSIÓN MEJORADA V2
-        
-        # 1. BACKGROUND DINÁMICO: usar percentil 10 (más robusto que percentil 5)
-        background_default = merged_df['gas_concentration'].quantile(0.10)
-        
-        # 2. UBICACIÓN DE LA FUENTE: usar el punto de MÁXIMA concentración
-        max_conc_idx = merged_df['gas_concentration'].idxmax()
-        source_lat = merged_df.loc[max_conc_idx, 'lat']
-        source_lon = merged_df.loc[max_conc_idx, 'lon']
-        
-        # 3. ESTIMACIÓN DE DIRECCIÓN DEL VIENTO: calcular vector desde centroide a máxima concentración
-        centroid_lat = merged_df['lat'].mean()
-        centroid_lon = merged_df['lon'].mean()
-        
-        # Vector de centroide a fuente
-        dlat = source_lat - centroid_lat
-        dlon = source_lon - centroid_lon
-        
-        # Convertir a ángulo meteorológico (desde donde viene el viento)
-        # El ángulo va desde el centroide (donde está la mayoría de puntos) hacia la fuente
-        bearing_towards_source = (np.degrees(np.arctan2(dlon, dlat)) + 360) % 360
-        # El viento viene desde la dirección opuesta
-        wind_dir_estimated = (bearing_towards_source + 180) % 360
-        
-        # 4. VELOCIDAD DEL VIENTO: estimar desde rango de distancias
-        from sklearn.metrics import pairwise_distances
-        coords = merged_df[['lat', 'lon']].values
-        distances = pairwise_distances(coords)
-        max_distance_km = np.max(distances) * 111  # Aproximación: 1° ≈ 111 km
-        # A mayor dispersión, mayor velocidad (heurística simple)
-        wind_speed_estimated = np.clip(1.0 + max_distance_km * 5, 1.0, 8.0)
-        
+        # Solo la combinación sigue viva el resto del análisis
+        del gps_df, gas_df
+        _check_memory_budget(memory_profile.predict_analysis_bytes(len(merged_df)), f'{len(merged_df)} puntos combinados')
+
+        # Parámetros del modelo (background, fuente, viento)
+        mem.stage('model_frame')
+        params = estimate_model_parameters(merged_df)
+        # Viento y estabilidad medidos por el anemómetro: reemplazan a los estimados
+        met_df = None
+        if anemometer_path:
+            met_df, met_info = measured_meteorology(anemometer_path, merged_df, config)
+            params.update(met_info)
+            print(f"Anemómetro ({met_info['anemometer_rate_hz']:.1f} Hz, cobertura {met_info['met_coverage']:.0%}): "
+                  f"clase dominante {met_info['stability_measured']}")
+        background_default = params['background']
+        wind_dir_estimated = params['wind_dir_from_deg']
+        wind_speed_estimated = params['wind_speed_ms']
+
         print(f"\n=== PARÁMETROS ESTIMADOS DEL MODELO ===")
         print(f"Background: {background_default:.2f}")
-        print(f"Fuente en: lat={source_lat:.6f}, lon={source_lon:.6f}")
-        print(f"Centroide en: lat={centroid_lat:.6f}, lon={centroid_lon:.6f}")
+        print(f"Fuente en: lat={params['source_lat']:.6f}, lon={params['source_lon']:.6f}")
         print(f"Dirección del viento estimada: {wind_dir_estimated:.1f}°")
         print(f"Velocidad del viento estimada: {wind_speed_estimated:.2f} m/s")
-        print(f"Dispersión espacial máxima: {max_distance_km:.3f} km")
         print("="*40)
-        
+
         with open('debug_log.txt', 'a', encoding='utf-8') as f:
             f.write(f"\n=== PARÁMETROS ESTIMADOS ===\n")
             f.write(f"Background: {background_default:.2f}\n")
-            f.write(f"Fuente: ({source_lat:.6f}, {source_lon:.6f})\n")
+            f.write(f"Fuente: ({params['source_lat']:.6f}, {params['source_lon']:.6f})\n")
             f.write(f"Viento: {wind_dir_estimated:.1f}° @ {wind_speed_estimated:.2f} m/s\n")
-        
-        # Crear DataFrame compatible con gaussian_ch4
-        df = pd.DataFrame({
-            'lat': merged_df['lat'],
-            'lon': merged_df['lon'],
-            'z_m': merged_df['elevation'],
-            'ch4_ppm': merged_df['gas_concentration'],  # Usamos esta columna independiente del gas
-            'gas_concentration': merged_df['gas_concentration'],  # Mantener también esta columna
-            'background_ppm': background_default,
-            'wind_speed_ms': wind_speed_estimated,
-            'wind_dir_from_deg': wind_dir_estimated,
-            'stability': 'D',  # Estabilidad neutral
-            'source_lat': source_lat,
-            'source_lon': source_lon,
-            'source_height_m': 2.0,
-            'Q_true_gps': 0.0
-        })
-        
-        # APLICAR FILTROS ESTADÍSTICOS SUAVIZADOS para mejorar el modelo
-        # Filtro 1: Eliminar datos sin gradiente apreciable (menos agresivo)
-        # Usar 20% sobre background en lugar de valor fijo
-        threshold = background_default * 1.001  # Solo 0.1% sobre background
-        df = df[df['ch4_ppm'] > threshold]
-        
-        # Filtro 2: Eliminar datos con viento MUY bajo (más permisivo)
-        df = df[df['wind_speed_ms'] > 0.3]
-        
+
+        # Altura del sensor sobre el suelo (DEM si está configurado, si no altura fija del inlet)
+        z_m, terrain_info = estimate_heights(merged_df, params, config)
+        params.update(terrain_info)
+        print(f"Terreno: {terrain_info['terrain']} (cobertura DEM {terrain_info['dem_coverage']:.0%})")
+
+        # Crear DataFrame compatible con gaussian_ch4 y aplicar filtros estadísticos
+        background = estimate_background(merged_df, config)
+        df = build_model_frame(merged_df, params, config.source_height_m, background, z_m, met_df)
+
         print(f"Datos después de aplicar filtros estadísticos: {len(df)} puntos")
         with open('debug_log.txt', 'a', encoding='utf-8') as f:
             f.write(f"Datos después de filtros estadísticos: {len(df)} puntos\n")
-        
+
         # Procesar los datos usando el modelo gaussiano - BÚSQUEDA OPTIMIZADA V2
+        trials = []
+        mem.stage('search')
         try:
-            # Probar múltiples combinaciones de estabilidad y sector
-            best_results = None
-            best_r2 = -999999
-            error_msg = ""
-            
-            # Clases de estabilidad a probar (ordenadas por probabilidad)
-            stability_classes = ['D', 'C', 'B', 'E', 'A']
-            # Sectores MÁS AMPLIOS para capturar más puntos
-            sector_widths = [180.0, 150.0, 120.0, 90.0]
-            
             print(f"\n=== BÚSQUEDA DE MEJOR CONFIGURACIÓN ===")
-            
-            for stability in stability_classes:
-                for sector_width in sector_widths:
-                    try:
-                        # Actualizar estabilidad en el DataFrame
-                        df['stability'] = stability
-                        
-                        from gaussian_ch4 import preprocess_and_invert
-                        temp_results = preprocess_and_invert(df, 
-                                                            stability_override=stability,
-                                                            wind_sector_half_width_deg=sector_width)
-                        
-                        if temp_results['n_points'] >= 10:  # Requerir al menos 10 puntos
-                            r2 = temp_results['R2']
-                            print(f"Estabilidad={stability}, Sector={sector_width}° → R²={r2:.3f}, n={temp_results['n_points']}, Q={temp_results['Q_hat_gph']:.1f} g/h")
-                            
-                            # Guardar si es mejor que el anterior Y tiene R² >= -0.5
-                            if r2 > best_r2 and r2 >= -0.5:
-                                best_r2 = r2
-                                best_results = temp_results
-                                
-                    except Exception as e:
-                        error_msg = str(e)
-                        continue
-            
+            best_results, trials, error_msg = search_best_configuration(df, config)
             print("="*40)
-            
+
             if best_results is not None:
                 results = best_results
-                print(f"\n*** MEJOR RESULTADO: R²={results['R2']:.3f}, Estabilidad={results['stability_used']} ***\n")
-                
+                print(f"\n*** MEJOR RESULTADO: R²={results['R2']:.3f}, Q²cv={results['Q2_kfold']:.3f}, "
+                      f"Estabilidad={results['stability_used']} ***\n")
+
                 # Calcular métricas adicionales de ajuste
                 if 'observed' in results and 'predicted' in results:
-                    observed = np.array(results['observed'])
-                    predicted = np.array(results['predicted'])
-                    
-                    # MAE (Mean Absolute Error)
-                    mae = np.mean(np.abs(observed - predicted))
-                    
-                    # MSE (Mean Squared Error)
-                    mse = np.mean((observed - predicted) ** 2)
-                    
-                    # RMSE (Root Mean Squared Error)
-                    rmse = np.sqrt(mse)
-                    
-                    # MAPE (Mean Absolute Percentage Error) - evitar división por cero
-                    mask = observed != 0
-                    if np.any(mask):
-                        mape = np.mean(np.abs((observed[mask] - predicted[mask]) / observed[mask])) * 100
-                    else:
-                        mape = 0.0
-                    
-                    results['metrics'] = {
-                        'MAE': float(mae),
-                        'MSE': float(mse),
-                        'RMSE': float(rmse),
-                        'MAPE': float(mape)
-                    }
-                    
-                    print(f"Métricas de ajuste: MAE={mae:.2f}, RMSE={rmse:.2f}, MAPE={mape:.2f}%")
-                
+                    results['metrics'] = compute_fit_metrics(results['observed'], results['predicted'])
+                    m = results['metrics']
+                    print(f"Métricas de ajuste: MAE={m['MAE']:.2f}, RMSE={m['RMSE']:.2f}, MAPE={m['MAPE']:.2f}%")
+
+                # Incertidumbre de Q por viento, altura de la fuente, fondo y estabilidad (Monte Carlo)
+                results['uncertainty'] = monte_carlo_emission(df, params, results, config)
+                mc = results['uncertainty']
+                if mc and 'Q_p50_gph' in mc:
+                    print(f"Monte Carlo ({mc['n_valid']}/{mc['n_samples']} muestras, {mc['elapsed_s']:.2f} s): "
+                          f"Q mediana={mc['Q_p50_gph']:.1f} g/h, 90% [{mc['Q_p05_gph']:.1f}, {mc['Q_p95_gph']:.1f}]")
+
                 # Agregar sugerencias si el R² es bajo
                 if results['R2'] < 0.5:
                     results['warning'] = "El R² es bajo, lo que indica que el modelo no se ajusta bien a los datos."
@@ -509,17 +515,29 @@ def upload_file():
             }
             print(f"Error en análisis: {error_trace}")
         
+        # Q por cada cruce de la pluma: mínimos cuadrados (si hubo ajuste) y balance de masa
+        mem.stage('transects')
+        transects = analyze_transects(merged_df, df, background, params,
+                                      results if 'observed' in results else None, config, z_m)
+        c = transects['combined']
+        print(f"Transectos: {len(transects['transects'])} cruces, {c['n_transects']} aceptados")
+        if 'Q_mb_median_gph' in c:
+            print(f"Balance de masa (mediana de {c['n_transects_mb']} cruces): {c['Q_mb_median_gph']:.1f} g/h")
+
         # Crear gráfico de observado vs modelado si hay datos disponibles
-        fig_obs_vs_pred = None
+        mem.stage('figures')
+        # Cada figura se serializa apenas se construye y se libera: no quedan vivas a la vez
+        # las listas de puntos, los objetos de plotly y su JSON de todas las figuras
+        obs_vs_pred_json = None
         if 'observed' in results and 'predicted' in results and len(results['observed']) > 0:
             observed_vals = results['observed']
             predicted_vals = results['predicted']
             
-            # Crear gráfico de dispersión
+            # Crear gráfico de dispersión (WebGL)
             fig_obs_vs_pred = go.Figure()
             
             # Puntos observados vs predichos
-            fig_obs_vs_pred.add_trace(go.Scatter(
+            fig_obs_vs_pred.add_trace(go.Scattergl(
                 x=observed_vals,
                 y=predicted_vals,
                 mode='markers',
@@ -538,6 +556,19 @@ def upload_file():
                 hovertemplate='<b>Observado:</b> %{x:.2f} ' + gas_units + '<br><b>Modelado:</b> %{y:.2f} ' + gas_units + '<extra></extra>'
             ))
             
+            # Puntos descartados/atenuados por el ajuste robusto (picos de tráfico, escapes)
+            if 'robust_weights' in results:
+                outliers = [i for i, w in enumerate(results['robust_weights']) if w < 0.5]
+                if outliers:
+                    fig_obs_vs_pred.add_trace(go.Scattergl(
+                        x=[observed_vals[i] for i in outliers],
+                        y=[predicted_vals[i] for i in outliers],
+                        mode='markers',
+                        name=f'Atípicos ({len(outliers)}, peso < 0.5)',
+                        marker=dict(size=11, symbol='x-open', color='red'),
+                        hovertemplate='<b>Atípico</b><br>Observado: %{x:.2f} ' + gas_units + '<extra></extra>'
+                    ))
+
             # Línea de ajuste perfecto (y=x)
             min_val = min(min(observed_vals), min(predicted_vals))
             max_val = max(max(observed_vals), max(predicted_vals))
@@ -578,6 +609,8 @@ def upload_file():
             # Agregar grid
             fig_obs_vs_pred.update_xaxes(showgrid=True, gridwidth=1, gridcolor='LightGray')
             fig_obs_vs_pred.update_yaxes(showgrid=True, gridwidth=1, gridcolor='LightGray')
+            obs_vs_pred_json = fig_obs_vs_pred.to_json()
+            del fig_obs_vs_pred, observed_vals, predicted_vals
         
         # Crear gráficas
         # 1. Mapa satelital 3D con puntos y mapa de calor
@@ -585,16 +618,38 @@ def upload_file():
         center_lat = df['lat'].mean()
         center_lon = df['lon'].mean()
         
-        # Determinar unidades del gas
-        gas_units = 'ppb' if gas_type == 'CH4' else 'ppm'
-        
         # Crear mapa con plotly usando mapbox SATELITAL
-        # IMPORTANTE: Convertir a listas para evitar codificación binaria
-        lat_list = df['lat'].tolist()
-        lon_list = df['lon'].tolist()
-        concentration_list = df['gas_concentration'].tolist()
-        elevation_list = df['z_m'].tolist()
-        
+        # Campañas grandes: el servidor agrega los puntos en celdas hexagonales por nivel de zoom
+        # (ver map_aggregation.py); el navegador recibe miles de celdas en vez de todos los puntos
+        map_zoom = 17
+        map_info = {'aggregated': False, 'n_points': len(df)}
+        if len(df) >= AGGREGATE_MIN_POINTS:
+            enhancement = df['gas_concentration'] - df['background_ppm']
+            store_points(_artifact_cache(), cache_key, df['lat'], df['lon'], df['gas_concentration'], enhancement)
+            cells = cached_cells(_artifact_cache(), cache_key, map_zoom)
+            if cells is None:
+                cells = aggregate_cells(df['lat'], df['lon'], df['gas_concentration'], enhancement, map_zoom)
+            map_info = {'aggregated': True, 'key': cache_key, 'shape': cells['shape'], 'zoom': map_zoom,
+                        'n_points': cells['n_points'], 'n_cells': cells['n_cells'], 'cell_m': cells['cell_m']}
+            print(f"Mapa agregado: {cells['n_points']} puntos -> {cells['n_cells']} celdas de {cells['cell_m']} m")
+            lat_list = cells['lat']
+            lon_list = cells['lon']
+            concentration_list = cells['mean']
+            hover_list = map_cell_hover(cells, gas_type, gas_units)
+            elevation_list = None
+            density_radius = 15
+            point_label = 'Celdas de medición'
+        else:
+            # IMPORTANTE: Convertir a listas para evitar codificación binaria
+            lat_list = df['lat'].tolist()
+            lon_list = df['lon'].tolist()
+            concentration_list = df['gas_concentration'].tolist()
+            elevation_list = df['z_m'].tolist()
+            # Hover con plantilla: sin un texto por punto (la altura va en customdata)
+            hover_list = None
+            density_radius = 30
+            point_label = 'Puntos de medición'
+
         fig_heatmap = go.Figure()
         
         # Agregar mapa de calor (densidad) primero (abajo) - más transparente para ver el satélite
@@ -602,7 +657,7 @@ def upload_file():
             lat=lat_list,
             lon=lon_list,
             z=concentration_list,
-            radius=30,
+            radius=density_radius,
             colorscale=[
                 [0, 'rgba(0,255,0,0.0)'],      # Transparente total (bajo - no contamina el mapa)
                 [0.3, 'rgba(255,255,0,0.3)'],  # Amarillo muy transparente
@@ -640,11 +695,13 @@ def upload_file():
                 ),
                 opacity=0.9
             ),
-            text=[f"<b>{gas_type}:</b> {val:.1f} {gas_units}<br><b>Elevación:</b> {elev:.1f} m<br><b>Lat:</b> {lat:.6f}<br><b>Lon:</b> {lon:.6f}" 
-                  for val, elev, lat, lon in zip(concentration_list, elevation_list, lat_list, lon_list)],
+            text=hover_list,
+            customdata=elevation_list,
             hoverinfo='text',
-            name='Puntos de medición',
-            hovertemplate='%{text}<extra></extra>'
+            name=point_label,
+            hovertemplate=('%{text}<extra></extra>' if hover_list is not None else
+                           f'<b>{gas_type}:</b> %{{marker.color:.1f}} {gas_units}<br><b>Altura sobre el suelo:</b> %{{customdata:.1f}} m'
+                           '<br><b>Lat:</b> %{lat:.6f}<br><b>Lon:</b> %{lon:.6f}<extra></extra>')
         ))
         
         # Token de Mapbox (reemplazar con tu token para vista satelital)
@@ -664,7 +721,7 @@ def upload_file():
                 style=mapbox_style,
                 accesstoken=mapbox_accesstoken,
                 center=dict(lat=center_lat, lon=center_lon),
-                zoom=17,
+                zoom=map_zoom,
                 pitch=0,
                 bearing=0
             ),
@@ -688,13 +745,24 @@ def upload_file():
             ),
             hovermode='closest'
         )
+        heatmap_json = fig_heatmap.to_json()
+        del fig_heatmap, lat_list, lon_list, concentration_list, hover_list, elevation_list
+        # Las figuras de plotly tienen referencias circulares (trazas <-> figura): sin el
+        # recolector de ciclos sus listas seguirían vivas hasta el final de la solicitud
+        gc.collect()
         
         # 2. Rosa de vientos (usando dirección de viento real o asumida)
         wind_rose = go.Figure()
         
         # Crear datos para la rosa de vientos
-        wind_directions = [wind_dir_estimated]
-        wind_frequencies = [len(df)]
+        if has_measured_meteorology(df):
+            # Viento medido: frecuencia de cada sector de 22.5°
+            sectors = np.round(df['wind_dir_from_deg'].to_numpy(dtype=float) / 22.5).astype(int) % 16
+            wind_directions = (np.arange(16) * 22.5).tolist()
+            wind_frequencies = np.bincount(sectors, minlength=16).tolist()
+        else:
+            wind_directions = [wind_dir_estimated]
+            wind_frequencies = [len(df)]
         
         wind_rose.add_trace(go.Barpolar(
             r=wind_frequencies,
@@ -732,14 +800,18 @@ def upload_file():
             height=500,
             showlegend=False
         )
+        wind_rose_json = wind_rose.to_json()
+        del wind_rose
         
         # 3. Serie temporal de concentraciones
         # IMPORTANTE: Convertir explícitamente a listas Python para evitar codificación binaria
-        timestamps_list = merged_df['timestamp'].tolist()
+        # Tiempos como texto ISO (lo mismo que escribe plotly), no un pd.Timestamp por muestra
+        timestamps_list = iso_timestamps(merged_df['timestamp'])
         concentrations_list = merged_df['gas_concentration'].tolist()
         
+        # Scattergl: WebGL en el navegador, fluido con decenas de miles de muestras
         fig_timeseries = go.Figure()
-        fig_timeseries.add_trace(go.Scatter(
+        fig_timeseries.add_trace(go.Scattergl(
             x=timestamps_list,
             y=concentrations_list,
             mode='lines+markers',
@@ -748,6 +820,28 @@ def upload_file():
             marker=dict(size=4, color='darkgreen'),
             hovertemplate=f'<b>Tiempo:</b> %{{x}}<br><b>{gas_type}:</b> %{{y:.1f}} {gas_units}<extra></extra>'
         ))
+        # Background móvil (solo cuando varía a lo largo del recorrido)
+        if config.background_mode != 'global':
+            fig_timeseries.add_trace(go.Scattergl(
+                x=timestamps_list,
+                y=background.tolist(),
+                mode='lines',
+                name='Background',
+                line=dict(color='gray', width=2, dash='dash'),
+                hovertemplate=f'<b>Background:</b> %{{y:.1f}} {gas_units}<extra></extra>'
+            ))
+        # Muestras dentro de cada cruce de la pluma
+        if len(transects['transects']) > 0:
+            in_transect = transects['transect_ids'] >= 0
+            fig_timeseries.add_trace(go.Scattergl(
+                x=[timestamps_list[i] for i in np.flatnonzero(in_transect)],
+                y=merged_df['gas_concentration'][in_transect].tolist(),
+                mode='markers',
+                name='Cruces de la pluma',
+                marker=dict(size=6, color='orange'),
+                customdata=(transects['transect_ids'][in_transect] + 1).tolist(),
+                hovertemplate='<b>Transecto %{customdata}</b><br>%{y:.1f} ' + gas_units + '<extra></extra>'
+            ))
         fig_timeseries.update_layout(
             title=f'Serie Temporal de Concentraciones {gas_type}',
             xaxis_title='Tiempo (UTC-5)',
@@ -772,31 +866,31 @@ def upload_file():
             f.write(f"Min: {merged_df['gas_concentration'].min()}, Max: {merged_df['gas_concentration'].max()}\n")
             f.write(f"Media: {merged_df['gas_concentration'].mean()}\n")
         
-        # Convertir a JSON y verificar datos
-        timeseries_json = json.loads(fig_timeseries.to_json())
+        # Convertir a JSON y verificar que los datos no quedaron en codificación binaria (bdata)
+        timeseries_json = fig_timeseries.to_json()
+        del fig_timeseries, timestamps_list
+        binary_encoded = '"bdata"' in timeseries_json
         print(f"\n=== DEBUG: Datos en JSON de timeseries ===")
-        y_data = timeseries_json['data'][0]['y']
-        print(f"Tipo de y_data: {type(y_data)}")
+        print(f"Codificación binaria en JSON: {'sí' if binary_encoded else 'no'}")
         
         with open('debug_log.txt', 'a', encoding='utf-8') as f:
             f.write(f"\n=== DEBUG: JSON timeseries ===\n")
-            f.write(f"Tipo de y_data: {type(y_data)}\n")
-            if isinstance(y_data, list):
-                f.write(f"Primeros 5 valores Y en JSON: {y_data[:5]}\n")
-                f.write(f"Últimos 5 valores Y en JSON: {y_data[-5:]}\n")
-            else:
-                f.write(f"y_data no es lista: {y_data}\n")
-        print(f"Primeros 5 valores Y en JSON: {list(y_data)[:5] if hasattr(y_data, '__iter__') else y_data}")
-        print(f"Total de puntos en JSON: {len(y_data) if hasattr(y_data, '__len__') else 'N/A'}")
+            f.write(f"Codificación binaria en JSON: {'sí' if binary_encoded else 'no'}\n")
+            f.write(f"Primeros 5 valores Y en JSON: {concentrations_list[:5]}\n")
+            f.write(f"Últimos 5 valores Y en JSON: {concentrations_list[-5:]}\n")
+        print(f"Primeros 5 valores Y en JSON: {concentrations_list[:5]}")
+        print(f"Total de puntos en JSON: {len(concentrations_list)}")
         print("="*40)
+        del concentrations_list
+        gc.collect()
         
         # Preparar respuesta
+        mem.stage('response')
         response_data = {
             'results': results,
-            'heatmap': json.loads(fig_heatmap.to_json()),
-            'wind_rose': json.loads(wind_rose.to_json()),
-            'timeseries': timeseries_json,
-            'obs_vs_pred': json.loads(fig_obs_vs_pred.to_json()) if fig_obs_vs_pred else None,
+            'transects': {'transects': transects['transects'], 'combined': transects['combined'],
+                          'loss': transects['loss']},
+            'map': map_info,
             'data_summary': {
                 'total_points': len(merged_df),
                 'gas_mean': float(merged_df['gas_concentration'].mean()),
@@ -804,22 +898,72 @@ def upload_file():
                 'gas_min': float(merged_df['gas_concentration'].min()),
                 'gas_type': gas_type,
                 'gas_units': gas_units,
-                'time_range': f"{merged_df['timestamp'].min()} - {merged_df['timestamp'].max()}"
+                'time_range': f"{merged_df['timestamp'].min()} - {merged_df['timestamp'].max()}",
+                'background_mode': config.background_mode,
+                'robust_loss': config.robust_loss,
+                'terrain': terrain_info['terrain'],
+                'dem_coverage': terrain_info['dem_coverage'],
+                'terrain_warning': terrain_info.get('terrain_warning'),
+                'analyzer_lag_s': merge_info['analyzer_lag_s'],
+                'lag_correlation': merge_info['lag_correlation'],
+                'wind_source': params.get('met_source', 'estimated'),
+                'wind_speed_ms': params['wind_speed_ms'],
+                'wind_dir_from_deg': params['wind_dir_from_deg']
             },
             'success': True
         }
-        
+
+        if met_df is not None:
+            response_data['meteorology'] = {k: params[k] for k in (
+                'stability_measured', 'met_coverage', 'anemometer_rate_hz', 'anemometer_block_s',
+                'anemometer_window_s', 'met_windows')}
+
+        # Tablas columnares (combinación, configuraciones y residuos) para /export en Parquet o Arrow
+        if columnar_export.available():
+            tables = columnar_export.analysis_tables(
+                merged_df, trials, results, gas_type, gas_units,
+                {**merge_info, 'data_filename': data_filename, 'gpx_filename': gpx_filename})
+            columnar_export.store_tables(_artifact_cache(), cache_key, tables)
+            del tables
+            response_data['exports'] = {'key': cache_key, 'tables': list(columnar_export.TABLES),
+                                        'formats': list(columnar_export.FORMATS)}
+
+        # Guardar en el historial solo si hubo ajuste del modelo
+        if 'observed' in results:
+            try:
+                response_data['run_id'] = _results_store().save_run(
+                    inputs_hash, gas_type, results,
+                    params={**params, **merge_info, 'transects': transects['transects']},
+                    data_filename=data_filename, gpx_filename=gpx_filename,
+                    gas_units=gas_units,
+                    time_start=merged_df['timestamp'].min(), time_end=merged_df['timestamp'].max())
+            except Exception as store_error:
+                print(f"Error al guardar en el historial: {store_error}")
+
         # Limpiar archivos temporales
-        try:
-            if os.path.exists(data_path):
-                os.remove(data_path)
-            if os.path.exists(gpx_path):
-                os.remove(gpx_path)
-        except Exception as cleanup_error:
-            print(f"Error al limpiar archivos temporales: {cleanup_error}")
-        
-        return jsonify(response_data)
-        
+        _cleanup_uploads(data_path, gpx_path, anemometer_path)
+
+        # Figuras ya serializadas: se insertan en la respuesta sin volver a convertirlas
+        figures = {'heatmap': heatmap_json, 'wind_rose': wind_rose_json,
+                   'timeseries': timeseries_json, 'obs_vs_pred': obs_vs_pred_json}
+        mem.stage('serialize')
+        payload = _json_payload(response_data, figures)
+        del response_data, figures, heatmap_json, wind_rose_json, timeseries_json, obs_vs_pred_json
+        if 'observed' in results:
+            _result_cache().set(cache_key, payload)
+
+        # Memoria por etapa (MEMORY_PROFILE): solo en esta respuesta, no en la cacheada
+        memory = mem.finish()
+        if memory is not None:
+            print(f"Memoria: pico {memory['peak_mb']:.1f} MB (" +
+                  ', '.join(f"{s['stage']} {s['peak_mb']:.1f}" for s in memory['stages']) + ")")
+            payload = payload[:-1] + b',"memory":' + current_app.json.dumps(memory).encode('utf-8') + b'}'
+        return current_app.response_class(payload, mimetype='application/json')
+
+    except PipelineError as e:
+        _cleanup_uploads(data_path, gpx_path, anemometer_path)
+        return jsonify(e.to_dict())
+
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
@@ -827,18 +971,165 @@ def upload_file():
         print(error_trace)
         
         # Intentar limpiar archivos en caso de error
-        try:
-            if 'data_path' in locals() and os.path.exists(data_path):
-                os.remove(data_path)
-            if 'gpx_path' in locals() and os.path.exists(gpx_path):
-                os.remove(gpx_path)
-        except:
-            pass
-            
+        _cleanup_uploads(data_path, gpx_path, anemometer_path)
+
         return jsonify({'error': str(e), 'trace': error_trace})
 
+    finally:
+        # Detener tracemalloc también en errores y respuestas cacheadas
+        mem.finish()
+
+@bp.route('/uploads', methods=['POST'])
+def create_chunked_upload():
+    """Iniciar una carga por fragmentos: {"filename", "size", "kind": "data"|"gpx"}"""
+    from chunked_upload import UploadError
+
+    body = request.get_json(silent=True) or {}
+    try:
+        size = int(body.get('size', -1))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'size debe ser un entero'}), 400
+    try:
+        status = _chunked_uploads().create(str(body.get('filename', '')), size, body.get('kind', ''))
+    except UploadError as e:
+        return jsonify(e.to_dict()), e.status
+    return jsonify(status), 201
+
+@bp.route('/uploads/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    """Estado de una carga: el cliente reanuda desde 'offset'."""
+    from chunked_upload import UploadError
+
+    try:
+        return jsonify(_chunked_uploads().status(upload_id))
+    except UploadError as e:
+        return jsonify(e.to_dict()), e.status
+
+@bp.route('/uploads/<upload_id>', methods=['PUT'])
+def chunked_upload_append(upload_id):
+    """Agregar un fragmento: /uploads/<id>?offset=N con cabecera X-Chunk-CRC32."""
+    from chunked_upload import UploadError
+
+    try:
+        offset = int(request.args.get('offset', ''))
+    except ValueError:
+        return jsonify({'error': 'offset debe ser un entero'}), 400
+    try:
+        status = _chunked_uploads().append(upload_id, offset, request.get_data(cache=False),
+                                           request.headers.get('X-Chunk-CRC32'))
+    except UploadError as e:
+        return jsonify(e.to_dict()), e.status
+    return jsonify(status)
+
+@bp.route('/runs', methods=['GET'])
+def list_runs():
+    """Listar análisis guardados. Filtros: gas, lat+lon+radius_m, from, to, min_r2, limit."""
+    import math
+    from datetime import datetime
+
+    args = request.args
+    if (args.get('lat') is None) != (args.get('lon') is None):
+        return jsonify({'error': 'lat y lon deben indicarse juntos'}), 400
+    try:
+        near = (float(args['lat']), float(args['lon'])) if args.get('lat') is not None else None
+        radius_m = float(args.get('radius_m', 500.0))
+        min_r2 = float(args['min_r2']) if args.get('min_r2') is not None else None
+        limit = int(args.get('limit', 100))
+    except ValueError:
+        return jsonify({'error': 'lat, lon, radius_m y min_r2 deben ser números y limit un entero'}), 400
+    if not all(math.isfinite(v) for v in (*(near or ()), radius_m)) or limit < 1:
+        return jsonify({'error': 'lat, lon y radius_m deben ser finitos y limit mayor que 0'}), 400
+    for key in ('from', 'to'):
+        try:
+            if args.get(key):
+                datetime.fromisoformat(args[key].replace('Z', '+00:00'))
+        except ValueError:
+            return jsonify({'error': f'{key} debe ser una fecha ISO 8601 (p. ej. 2025-03-01T15:00:00Z)'}), 400
+    runs = _results_store().list_runs(
+        gas_type=args.get('gas'),
+        near=near,
+        radius_m=radius_m,
+        time_from=args.get('from'),
+        time_to=args.get('to'),
+        min_r2=min_r2,
+        limit=limit)
+    return jsonify({'runs': runs, 'count': len(runs)})
+
+@bp.route('/runs/<int:run_id>', methods=['GET'])
+def get_run(run_id):
+    """Detalle de un análisis guardado (arrays observado/modelado con ?arrays=1)."""
+    run = _results_store().get_run(run_id, include_arrays=request.args.get('arrays') == '1')
+    if run is None:
+        return jsonify({'error': f'No existe el análisis {run_id}'}), 404
+    return jsonify(run)
+
+@bp.route('/runs/<int:run_id>/transects', methods=['GET'])
+def run_transects(run_id):
+    """Recombinar los cruces de un análisis guardado excluyendo algunos: ?exclude=0,3"""
+    from pipeline import combine_transects
+
+    run = _results_store().get_run(run_id)
+    if run is None:
+        return jsonify({'error': f'No existe el análisis {run_id}'}), 404
+    try:
+        exclude = [int(i) for i in request.args.get('exclude', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({'error': 'exclude debe ser una lista de enteros separada por comas'}), 400
+    transects = run['params'].get('transects', [])
+    return jsonify({'run_id': run_id, 'transects': transects,
+                    'combined': combine_transects(transects, exclude)})
+
+@bp.route('/map/cells', methods=['GET'])
+def map_cells():
+    """Celdas agregadas del mapa para otro nivel de zoom: /map/cells?key=...&zoom=15&gas=CH4"""
+    from map_aggregation import SHAPES, cached_cells
+    from pipeline import GAS_UNITS
+
+    key = request.args.get('key', '')
+    shape = request.args.get('shape', 'hex')
+    gas_type = request.args.get('gas', 'CH4')
+    if not key or shape not in SHAPES or gas_type not in GAS_UNITS:
+        return jsonify({'error': 'Parámetros no válidos: se requieren key, zoom, shape (hex/square) y gas'}), 400
+    try:
+        zoom = float(request.args.get('zoom', 17))
+    except ValueError:
+        return jsonify({'error': 'zoom debe ser un número'}), 400
+    cells = cached_cells(_artifact_cache(), key, round(zoom), shape)
+    if cells is None:
+        return jsonify({'error': 'Los puntos de este mapa ya no están en caché; vuelve a procesar los archivos'}), 404
+    cells['text'] = map_cell_hover(cells, gas_type, GAS_UNITS[gas_type])
+    return jsonify(cells)
+
+@bp.route('/export/<key>/<table>.<fmt>', methods=['GET'])
+def export_table(key, table, fmt):
+    """Descargar una tabla del análisis: /export/<key>/merged.parquet (merged, trials, residuals; parquet o arrow)"""
+    import columnar_export
+
+    if table not in columnar_export.TABLES or fmt not in columnar_export.FORMATS:
+        return jsonify({'error': 'Tabla o formato no válido: use merged, trials o residuals en .parquet o .arrow'}), 400
+    if not columnar_export.available():
+        return jsonify({'error': 'La exportación Parquet/Arrow requiere pyarrow en el servidor'}), 501
+    data = columnar_export.load_table(_artifact_cache(), key, table)
+    if data is None:
+        return jsonify({'error': 'Esta tabla ya no está en caché; vuelve a procesar los archivos'}), 404
+    mimetype, ext = columnar_export.FORMATS[fmt]
+    response = current_app.response_class(columnar_export.stream_table(data, fmt), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{table}_{key[:12]}{ext}"'
+    return response
+
+@bp.route('/runs/compare', methods=['GET'])
+def compare_runs():
+    """Comparar varios análisis: /runs/compare?ids=1,2,3"""
+    try:
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({'error': 'ids debe ser una lista de enteros separada por comas'}), 400
+    if not ids:
+        return jsonify({'error': 'Se requiere el parámetro ids'}), 400
+    return jsonify(_results_store().compare_runs(ids))
+
 if __name__ == '__main__':
     # Para producción (Render.com) se usa el puerto de la variable de entorno
     port = int(os.environ.get('PORT', 5000))
     # Usar host 0.0.0.0 para aceptar conexiones externas
-    app.run(host='0.0.0.0', port=port, debug=False)
+    create_app().run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,232 @@
+"""
+columnar_export.py — Parquet / Arrow IPC export of an analysis, and re-import of a merge.
+
+Three tables per analysis:
+    merged     the merged GPS + analyzer frame (timestamp, lat, lon, elevation,
+               gas_concentration, gas_type, gas_units); the schema metadata holds the
+               gas and the merge info (analyzer lag), so the file can be re-analyzed
+    trials     one row per (stability, sector) configuration of the search
+    residuals  observed / predicted anomaly, residual and robust weight of the best fit
+
+Tables are built column-wise from the numpy arrays (pa.Table.from_pandas / pa.array),
+kept in the artifact cache (result_cache.py) as Arrow IPC streams, and written to the
+HTTP response one record batch at a time (stream_table), so no per-row Python objects
+are created.
+read_merged() loads a saved `merged` table back (Parquet or Arrow) for
+pipeline.load_saved_merge().
+
+pyarrow is optional: without it available() is False and the app skips the exports.
+
+Usage:
+    tables = analysis_tables(merged_df, trials, results, gas_type, gas_units, merge_info)
+    store_tables(cache, cache_key, tables)
+    table = load_table(cache, cache_key, 'merged')
+    for chunk in stream_table(table, 'parquet'): ...
+    merged_df, meta = read_merged('campaign_merged.parquet')
+"""
+
+import json
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+TABLES = ('merged', 'trials', 'residuals')
+# formato -> (mimetype, extensión)
+FORMATS = {
+    'parquet': ('application/vnd.apache.parquet', '.parquet'),
+    'arrow': ('application/vnd.apache.arrow.file', '.arrow'),
+}
+BATCH_ROWS = 64 * 1024
+MERGED_COLUMNS = ('timestamp', 'lat', 'lon', 'elevation', 'gas_concentration')
+METADATA_KEY = b'gea'
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def available() -> bool:
+    return _pyarrow() is not None
+
+
+def _with_metadata(table, meta: Dict[str, Any]):
+    return table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                          METADATA_KEY: json.dumps(meta, default=str).encode('utf-8')})
+
+
+def table_metadata(table) -> Dict[str, Any]:
+    raw = (table.schema.metadata or {}).get(METADATA_KEY)
+    return json.loads(raw) if raw else {}
+
+
+# -----------------------------
+# Tables
+# -----------------------------
+
+def merged_table(merged_df: pd.DataFrame, gas_type: str, gas_units: str,
+                 merge_info: Optional[Dict[str, Any]] = None):
+    pa = _pyarrow()
+    table = pa.Table.from_pandas(merged_df.reset_index(drop=True), preserve_index=False)
+    return _with_metadata(table, {'table': 'merged', 'gas_type': gas_type, 'gas_units': gas_units,
+                                  'merge_info': merge_info or {}})
+
+
+def trials_table(trials: List[Dict[str, Any]]):
+    pa = _pyarrow()
+    columns = ('stability', 'sector_half_width_deg', 'n_points', 'R2', 'Q2_loo', 'Q2_kfold',
+               'Q_hat_gph', 'Q_std_gph')
+    types = (pa.string(), pa.float64(), pa.int64(), pa.float64(), pa.float64(), pa.float64(),
+             pa.float64(), pa.float64())
+    table = pa.table({col: pa.array([t[col] for t in trials], type=typ) for col, typ in zip(columns, types)})
+    return _with_metadata(table, {'table': 'trials'})
+
+
+def residuals_table(results: Optional[Dict[str, Any]]):
+    """Residuals of the best fit; an empty table when there was no fit."""
+    pa = _pyarrow()
+    results = results if results and 'observed' in results else {}
+    observed = np.asarray(results.get('observed', []), dtype=np.float64)
+    predicted = np.asarray(results.get('predicted', []), dtype=np.float64)
+    weights = results.get('robust_weights')
+    weights = np.asarray(weights, dtype=np.float64) if weights is not None else np.ones_like(observed)
+    table = pa.table({
+        'observed': observed,
+        'predicted': predicted,
+        'residual': observed - predicted,
+        'robust_weight': weights,
+    })
+    fit = {k: results[k] for k in ('Q_hat_gph', 'Q_std_gph', 'R2', 'Q2_loo', 'Q2_kfold', 'stability_used',
+                                   'sector_half_width_deg', 'loss', 'selection_criterion') if k in results}
+    return _with_metadata(table, {'table': 'residuals', 'fit': fit})
+
+
+def analysis_tables(merged_df: pd.DataFrame, trials, results, gas_type: str, gas_units: str,
+                    merge_info: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    return {
+        'merged': merged_table(merged_df, gas_type, gas_units, merge_info),
+        'trials': trials_table(trials),
+        'residuals': residuals_table(results),
+    }
+
+
+# -----------------------------
+# Cache (Arrow IPC stream bytes in ResultCache)
+# -----------------------------
+
+def _table_key(dataset_key: str, name: str) -> str:
+    return f"export:{dataset_key}:{name}"
+
+
+def store_tables(cache, dataset_key: str, tables: Dict[str, Any]) -> None:
+    pa = _pyarrow()
+    for name, table in tables.items():
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=BATCH_ROWS)
+        cache.set(_table_key(dataset_key, name), sink.getvalue().to_pybytes())
+
+
+def load_table(cache, dataset_key: str, name: str):
+    """The stored table, or None when it expired (or was never stored)."""
+    pa = _pyarrow()
+    raw = cache.get(_table_key(dataset_key, name))
+    if raw is None:
+        return None
+    return pa.ipc.open_stream(pa.py_buffer(raw)).read_all()
+
+
+# -----------------------------
+# Streaming writers
+# -----------------------------
+
+class _ChunkSink:
+    """Write-only file object that hands the written bytes back in pieces."""
+
+    closed = False
+
+    def __init__(self):
+        self._parts = []
+        self._pos = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._parts.append(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def stream_table(table, fmt: str, batch_rows: int = BATCH_ROWS) -> Iterator[bytes]:
+    """Serialize `table` as Parquet (one row group per batch) or an Arrow IPC file, yielding bytes as written."""
+    pa = _pyarrow()
+    sink = _ChunkSink()
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(sink, table.schema, compression='zstd')
+    elif fmt == 'arrow':
+        writer = pa.ipc.new_file(sink, table.schema)
+    else:
+        raise ValueError(f"Formato de exportación no válido: {fmt}")
+    with writer:
+        for start in range(0, table.num_rows, batch_rows):
+            writer.write_table(table.slice(start, batch_rows))
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    chunk = sink.drain()
+    if chunk:
+        yield chunk
+
+
+# -----------------------------
+# Import
+# -----------------------------
+
+def read_merged(path: str) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    """
+    A `merged` table saved by this module (Parquet, Arrow IPC file or stream) ->
+    (merged_df, metadata). Raises ValueError when the file is not a usable merge.
+    """
+    pa = _pyarrow()
+    if pa is None:
+        raise ValueError("Para cargar combinaciones guardadas instale pyarrow (pip install pyarrow)")
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+    try:
+        if magic[:4] == b'PAR1':
+            import pyarrow.parquet as pq
+            table = pq.read_table(path)
+        elif magic == b'ARROW1':
+            with pa.memory_map(path) as source:
+                table = pa.ipc.open_file(source).read_all()
+        else:
+            with pa.memory_map(path) as source:
+                table = pa.ipc.open_stream(source).read_all()
+    except pa.ArrowInvalid as e:
+        raise ValueError(f"El archivo no es Parquet ni Arrow: {e}")
+
+    meta = table_metadata(table)
+    missing = [col for col in MERGED_COLUMNS if col not in table.column_names]
+    if missing:
+        raise ValueError(f"Faltan columnas en la combinación guardada: {', '.join(missing)}")
+    if meta.get('table', 'merged') != 'merged':
+        raise ValueError(f"El archivo contiene la tabla '{meta['table']}', no una combinación (merged)")
+    return table.to_pandas(), meta
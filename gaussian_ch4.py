@@ -7,7 +7,8 @@ Usage examples:
     # From another script or notebook
     from gaussian_ch4 import (
         gaussian_concentration, invert_emission_rate, pasquill_sigma,
-        latlon_to_local_xy, rotate_to_wind_frame, simulate_dataset
+        latlon_to_local_xy, local_projection, rotate_to_wind_frame, simulate_dataset,
+        StreamingEmissionEstimator, crosswind_integrated_emission, robust_weights
     )
 
     # CLI (quick test using synthetic data)
@@ -20,7 +21,8 @@ a pragmatic set of defaults; tune to site-specific conditions when field data ar
 import numpy as np
 import pandas as pd
 from dataclasses import dataclass
-from typing import Tuple, Literal, Optional, Dict
+from functools import lru_cache
+from typing import Any, Tuple, Literal, Optional, Dict
 
 # -----------------------------
 # Coordinate utilities
@@ -28,22 +30,91 @@ from typing import Tuple, Literal, Optional, Dict
 
 EARTH_R = 6371000.0  # meters
 
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1.0 / 298.257223563
+
+
+class LocalProjection:
+    """
+    Transverse Mercator (Krüger series to n^4, WGS84, scale 1 on the central meridian)
+    centred on a site: x east, y north in meters with (lat0, lon0) at the origin.
+    Conformal (wind-frame angles are preserved); the series itself is exact to < 1 mm
+    and the scale error is only x^2 / 2R^2 (1.2 ppm at 10 km, 11 ppm at 30 km east or
+    west of the site). All constants are computed once per site; forward/inverse are
+    pure array math. Use local_projection() to get the cached instance for a site.
+    """
+
+    def __init__(self, lat0: float, lon0: float):
+        self.lat0 = float(lat0)
+        self.lon0 = float(lon0)
+        n = WGS84_F / (2.0 - WGS84_F)
+        self.e = 2.0 * np.sqrt(n) / (1.0 + n)
+        self.A = WGS84_A / (1.0 + n) * (1.0 + n ** 2 / 4.0 + n ** 4 / 64.0)
+        self.alpha = np.array([
+            n / 2 - 2 * n ** 2 / 3 + 5 * n ** 3 / 16 + 41 * n ** 4 / 180,
+            13 * n ** 2 / 48 - 3 * n ** 3 / 5 + 557 * n ** 4 / 1440,
+            61 * n ** 3 / 240 - 103 * n ** 4 / 140,
+            49561 * n ** 4 / 161280,
+        ])
+        self.beta = np.array([
+            n / 2 - 2 * n ** 2 / 3 + 37 * n ** 3 / 96 - n ** 4 / 360,
+            n ** 2 / 48 + n ** 3 / 15 - 437 * n ** 4 / 1440,
+            17 * n ** 3 / 480 - 37 * n ** 4 / 840,
+            4397 * n ** 4 / 161280,
+        ])
+        self.delta = np.array([
+            2 * n - 2 * n ** 2 / 3 - 2 * n ** 3 + 116 * n ** 4 / 45,
+            7 * n ** 2 / 3 - 8 * n ** 3 / 5 - 227 * n ** 4 / 45,
+            56 * n ** 3 / 15 - 136 * n ** 4 / 35,
+            4279 * n ** 4 / 630,
+        ])
+        self._j2 = 2.0 * np.arange(1, 5)
+        self.y0 = 0.0
+        _, self.y0 = self.forward(np.array([self.lat0]), np.array([self.lon0]))
+        self.y0 = float(self.y0[0])
+
+    def forward(self, lat, lon) -> Tuple[np.ndarray, np.ndarray]:
+        """(lat, lon) degrees -> local (x east, y north) meters."""
+        phi = np.radians(np.asarray(lat, dtype=float))
+        dlmb = np.radians(np.asarray(lon, dtype=float) - self.lon0)
+        sin_phi = np.sin(phi)
+        t = np.sinh(np.arctanh(sin_phi) - self.e * np.arctanh(self.e * sin_phi))
+        xi = np.arctan2(t, np.cos(dlmb))
+        eta = np.arctanh(np.sin(dlmb) / np.sqrt(1.0 + t * t))
+        j2xi = self._j2 * xi[..., None]
+        j2eta = self._j2 * eta[..., None]
+        x = self.A * (eta + np.sum(self.alpha * np.cos(j2xi) * np.sinh(j2eta), axis=-1))
+        y = self.A * (xi + np.sum(self.alpha * np.sin(j2xi) * np.cosh(j2eta), axis=-1)) - self.y0
+        return x, y
+
+    def inverse(self, x, y) -> Tuple[np.ndarray, np.ndarray]:
+        """Local (x east, y north) meters -> (lat, lon) degrees."""
+        xi = (np.asarray(y, dtype=float) + self.y0) / self.A
+        eta = np.asarray(x, dtype=float) / self.A
+        j2xi = self._j2 * xi[..., None]
+        j2eta = self._j2 * eta[..., None]
+        xi_p = xi - np.sum(self.beta * np.sin(j2xi) * np.cosh(j2eta), axis=-1)
+        eta_p = eta - np.sum(self.beta * np.cos(j2xi) * np.sinh(j2eta), axis=-1)
+        chi = np.arcsin(np.sin(xi_p) / np.cosh(eta_p))
+        phi = chi + np.sum(self.delta * np.sin(self._j2 * chi[..., None]), axis=-1)
+        lmb = np.arctan2(np.sinh(eta_p), np.cos(xi_p))
+        return np.degrees(phi), self.lon0 + np.degrees(lmb)
+
+
+@lru_cache(maxsize=256)
+def local_projection(lat0: float, lon0: float) -> LocalProjection:
+    """Cached per-site projection (repeated sites only pay for the array math)."""
+    return LocalProjection(lat0, lon0)
+
+
 def latlon_to_local_xy(lat: np.ndarray, lon: np.ndarray,
                        lat0: float, lon0: float) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Convert lat/lon to local tangent-plane x (east), y (north) in meters
-    using an equirectangular approximation suitable for small domains (< few km).
+    Convert lat/lon to local x (east), y (north) in meters around (lat0, lon0)
+    with the site's transverse Mercator projection (see LocalProjection).
     """
-    lat_rad = np.radians(lat)
-    lon_rad = np.radians(lon)
-    lat0_rad = np.radians(lat0)
-    lon0_rad = np.radians(lon0)
-
-    dlon = lon_rad - lon0_rad
-    dlat = lat_rad - lat0_rad
-    x = EARTH_R * dlon * np.cos((lat_rad + lat0_rad) / 2.0)
-    y = EARTH_R * dlat
-    return x, y
+    return local_projection(float(lat0), float(lon0)).forward(lat, lon)
 
 def rotate_to_wind_frame(x_local: np.ndarray, y_local: np.ndarray,
                          wind_dir_from_deg: float) -> Tuple[np.ndarray, np.ndarray]:
@@ -127,54 +198,312 @@ def gaussian_concentration(Q_gps: float,
 # Inversion for Q (linear least squares with weights)
 # -----------------------------
 
+ROBUST_TUNING = {"huber": 1.345, "tukey": 4.685}  # 95% efficiency under Gaussian noise
+# Below this sum of G^2 (s^2/m^6) the points only see the far tails of the plume (G < ~1e-10
+# s/m^3 each, several sigma off axis at any distance): Q is not identifiable from them.
+SUM_GG_TOL = 1e-20
+# A k-fold training set keeping less than this share of the total sum w G^2 cannot identify
+# Q (its held-out block carries nearly all of the plume signal): the fold is degenerate.
+CV_MIN_TRAIN_GG_FRACTION = 0.05
+
+
+def plume_kernel(x: np.ndarray, y: np.ndarray, z: np.ndarray,
+                 u_ms: np.ndarray, H_m: float,
+                 sigma_y: np.ndarray, sigma_z: np.ndarray) -> np.ndarray:
+    """
+    Unit-emission plume response G such that C = G * Q (same clipping as
+    gaussian_concentration). Upwind points (x <= 0) return 0. The only kernel used by
+    the inversions (invert_emission_rate, StreamingEmissionEstimator, transects).
+    """
+    return gaussian_concentration(1.0, x, y, z, u_ms, H_m, sigma_y, sigma_z)
+
+
+def robust_weights(resid: np.ndarray, loss: str = "huber", c: Optional[float] = None,
+                   scale: Optional[float] = None) -> np.ndarray:
+    """
+    IRLS weights for Huber or Tukey bisquare. The residual scale defaults to the
+    normalized MAD (median |r| / 0.6745), so a few traffic spikes do not inflate it.
+    """
+    c = ROBUST_TUNING[loss] if c is None else c
+    if scale is None:
+        scale = float(np.median(np.abs(resid))) / 0.6745
+    if scale <= 0:
+        return np.ones_like(resid)
+    a = np.abs(resid) / (c * scale)
+    if loss == "huber":
+        return np.where(a <= 1.0, 1.0, 1.0 / np.maximum(a, 1e-12))
+    if loss == "tukey":
+        return np.where(a < 1.0, (1.0 - a ** 2) ** 2, 0.0)
+    raise ValueError(f"Unknown robust loss '{loss}' (use 'huber' or 'tukey').")
+
+
+def cross_validation_scores(G: np.ndarray, y: np.ndarray, w: Optional[np.ndarray] = None,
+                            folds: int = 5) -> Dict[str, float]:
+    """
+    Closed-form cross-validation of the 1-parameter fit y = G Q (weights w), without refitting.
+
+    Leave-one-out: Q_(-i) = (S_gy - w_i G_i y_i) / (S_gg - w_i G_i^2), i.e. the residual
+    e_i / (1 - h_i) with hat diagonal h_i = w_i G_i^2 / S_gg. k-fold: contiguous blocks in
+    sample (time) order, so correlated neighbouring samples do not leak between training and
+    test folds; the fold sums come from one bincount per statistic. A deleted set whose
+    remaining S_gg is 0 predicts Q = 0, as in the full fit.
+    Q2 = 1 - PRESS / SS_tot (predictive R^2) and rmse = sqrt(PRESS / sum w), weighted with w.
+    k-fold folds whose training S_gg is below CV_MIN_TRAIN_GG_FRACTION of the total are
+    counted in cv_degenerate_folds and left out of the k-fold scores (a nearly empty
+    training set extrapolates Q by orders of magnitude and drives Q2 to -1e9).
+    """
+    y = np.asarray(y, dtype=float)
+    n = y.size
+    w = np.ones(n) if w is None else np.asarray(w, dtype=float)
+    k = int(min(max(folds, 2), n)) if n >= 2 else 0
+    if k < 2:
+        return {"Q2_loo": 0.0, "rmse_loo": 0.0, "Q2_kfold": 0.0, "rmse_kfold": 0.0, "cv_folds": k,
+                "cv_degenerate_folds": 0, "Q_fold_std_gps": 0.0}
+
+    wg = w * G
+    gg, gy = wg * G, wg * y
+    sgg, sgy = float(np.sum(gg)), float(np.sum(gy))
+    sw = float(np.sum(w))
+    y_mean = float(np.sum(w * y)) / sw if sw > 0 else 0.0
+    ss_tot = float(np.sum(w * (y - y_mean) ** 2))
+
+    def scores(q_deleted, keep=slice(None)):
+        press = float(np.sum((w * (y - G * q_deleted) ** 2)[keep]))
+        tot = ss_tot if isinstance(keep, slice) else float(np.sum((w * (y - y_mean) ** 2)[keep]))
+        sw_keep = sw if isinstance(keep, slice) else float(np.sum(w[keep]))
+        q2 = 1.0 - press / tot if tot > 0 else 0.0
+        return q2, float(np.sqrt(press / sw_keep)) if sw_keep > 0 else 0.0
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        den = sgg - gg
+        q_loo = np.where(den > 1e-12 * sgg, (sgy - gy) / den, 0.0)
+        fold = (np.arange(n) * k) // n
+        den_k = sgg - np.bincount(fold, weights=gg, minlength=k)
+        ok_k = (den_k > CV_MIN_TRAIN_GG_FRACTION * sgg) & (den_k > 0)
+        q_k = np.where(ok_k, (sgy - np.bincount(fold, weights=gy, minlength=k)) / den_k, 0.0)
+    q2_loo, rmse_loo = scores(q_loo)
+    q2_k, rmse_k = scores(q_k[fold], ok_k[fold])
+    return {"Q2_loo": q2_loo, "rmse_loo": rmse_loo, "Q2_kfold": q2_k, "rmse_kfold": rmse_k,
+            "cv_folds": k, "cv_degenerate_folds": int(k - ok_k.sum()),
+            "Q_fold_std_gps": float(np.std(q_k[ok_k], ddof=1)) if ok_k.sum() > 1 else 0.0}
+
+
 def invert_emission_rate(
         x: np.ndarray, y: np.ndarray, z: np.ndarray,
         u_ms: np.ndarray, H_m: float,
         dC: np.ndarray,
         sigma_y: np.ndarray, sigma_z: np.ndarray,
-        weights: Optional[np.ndarray] = None
-    ) -> Tuple[float, float, float]:
+        weights: Optional[np.ndarray] = None,
+        loss: Literal["l2", "huber", "tukey"] = "l2",
+        max_iter: int = 30, tol: float = 1e-8,
+        return_weights: bool = False,
+        return_cv: bool = False, cv_folds: int = 5
+    ):
     """
     Solve for Q in C = G * Q  (linear in Q), using weighted least squares.
-    Returns (Q_hat, Q_std, r2).
+    With loss="huber" or "tukey" the fit is robust (IRLS): each iteration reweights
+    the residuals (robust_weights) and re-solves from the weighted sufficient
+    statistics sum w G y / sum w G^2, so every pass is O(N). Tukey starts from the
+    Huber solution. R^2 is then weighted with the final robust weights, so spikes
+    neither drive Q nor the R^2 used to rank configurations.
+    Returns (Q_hat, Q_std, r2), plus the final weights if return_weights and the
+    cross_validation_scores dict (final weights held fixed) if return_cv. When sum w G^2
+    <= SUM_GG_TOL (no plume signal) Q_hat is 0 and Q_std is inf.
     """
-    u = np.maximum(u_ms, 0.1)
-    sigy = np.maximum(sigma_y, 0.01)
-    sigz = np.maximum(sigma_z, 0.01)
-
-    G = (1.0 / (2.0 * np.pi * u * sigy * sigz)) * \
-        np.exp(- (y ** 2) / (2.0 * sigy ** 2)) * \
-        (np.exp(- ((z - H_m) ** 2) / (2.0 * sigz ** 2)) + np.exp(- ((z + H_m) ** 2) / (2.0 * sigz ** 2)))
+    G = plume_kernel(x, y, z, u_ms, H_m, sigma_y, sigma_z)
 
     mask = (x > 0) & np.isfinite(G) & np.isfinite(dC)
     G = G[mask]
     yv = dC[mask]
-    if weights is not None:
-        w = weights[mask]
-        W = np.diag(w)
-        GTW = G.T @ W
-        Q_hat = float(np.linalg.pinv(GTW @ G) @ (GTW @ yv))
-        y_pred = G * Q_hat
-        resid = yv - y_pred
-        dof = max(len(yv) - 1, 1)
-        s2 = float((resid.T @ (W @ resid)) / dof)
-        covQ = s2 * np.linalg.pinv(GTW @ G)
-        Q_std = float(np.sqrt(covQ))
-    else:
-        G2 = G[:, None]  # Nx1
-        Q_hat = float(np.linalg.pinv(G2).dot(yv))
-        y_pred = G * Q_hat
-        resid = yv - y_pred
-        dof = max(len(yv) - 1, 1)
-        s2 = float((resid @ resid) / dof)
-        # Var(Q) = s2 * (G^T G)^-1 for 1-parameter LSQ
-        Q_std = float(np.sqrt(s2 / np.maximum(np.sum(G * G), 1e-12)))
-
-    # R^2
-    ss_res = float(np.sum((yv - y_pred) ** 2))
-    ss_tot = float(np.sum((yv - np.mean(yv)) ** 2)) if len(yv) > 1 else 0.0
+    w0 = np.ones_like(yv) if weights is None else np.asarray(weights, dtype=float)[mask]
+
+    def solve(w):
+        sgg = float(np.sum(w * G * G))
+        return float(np.sum(w * G * yv)) / sgg if sgg > SUM_GG_TOL else 0.0, sgg
+
+    Q_hat, sgg = solve(w0)
+    w = w0
+    if loss != "l2":
+        for stage in (("huber", "tukey") if loss == "tukey" else ("huber",)):
+            for _ in range(max_iter):
+                w = w0 * robust_weights(yv - G * Q_hat, stage)
+                Q_new, sgg = solve(w)
+                converged = abs(Q_new - Q_hat) <= tol * max(abs(Q_hat), 1e-12)
+                Q_hat = Q_new
+                if converged:
+                    break
+
+    # Var(Q) = s2 * (G^T W G)^-1 for 1-parameter WLS
+    resid = yv - G * Q_hat
+    dof = max(len(yv) - 1, 1)
+    s2 = float(np.sum(w * resid ** 2)) / dof
+    # No plume signal: Q is undetermined, report an infinite (not a tiny) uncertainty
+    Q_std = float(np.sqrt(s2 / sgg)) if sgg > SUM_GG_TOL else float("inf")
+
+    # R^2 (weighted when robust)
+    r_w = w if loss != "l2" else np.ones_like(yv)
+    ss_res = float(np.sum(r_w * resid ** 2))
+    y_mean = float(np.sum(r_w * yv) / np.sum(r_w)) if np.sum(r_w) > 0 else 0.0
+    ss_tot = float(np.sum(r_w * (yv - y_mean) ** 2)) if len(yv) > 1 else 0.0
     r2 = 1.0 - ss_res / ss_tot if ss_tot > 0 else 0.0
-    return Q_hat, Q_std, r2
+    out = (Q_hat, Q_std, r2)
+    if return_weights:
+        full_w = np.zeros(mask.shape)
+        full_w[mask] = w
+        out += (full_w,)
+    if return_cv:
+        out += (cross_validation_scores(G, yv, w, cv_folds),)
+    return out
+
+# -----------------------------
+# Online (streaming) inversion
+# -----------------------------
+
+@dataclass
+class StreamingEmissionEstimator:
+    """
+    Constant-memory single-source estimator for Q in dC = G * Q.
+
+    Only the sufficient statistics (n, sum G^2, sum G*y, sum y, sum y^2) are kept,
+    so chunks of (x, y, z, u, dC) can be fed with update() over arbitrarily long
+    streams, and partial states from parallel workers combined with merge().
+    Results match invert_emission_rate(..., weights=None) on the concatenated data,
+    including the unidentifiable case (sum G^2 <= SUM_GG_TOL: Q_hat 0, Q_std inf).
+    With per-point weights (e.g. the final IRLS weights of a robust fit) the sums are
+    weighted and the result matches that fit's Q_hat, Q_std and weighted R²; sum_w is
+    the total weight (0 in states saved before weights were supported: treated as n).
+    """
+    H_m: float = 2.0
+    stability: str = "D"
+    n: int = 0
+    sum_gg: float = 0.0
+    sum_gy: float = 0.0
+    sum_y: float = 0.0
+    sum_yy: float = 0.0
+    sum_w: float = 0.0
+
+    def update(self, x: np.ndarray, y: np.ndarray, z: np.ndarray,
+               u_ms: np.ndarray, dC: np.ndarray,
+               sigma_y: Optional[np.ndarray] = None,
+               sigma_z: Optional[np.ndarray] = None,
+               weights: Optional[np.ndarray] = None) -> "StreamingEmissionEstimator":
+        """Accumulate one chunk (wind-frame coordinates). Sigmas default to pasquill_sigma(|x|)."""
+        x = np.asarray(x, dtype=float)
+        dC = np.asarray(dC, dtype=float)
+        if sigma_y is None or sigma_z is None:
+            sigma_y, sigma_z = pasquill_sigma(np.abs(x), self.stability)
+        G = plume_kernel(x, np.asarray(y, dtype=float), np.asarray(z, dtype=float),
+                         np.asarray(u_ms, dtype=float), self.H_m, sigma_y, sigma_z)
+        mask = (x > 0) & np.isfinite(G) & np.isfinite(dC)
+        G = G[mask]
+        yv = dC[mask]
+        w = np.ones_like(G) if weights is None else np.broadcast_to(np.asarray(weights, dtype=float), x.shape)[mask]
+        self.n += int(G.size)
+        self.sum_gg += float((w * G) @ G)
+        self.sum_gy += float((w * G) @ yv)
+        self.sum_y += float(w @ yv)
+        self.sum_yy += float((w * yv) @ yv)
+        self.sum_w += float(w.sum())
+        return self
+
+    def merge(self, other: "StreamingEmissionEstimator") -> "StreamingEmissionEstimator":
+        """Fold another partial state (same H_m and stability) into this one."""
+        if other.H_m != self.H_m or other.stability != self.stability:
+            raise ValueError("Cannot merge estimators with different source height or stability class.")
+        self.sum_w = (self.sum_w or self.n) + (other.sum_w or other.n)
+        self.n += other.n
+        self.sum_gg += other.sum_gg
+        self.sum_gy += other.sum_gy
+        self.sum_y += other.sum_y
+        self.sum_yy += other.sum_yy
+        return self
+
+    @property
+    def identifiable(self) -> bool:
+        """False when the points barely see the plume (sum G^2 <= SUM_GG_TOL)."""
+        return self.sum_gg > SUM_GG_TOL
+
+    @property
+    def Q_hat(self) -> float:
+        return self.sum_gy / self.sum_gg if self.identifiable else 0.0
+
+    @property
+    def ss_res(self) -> float:
+        # sum (y - G Q)^2 = sum y^2 - 2 Q sum Gy + Q^2 sum G^2, with Q = sum Gy / sum G^2
+        if not self.identifiable:
+            return self.sum_yy
+        return max(self.sum_yy - self.sum_gy ** 2 / self.sum_gg, 0.0)
+
+    @property
+    def Q_std(self) -> float:
+        if not self.identifiable:
+            return float("inf")
+        dof = max(self.n - 1, 1)
+        return float(np.sqrt((self.ss_res / dof) / self.sum_gg))
+
+    @property
+    def r2(self) -> float:
+        if self.n <= 1:
+            return 0.0
+        sw = self.sum_w or self.n
+        ss_tot = self.sum_yy - self.sum_y ** 2 / sw if sw > 0 else 0.0
+        return 1.0 - self.ss_res / ss_tot if ss_tot > 0 else 0.0
+
+    def result(self) -> Tuple[float, float, float]:
+        """Current (Q_hat, Q_std, r2), same tuple layout as invert_emission_rate."""
+        return self.Q_hat, self.Q_std, self.r2
+
+# -----------------------------
+# Crosswind-integrated mass balance
+# -----------------------------
+
+def crosswind_integrated_emission(x: np.ndarray, y: np.ndarray, z: np.ndarray,
+                                  u_ms: np.ndarray, H_m: float, dC: np.ndarray,
+                                  groups: np.ndarray, stability: str = "D") -> Dict[str, np.ndarray]:
+    """
+    Q per transect from the crosswind integral of the anomaly, O(N) for all groups at once.
+
+    Integrating the reflected Gaussian plume over y removes sigma_y:
+        int C dy = Q / (sqrt(2 pi) u sigma_z) * [exp(-(z-H)^2 / 2 sz^2) + exp(-(z+H)^2 / 2 sz^2)]
+    so Q = sqrt(2 pi) u sigma_z |int dC dy| / V(z). The integral is the trapezoid rule
+    over wind-frame y in sample order (final value of the cumulative trapezoid); sigma_z
+    is evaluated at the anomaly-weighted downwind distance of each transect.
+    groups: transect id per sample (-1 = ignore). Returns arrays indexed by transect id;
+    Q is NaN for transects that are not downwind of the source.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    z = np.asarray(z, dtype=float)
+    u = np.maximum(np.asarray(u_ms, dtype=float), 0.1)
+    dC = np.asarray(dC, dtype=float)
+    groups = np.asarray(groups)
+    k = int(groups.max()) + 1 if groups.size else 0
+    if k <= 0:
+        empty = np.zeros(0)
+        return {"Q_gps": empty, "integral": empty, "x_m": empty, "sigma_z_m": empty, "n": empty.astype(int)}
+
+    ok = (groups >= 0) & np.isfinite(dC) & np.isfinite(y)
+    # Trapezoid segments between consecutive valid samples of the same transect
+    same = ok[1:] & ok[:-1] & (groups[1:] == groups[:-1])
+    seg = 0.5 * (dC[1:] + dC[:-1]) * (y[1:] - y[:-1])
+    integral = np.bincount(groups[1:][same], weights=seg[same], minlength=k)
+
+    g = groups[ok]
+    n = np.bincount(g, minlength=k)
+    w = np.clip(dC[ok], 0.0, None)
+    w_sum = np.bincount(g, weights=w, minlength=k)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_bar = np.bincount(g, weights=w * x[ok], minlength=k) / w_sum
+        z_bar = np.bincount(g, weights=w * z[ok], minlength=k) / w_sum
+        u_bar = np.bincount(g, weights=u[ok], minlength=k) / n
+
+        _, sigz = pasquill_sigma(np.where(x_bar > 0, x_bar, 1.0), stability)
+        sigz = np.maximum(sigz, 0.01)
+        vertical = (np.exp(-((z_bar - H_m) ** 2) / (2.0 * sigz ** 2)) +
+                    np.exp(-((z_bar + H_m) ** 2) / (2.0 * sigz ** 2)))
+        Q = np.sqrt(2.0 * np.pi) * u_bar * sigz * np.abs(integral) / vertical
+    Q = np.where((x_bar > 0) & (vertical > 0) & np.isfinite(Q), Q, np.nan)
+    return {"Q_gps": Q, "integral": integral, "x_m": x_bar, "sigma_z_m": sigz, "n": n}
 
 # -----------------------------
 # Synthetic dataset generator
@@ -202,11 +531,8 @@ def simulate_dataset(n_points: int = 500,
     dx = rng.uniform(-domain_m, domain_m, n_points)
     dy = rng.uniform(-domain_m, domain_m, n_points)
 
-    # Convert to pseudo lat/lon for convenience
-    dlat = dy / EARTH_R
-    dlon = dx / (EARTH_R * np.cos(np.radians(lat0)))
-    lat = lat0 + np.degrees(dlat)
-    lon = lon0 + np.degrees(dlon)
+    # Convert to lat/lon with the site projection
+    lat, lon = local_projection(lat0, lon0).inverse(dx, dy)
 
     # Rotate to wind frame
     xw, yw = rotate_to_wind_frame(dx, dy, wind_dir_from_deg)
@@ -246,20 +572,46 @@ def simulate_dataset(n_points: int = 500,
 # High-level pipeline
 # -----------------------------
 
-def preprocess_and_invert(df: pd.DataFrame,
-                          stability_override: Optional[str] = None,
-                          wind_sector_half_width_deg: float = 30.0) -> Dict[str, float]:
+def frame_value(df: pd.DataFrame, name: str):
     """
-    End-to-end: compute local coords, rotate to wind frame, compute sigmas,
-    build anomaly, filter points within wind sector, then invert for Q.
+    Model-frame input `name`: the column's values when the frame has one, else the per-run
+    scalar in df.attrs (frames built by pipeline.build_model_frame keep the source position,
+    source height and, without measured meteorology, wind direction and stability only once).
+    """
+    if name in df.columns:
+        return df[name].to_numpy()
+    return df.attrs[name]
+
+
+def _frame_scalar(df: pd.DataFrame, name: str) -> float:
+    value = frame_value(df, name)
+    return float(value[0]) if np.ndim(value) else float(value)
+
+
+def source_local_xy(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """Local x/y (m) of every row relative to the source (projected once, reusable across fits)."""
+    return latlon_to_local_xy(df["lat"].values, df["lon"].values,
+                              _frame_scalar(df, "source_lat"), _frame_scalar(df, "source_lon"))
+
+
+def wind_frame_inputs(df: pd.DataFrame,
+                      stability_override: Optional[str] = None,
+                      wind_sector_half_width_deg: float = 30.0,
+                      local_xy: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> Dict[str, np.ndarray]:
+    """
+    Wind-frame geometry, anomaly and sigmas for every row of a model frame, plus the
+    downwind/in-sector/finite mask used by preprocess_and_invert (rows stay aligned with df).
+    local_xy: precomputed source_local_xy(df), to skip the projection on repeated fits.
+    Wind direction and (without stability_override) stability are taken per row when they
+    are columns (see frame_value), so a frame with measured meteorology (varying wind and
+    class) is handled; "stability" is then the most frequent class.
     """
     # Coordinates relative to source
-    x_local, y_local = latlon_to_local_xy(df["lat"].values, df["lon"].values,
-                                          df["source_lat"].values[0], df["source_lon"].values[0])
+    x_local, y_local = local_xy if local_xy is not None else source_local_xy(df)
 
     # Bearing from source to point (for sector filter)
     bearings_deg = (np.degrees(np.arctan2(x_local, y_local)) + 360.0) % 360.0  # 0=N, 90=E
-    wind_from = float(df["wind_dir_from_deg"].iloc[0])
+    wind_from = np.asarray(frame_value(df, "wind_dir_from_deg"), dtype=float)
     wind_towards = (wind_from + 180.0) % 360.0
     # Angular difference
     ang_diff = np.abs(((bearings_deg - wind_towards + 180.0) % 360.0) - 180.0)
@@ -271,19 +623,53 @@ def preprocess_and_invert(df: pd.DataFrame,
     dC = (df["ch4_ppm"] - df["background_ppm"]).values
     z = df["z_m"].values
     u = df["wind_speed_ms"].values
-    H = float(df["source_height_m"].iloc[0])
+    H = _frame_scalar(df, "source_height_m")
 
     # Sigmas
-    stab = stability_override or str(df["stability"].iloc[0])
-    sigy, sigz = pasquill_sigma(np.abs(xw), stab)
+    stab_values = frame_value(df, "stability") if stability_override is None else None
+    if stability_override is not None or np.ndim(stab_values) == 0:
+        stab = stability_override if stability_override is not None else str(stab_values)
+        sigy, sigz = pasquill_sigma(np.abs(xw), stab)
+    else:
+        classes, codes, counts = np.unique(stab_values.astype(str),
+                                           return_inverse=True, return_counts=True)
+        stab = str(classes[np.argmax(counts)])
+        sigy, sigz = pasquill_sigma(np.abs(xw), stab)
+        for k, cls in enumerate(classes):
+            if cls != stab:
+                rows = codes == k
+                sigy[rows], sigz[rows] = pasquill_sigma(np.abs(xw[rows]), str(cls))
 
     # Filter: downwind, inside sector, finite
     mask = (xw > 0) & (ang_diff <= wind_sector_half_width_deg) & np.isfinite(dC) & np.isfinite(u)
+    return {"xw": xw, "yw": yw, "z": z, "u": u, "H": H, "dC": dC,
+            "sigy": sigy, "sigz": sigz, "stability": stab, "mask": mask}
+
+
+def preprocess_and_invert(df: pd.DataFrame,
+                          stability_override: Optional[str] = None,
+                          wind_sector_half_width_deg: float = 30.0,
+                          loss: Literal["l2", "huber", "tukey"] = "l2",
+                          local_xy: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+                          cv_folds: int = 5) -> Dict[str, float]:
+    """
+    End-to-end: compute local coords, rotate to wind frame, compute sigmas,
+    build anomaly, filter points within wind sector, then invert for Q
+    (robust IRLS when loss is "huber" or "tukey"; the final weights are returned).
+    The closed-form leave-one-out and cv_folds-fold scores (cross_validation_scores)
+    are included.
+    local_xy: precomputed source_local_xy(df) when fitting the same frame repeatedly.
+    """
+    inp = wind_frame_inputs(df, stability_override, wind_sector_half_width_deg, local_xy)
+    xw, yw, z, u, H, dC = inp["xw"], inp["yw"], inp["z"], inp["u"], inp["H"], inp["dC"]
+    sigy, sigz, stab, mask = inp["sigy"], inp["sigz"], inp["stability"], inp["mask"]
     if mask.sum() < 5:
         raise ValueError("Insufficient valid downwind points after filtering. Try relaxing the sector or check inputs.")
 
-    Q_hat, Q_std, r2 = invert_emission_rate(xw[mask], yw[mask], z[mask], u[mask], H,
-                                            dC[mask], sigy[mask], sigz[mask], weights=None)
+    Q_hat, Q_std, r2, w, cv = invert_emission_rate(xw[mask], yw[mask], z[mask], u[mask], H,
+                                                   dC[mask], sigy[mask], sigz[mask], weights=None,
+                                                   loss=loss, return_weights=True,
+                                                   return_cv=True, cv_folds=cv_folds)
     
     # Calcular valores predichos para gráfico observado vs modelado
     predicted = gaussian_concentration(Q_hat, xw[mask], yw[mask], z[mask], u[mask], H, 
@@ -296,12 +682,37 @@ def preprocess_and_invert(df: pd.DataFrame,
         "Q_hat_gph": Q_hat * 3600.0,
         "Q_std_gph": Q_std * 3600.0,
         "R2": r2,
+        **cv,
         "n_points": int(mask.sum()),
         "stability_used": stab,
+        "loss": loss,
         "observed": observed.tolist(),
-        "predicted": predicted.tolist()
+        "predicted": predicted.tolist(),
+        **({"robust_weights": w.tolist()} if loss != "l2" else {})
     }
 
+
+def fit_row_weights(df: pd.DataFrame, results: Dict[str, Any],
+                    stability_override: Optional[str] = None,
+                    wind_sector_half_width_deg: float = 30.0,
+                    local_xy: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> Optional[np.ndarray]:
+    """
+    The final IRLS weights of a preprocess_and_invert fit, aligned with the rows of df
+    ("robust_weights" only covers the fit's masked rows; the other rows get 1), so that
+    estimates derived from the same frame use the same robust loss. None for an L2 fit.
+    stability_override and the sector must be the ones the fit was run with.
+    """
+    w = results.get("robust_weights")
+    if w is None:
+        return None
+    w = np.asarray(w, dtype=float)
+    mask = wind_frame_inputs(df, stability_override, wind_sector_half_width_deg, local_xy)["mask"]
+    if w.size != int(mask.sum()):
+        raise ValueError("robust_weights do not match the fit's rows; use the fit's stability and sector.")
+    row_w = np.ones(len(df))
+    row_w[mask] = w
+    return row_w
+
 # -----------------------------
 # CLI demo
 # -----------------------------
@@ -0,0 +1,25 @@
+# Configuración de gunicorn (se carga automáticamente desde el directorio de trabajo).
+# Workers, threads y timeout se dimensionan con server_config.py a partir del perfil medido
+# por loadtest.py; WEB_CONCURRENCY, GUNICORN_THREADS y GUNICORN_TIMEOUT los sobrescriben.
+import os
+
+from server_config import recommend
+
+_rec = recommend()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = _rec['workers']
+threads = _rec['threads']
+worker_class = 'gthread' if threads > 1 else 'sync'
+timeout = _rec['timeout']
+graceful_timeout = 30
+keepalive = 5
+# warm_up() en el maestro, los workers comparten módulos copy-on-write
+preload_app = True
+# Reciclar workers de vez en cuando para acotar la fragmentación de memoria
+max_requests = 500
+max_requests_jitter = 50
+
+
+def on_starting(server):
+    server.log.info(f"server_config: {_rec}")
@@ -0,0 +1,367 @@
+"""
+loadtest.py — Local load-test harness for /upload.
+
+Generates synthetic LI-7810 `.data` / `.gpx` pairs (a vehicle crossing a Gaussian
+plume several times), starts the app locally (gunicorn with gunicorn.conf.py when
+available, otherwise the Flask dev server), replays the pairs with N concurrent
+clients and reports throughput and p50/p95/p99 latency.
+
+The response cache is disabled on the spawned server (RESULT_CACHE_MAX_ENTRIES=0)
+so every request runs the full pipeline; use --with-cache to measure cache hits.
+
+Usage:
+    python loadtest.py --requests 40 --concurrency 4 --points 1200
+    python loadtest.py --url http://127.0.0.1:8000 --requests 100 --concurrency 8
+    python loadtest.py --profile          # in-process CPU/memory profile -> loadtest_profile.json
+    python loadtest.py --payload          # response sizes with/without compression and asset caching
+
+The profile feeds server_config.py (workers, threads, timeout).
+"""
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from gaussian_ch4 import gaussian_concentration, local_projection, pasquill_sigma
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_UTC_MINUS_5 = timezone(timedelta(hours=-5))
+
+
+# -----------------------------
+# Synthetic drives
+# -----------------------------
+
+def write_synthetic_drive(prefix: str, n_points: int = 1200, seed: int = 0,
+                          Q_gps: float = 20.0, lat0: float = 7.1300, lon0: float = -73.1250,
+                          wind_dir_from_deg: float = 270.0, wind_speed_ms: float = 3.0,
+                          stability: str = 'D', background_ppb: float = 2000.0,
+                          noise_ppb: float = 3.0, passes: int = 6,
+                          start: Optional[datetime] = None, rate_hz: float = 1.0,
+                          analyzer_lag_s: float = 0.0) -> Tuple[str, str]:
+    """
+    Write `<prefix>.data` and `<prefix>.gpx` for a serpentine drive downwind of a source.
+    analyzer_lag_s delays the analyzer timestamps (inlet transport time).
+    Returns (data_path, gpx_path).
+    """
+    rng = np.random.default_rng(seed)
+    start = start or datetime(2025, 3, 1, 15, 0, 0, tzinfo=timezone.utc)
+    t = np.arange(n_points)
+
+    # Trayectoria en marco del viento: avanza a favor del viento y cruza la pluma `passes` veces
+    xw = 30.0 + 220.0 * t / max(n_points - 1, 1)
+    yw = 150.0 * np.sin(2.0 * np.pi * passes * t / max(n_points, 1))
+    # Inversa de rotate_to_wind_frame
+    theta = np.radians((wind_dir_from_deg + 180.0) % 360.0)
+    x = np.cos(theta) * xw - np.sin(theta) * yw
+    y = np.sin(theta) * xw + np.cos(theta) * yw
+    lat, lon = local_projection(lat0, lon0).inverse(x, y)
+    z = 1.5 + rng.normal(0.0, 0.05, n_points)
+
+    sigy, sigz = pasquill_sigma(np.abs(xw), stability)
+    # 1 unidad del modelo = 1 ppm de anomalía -> ppb
+    dC_ppb = 1000.0 * gaussian_concentration(Q_gps, xw, yw, z, np.full(n_points, wind_speed_ms),
+                                             2.0, sigy, sigz)
+    ch4 = background_ppb + dC_ppb + rng.normal(0.0, noise_ppb, n_points)
+    co2 = 420.0 + dC_ppb / 50.0 + rng.normal(0.0, 0.5, n_points)
+
+    times = [start + timedelta(seconds=float(i) / rate_hz) for i in range(n_points)]
+    gpx_path, data_path = prefix + '.gpx', prefix + '.data'
+    with open(gpx_path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<gpx version="1.1" creator="loadtest" xmlns="http://www.topografix.com/GPX/1/1">\n'
+                '<trk><name>synthetic</name><trkseg>\n')
+        for i in range(n_points):
+            f.write(f'<trkpt lat="{lat[i]:.7f}" lon="{lon[i]:.7f}"><ele>{z[i]:.2f}</ele>'
+                    f'<time>{times[i].strftime("%Y-%m-%dT%H:%M:%SZ")}</time></trkpt>\n')
+        f.write('</trkseg></trk></gpx>\n')
+    with open(data_path, 'w', encoding='utf-8') as f:
+        f.write('Model:\tLI-7810 CH4/CO2/H2O Trace Gas Analyzer\nSN:\tTG10-01183\n'
+                'Software Version:\t2.3.0\nTimestamp:\t' + f'{times[0].astimezone(_UTC_MINUS_5):%Y-%m-%d %H:%M:%S}\n'
+                'Timezone:\tAmerica/Bogota\n')
+        f.write('DATAH\tSECONDS\tNANOSECONDS\tNDX\tDIAG\tREMARK\tDATE\tTIME\tH2O\tCO2\tCH4\n')
+        f.write('DATAU\ts\tns\t\t\t\tdate\ttime\tppm\tppm\tppb\n')
+        for i in range(n_points):
+            t_an = times[i] + timedelta(seconds=analyzer_lag_s)
+            local = t_an.astimezone(_UTC_MINUS_5)
+            f.write(f'DATA\t{int(t_an.timestamp())}\t{t_an.microsecond * 1000}\t{i}\t0\t\t'
+                    f'{local:%Y-%m-%d}\t{local:%H:%M:%S}\t9000.0\t{co2[i]:.3f}\t{ch4[i]:.3f}\n')
+    return data_path, gpx_path
+
+
+def generate_drives(out_dir: str, count: int, n_points: int) -> List[Tuple[str, str]]:
+    os.makedirs(out_dir, exist_ok=True)
+    return [write_synthetic_drive(os.path.join(out_dir, f'drive_{i:03d}'), n_points=n_points, seed=i,
+                                  wind_dir_from_deg=(250.0 + 10.0 * i) % 360.0)
+            for i in range(count)]
+
+
+# -----------------------------
+# HTTP client
+# -----------------------------
+
+def _multipart(fields: Dict[str, str], files: Dict[str, str]) -> Tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, path in files.items():
+        with open(path, 'rb') as f:
+            content = f.read()
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                     f'filename="{os.path.basename(path)}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def post_upload(url: str, data_path: str, gpx_path: str, gas_type: str = 'CH4',
+                timeout: float = 300.0) -> Tuple[float, bool, int]:
+    """POST one pair; returns (latency_s, ok, response_bytes)."""
+    body, content_type = _multipart({'gasType': gas_type}, {'dataFile': data_path, 'gpxFile': gpx_path})
+    req = urllib.request.Request(url.rstrip('/') + '/upload', data=body, method='POST',
+                                 headers={'Content-Type': content_type})
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            payload = resp.read()
+        ok = resp.status == 200 and b'"success"' in payload
+    except Exception:
+        payload, ok = b'', False
+    return time.perf_counter() - t0, ok, len(payload)
+
+
+def run_load(url: str, drives: List[Tuple[str, str]], requests: int, concurrency: int) -> Dict[str, float]:
+    jobs = [drives[i % len(drives)] for i in range(requests)]
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda d: post_upload(url, *d), jobs))
+    wall = time.perf_counter() - t0
+    lat = np.array([r[0] for r in results])
+    ok = sum(1 for r in results if r[1])
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'ok': ok,
+        'errors': requests - ok,
+        'wall_s': wall,
+        'throughput_rps': requests / wall if wall > 0 else 0.0,
+        'p50_s': float(np.percentile(lat, 50)),
+        'p95_s': float(np.percentile(lat, 95)),
+        'p99_s': float(np.percentile(lat, 99)),
+        'max_s': float(lat.max()),
+        'mean_response_kb': float(np.mean([r[2] for r in results]) / 1024.0),
+    }
+
+
+# -----------------------------
+# Local server
+# -----------------------------
+
+def start_server(port: int, workdir: str, with_cache: bool = False) -> subprocess.Popen:
+    env = {**os.environ,
+           'PORT': str(port),
+           'PYTHONPATH': _HERE,
+           'RESULTS_DB': os.path.join(workdir, 'results.db'),
+           'RESULT_CACHE_DB': os.path.join(workdir, 'cache.db'),
+        'ARTIFACT_CACHE_DB': os.path.join(workdir, 'artifacts.db'),
+           'ARTIFACT_CACHE_DB': os.path.join(workdir, 'artifacts.db'),
+           'UPLOAD_FOLDER': os.path.join(workdir, 'uploads')}
+    if not with_cache:
+        env['RESULT_CACHE_MAX_ENTRIES'] = '0'
+    if shutil.which('gunicorn'):
+        cmd = ['gunicorn', '-c', os.path.join(_HERE, 'gunicorn.conf.py'), '-b', f'127.0.0.1:{port}',
+               'codigo_HTML_Gausiana:create_app()']
+    else:
+        cmd = [sys.executable, os.path.join(_HERE, 'codigo_HTML_Gausiana.py')]
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=2).read()
+            return proc
+        except Exception:
+            if proc.poll() is not None:
+                raise RuntimeError('El servidor terminó al arrancar')
+            time.sleep(0.3)
+    proc.terminate()
+    raise RuntimeError('El servidor no respondió en 60 s')
+
+
+# -----------------------------
+# In-process profile
+# -----------------------------
+
+def profile_pipeline(drives: List[Tuple[str, str]], out_path: str) -> Dict[str, float]:
+    """CPU seconds, wall p99 and peak RSS per request, measured with the Flask test client."""
+    workdir = tempfile.mkdtemp(prefix='gea_profile_')
+    os.environ['RESULT_CACHE_MAX_ENTRIES'] = '0'
+    import codigo_HTML_Gausiana
+    app = codigo_HTML_Gausiana.create_app({
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'RESULTS_DB': os.path.join(workdir, 'results.db'),
+        'RESULT_CACHE_DB': os.path.join(workdir, 'cache.db'),
+        'ARTIFACT_CACHE_DB': os.path.join(workdir, 'artifacts.db'),
+    })
+    client = app.test_client()
+    base_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    cpu, wall = [], []
+    for data_path, gpx_path in drives:
+        with open(data_path, 'rb') as fd, open(gpx_path, 'rb') as fg:
+            c0, w0 = time.process_time(), time.perf_counter()
+            client.post('/upload', data={'dataFile': (fd, os.path.basename(data_path)),
+                                         'gpxFile': (fg, os.path.basename(gpx_path)),
+                                         'gasType': 'CH4'})
+            cpu.append(time.process_time() - c0)
+            wall.append(time.perf_counter() - w0)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    profile = {
+        'cpu_s_per_request': float(np.mean(cpu)),
+        'wall_s_p99': float(np.percentile(wall, 99)),
+        'peak_rss_mb_per_request': max(peak_rss_mb - base_rss_mb, 1.0),
+        'base_rss_mb': base_rss_mb,
+    }
+    with open(out_path, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, indent=2)
+    return profile
+
+
+def measure_payload(drives: List[Tuple[str, str]], bandwidth_mbps: float = 10.0) -> Dict[str, float]:
+    """
+    Bytes on the wire for /upload (identity vs negotiated encoding) and for a first and a
+    repeat page visit (HTML + CSS + JS + banner), with the download time at bandwidth_mbps.
+    """
+    workdir = tempfile.mkdtemp(prefix='gea_payload_')
+    import codigo_HTML_Gausiana
+    import http_cache
+    app = codigo_HTML_Gausiana.create_app({
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'RESULTS_DB': os.path.join(workdir, 'results.db'),
+        'RESULT_CACHE_DB': os.path.join(workdir, 'cache.db'),
+        'ARTIFACT_CACHE_DB': os.path.join(workdir, 'artifacts.db'),
+    })
+    client = app.test_client()
+    encoding = http_cache.available_encodings()[0]
+
+    def upload(accept):
+        data_path, gpx_path = drives[0]
+        with open(data_path, 'rb') as fd, open(gpx_path, 'rb') as fg:
+            t0 = time.perf_counter()
+            resp = client.post('/upload', headers={'Accept-Encoding': accept},
+                               data={'dataFile': (fd, os.path.basename(data_path)),
+                                     'gpxFile': (fg, os.path.basename(gpx_path)), 'gasType': 'CH4'})
+            return len(resp.get_data()), time.perf_counter() - t0
+
+    upload(encoding)  # llenar la caché de respuestas: las dos mediciones siguientes son hits
+    identity_bytes, identity_s = upload('identity')
+    encoded_bytes, encoded_s = upload(encoding)
+
+    assets = ['/'] + ['/static/' + app.extensions['asset_manifest'].get(a, a)
+                      for a in ('css/styles.css', 'js/main.js', 'banner.jpg.webp')]
+    validators: Dict[str, Dict[str, str]] = {}
+    immutable = set()
+
+    def visit():
+        """Fetch the page and its assets like a browser with a warm HTTP cache would."""
+        total, requests_made = 0, 0
+        for url in assets:
+            if url in immutable:
+                continue  # Cache-Control immutable: el navegador la reutiliza sin preguntar
+            resp = client.get(url, headers={'Accept-Encoding': encoding, **validators.get(url, {})})
+            total, requests_made = total + len(resp.get_data()), requests_made + 1
+            if resp.headers.get('ETag'):
+                validators[url] = {'If-None-Match': resp.headers['ETag']}
+            if 'immutable' in resp.headers.get('Cache-Control', ''):
+                immutable.add(url)
+            resp.close()
+        return total, requests_made
+
+    first_bytes, first_requests = visit()
+    repeat_bytes, repeat_requests = visit()
+
+    to_s = 8.0 / (bandwidth_mbps * 1e6)
+    return {
+        'encoding': encoding,
+        'upload_identity_kb': identity_bytes / 1024.0,
+        'upload_encoded_kb': encoded_bytes / 1024.0,
+        'upload_ratio': identity_bytes / max(encoded_bytes, 1),
+        'upload_server_s_identity': identity_s,
+        'upload_server_s_encoded': encoded_s,
+        'upload_download_s_identity': identity_bytes * to_s,
+        'upload_download_s_encoded': encoded_bytes * to_s,
+        'page_first_kb': first_bytes / 1024.0,
+        'page_first_requests': first_requests,
+        'page_repeat_kb': repeat_bytes / 1024.0,
+        'page_repeat_requests': repeat_requests,
+        'bandwidth_mbps': bandwidth_mbps,
+    }
+
+
+def _print_report(report: Dict[str, float]) -> None:
+    print("=== RESULTADOS DE CARGA ===")
+    print(f"Solicitudes: {report['requests']} (ok={report['ok']}, errores={report['errors']}), "
+          f"concurrencia={report['concurrency']}")
+    print(f"Throughput: {report['throughput_rps']:.2f} req/s en {report['wall_s']:.1f} s")
+    print(f"Latencia p50={report['p50_s'] * 1000:.0f} ms  p95={report['p95_s'] * 1000:.0f} ms  "
+          f"p99={report['p99_s'] * 1000:.0f} ms  max={report['max_s'] * 1000:.0f} ms")
+    print(f"Tamaño medio de respuesta: {report['mean_response_kb']:.0f} KB")
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="Load test /upload with synthetic drives.")
+    ap.add_argument("--url", default=None, help="Existing server URL (default: start one locally).")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--requests", type=int, default=40)
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--drives", type=int, default=8, help="Distinct synthetic drives to cycle through.")
+    ap.add_argument("--points", type=int, default=1200, help="Samples per synthetic drive.")
+    ap.add_argument("--with-cache", action="store_true", help="Keep the response cache enabled.")
+    ap.add_argument("--profile", action="store_true", help="Measure the in-process CPU/memory profile instead.")
+    ap.add_argument("--profile-out", default=os.path.join(_HERE, 'loadtest_profile.json'))
+    ap.add_argument("--payload", action="store_true", help="Measure compressed payload and asset caching instead.")
+    ap.add_argument("--bandwidth-mbps", type=float, default=10.0, help="Link speed for --payload download times.")
+    ap.add_argument("--json", default=None, help="Also write the report to this JSON file.")
+    args = ap.parse_args()
+
+    drive_dir = tempfile.mkdtemp(prefix='gea_drives_')
+    drives = generate_drives(drive_dir, args.drives, args.points)
+
+    if args.payload:
+        print(json.dumps(measure_payload(drives, args.bandwidth_mbps), indent=2))
+        sys.exit(0)
+
+    if args.profile:
+        prof = profile_pipeline(drives, args.profile_out)
+        print(json.dumps(prof, indent=2))
+        from server_config import recommend
+        print("Configuración recomendada:", json.dumps(recommend(prof), indent=2))
+        sys.exit(0)
+
+    server = None
+    url = args.url
+    if url is None:
+        server = start_server(args.port, tempfile.mkdtemp(prefix='gea_server_'), args.with_cache)
+        url = f'http://127.0.0.1:{args.port}'
+    try:
+        report = run_load(url, drives, args.requests, args.concurrency)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+    _print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
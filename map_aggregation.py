@@ -0,0 +1,191 @@
+"""
+map_aggregation.py — Server-side spatial aggregation of measurement points for the map.
+
+Large campaigns (100k+ samples) freeze the browser when every point is sent to
+Densitymapbox/Scattermapbox. Instead, points are binned into hexagonal (or square)
+cells whose size follows the map zoom (about CELL_PX screen pixels per cell), and
+the map draws one marker per cell with its count, mean, max and mean enhancement
+over background. Binning is a single vectorized pass: projected meters -> integer
+cell index -> np.unique(return_inverse) -> np.bincount / np.maximum.reduceat.
+
+The raw points of a dataset are stored once in the shared artifact cache (a
+ResultCache separate from the /upload response cache, see result_cache.py) under
+the dataset key; each (dataset, zoom, shape) result is
+cached next to them, so other zoom levels are computed on first request and then
+served from the cache by any worker.
+
+Usage:
+    cells = aggregate_cells(lat, lon, conc, enhancement, zoom=17)
+    store_points(cache, key, lat, lon, conc, enhancement)
+    cells = cached_cells(cache, key, zoom=15)      # None if the points expired
+
+MAP_AGGREGATE_MIN_POINTS (environment) sets the size above which /upload aggregates.
+"""
+
+import io
+import json
+import os
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from gaussian_ch4 import local_projection
+
+# Por encima de este número de puntos el mapa se dibuja con celdas agregadas
+AGGREGATE_MIN_POINTS = int(os.environ.get('MAP_AGGREGATE_MIN_POINTS', 5000))
+# Tamaño aproximado de una celda en píxeles de pantalla
+CELL_PX = 12
+MAP_ZOOMS = tuple(range(10, 21))
+SHAPES = ('hex', 'square')
+
+# Metros por píxel de Web Mercator en el ecuador con zoom 0 (teselas de 256 px)
+_M_PER_PX_Z0 = 156543.03392
+_SQRT3 = np.sqrt(3.0)
+
+
+def cell_size_m(zoom: float, lat: float) -> float:
+    """Cell size (m) that spans about CELL_PX pixels at this zoom and latitude."""
+    return CELL_PX * _M_PER_PX_Z0 * np.cos(np.radians(lat)) / 2.0 ** zoom
+
+
+# -----------------------------
+# Cell indexing
+# -----------------------------
+
+def hex_index(x: np.ndarray, y: np.ndarray, size: float):
+    """Axial (q, r) of the pointy-top hexagon (circumradius `size`) containing each point."""
+    qf = (_SQRT3 / 3.0 * x - y / 3.0) / size
+    rf = (2.0 / 3.0 * y) / size
+    sf = -qf - rf
+    q, r, s = np.round(qf), np.round(rf), np.round(sf)
+    # Redondeo cúbico: corregir la coordenada con mayor error para que q + r + s = 0
+    dq, dr, ds = np.abs(q - qf), np.abs(r - rf), np.abs(s - sf)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    q = np.where(fix_q, -r - s, q)
+    r = np.where(fix_r, -q - s, r)
+    return q.astype(np.int64), r.astype(np.int64)
+
+
+def hex_center(q: np.ndarray, r: np.ndarray, size: float):
+    return size * _SQRT3 * (q + r / 2.0), size * 1.5 * r
+
+
+def square_index(x: np.ndarray, y: np.ndarray, size: float):
+    return np.floor(x / size).astype(np.int64), np.floor(y / size).astype(np.int64)
+
+
+def square_center(i: np.ndarray, j: np.ndarray, size: float):
+    return (i + 0.5) * size, (j + 0.5) * size
+
+
+# -----------------------------
+# Aggregation
+# -----------------------------
+
+def aggregate_cells(lat, lon, values, enhancement=None, zoom: float = 17,
+                    shape: str = 'hex', origin=None) -> Dict[str, Any]:
+    """
+    Bin points into cells for one zoom level.
+    Returns {'zoom', 'shape', 'cell_m', 'n_points', 'n_cells', 'lat', 'lon', 'count',
+             'mean', 'max', 'enhancement_mean', 'enhancement_max'} with one list entry per cell.
+    origin: (lat0, lon0) of the projection; defaults to the rounded centroid so every zoom
+    of a dataset shares the same grid origin.
+    """
+    if shape not in SHAPES:
+        raise ValueError(f"Forma de celda no válida: {shape}")
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    values = np.asarray(values, dtype=float)
+    enhancement = values * 0.0 if enhancement is None else np.asarray(enhancement, dtype=float)
+    ok = np.isfinite(lat) & np.isfinite(lon) & np.isfinite(values) & np.isfinite(enhancement)
+    lat, lon, values, enhancement = lat[ok], lon[ok], values[ok], enhancement[ok]
+
+    out = {'zoom': zoom, 'shape': shape, 'n_points': int(lat.size)}
+    if lat.size == 0:
+        out.update(cell_m=None, n_cells=0, lat=[], lon=[], count=[], mean=[], max=[],
+                   enhancement_mean=[], enhancement_max=[])
+        return out
+
+    if origin is None:
+        origin = (round(float(lat.mean()), 3), round(float(lon.mean()), 3))
+    proj = local_projection(*origin)
+    x, y = proj.forward(lat, lon)
+    size = cell_size_m(zoom, origin[0])
+    if shape == 'hex':
+        i, j = hex_index(x, y, size)
+    else:
+        i, j = square_index(x, y, size)
+
+    # Un entero por celda: los índices caben holgadamente en 32 bits cada uno
+    keys = (i << 32) + (j & 0xFFFFFFFF)
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.ravel()
+    count = np.bincount(inverse)
+    mean = np.bincount(inverse, weights=values) / count
+    enh_mean = np.bincount(inverse, weights=enhancement) / count
+    # Máximos por celda: ordenar por celda y reducir por tramos
+    order = np.argsort(inverse, kind='stable')
+    starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+    vmax = np.maximum.reduceat(values[order], starts)
+    enh_max = np.maximum.reduceat(enhancement[order], starts)
+
+    ci = uniq >> 32
+    cj = ((uniq & 0xFFFFFFFF) ^ 0x80000000) - 0x80000000
+    cx, cy = hex_center(ci, cj, size) if shape == 'hex' else square_center(ci, cj, size)
+    clat, clon = proj.inverse(cx, cy)
+
+    out.update(
+        cell_m=round(float(size), 2),
+        n_cells=int(uniq.size),
+        lat=np.round(clat, 7).tolist(),
+        lon=np.round(clon, 7).tolist(),
+        count=count.tolist(),
+        mean=np.round(mean, 4).tolist(),
+        max=np.round(vmax, 4).tolist(),
+        enhancement_mean=np.round(enh_mean, 4).tolist(),
+        enhancement_max=np.round(enh_max, 4).tolist(),
+    )
+    return out
+
+
+# -----------------------------
+# Cache per dataset and zoom
+# -----------------------------
+
+def _points_key(dataset_key: str) -> str:
+    return f'map:{dataset_key}:points'
+
+
+def _cells_key(dataset_key: str, zoom: int, shape: str) -> str:
+    return f'map:{dataset_key}:{shape}:{zoom}'
+
+
+def store_points(cache, dataset_key: str, lat, lon, values, enhancement) -> None:
+    """
+    Keep the raw points of a dataset (.npz, float64 like the analysis) so other zooms
+    can be aggregated later with the same cell statistics as the first response.
+    """
+    buf = io.BytesIO()
+    np.savez(buf, lat=np.asarray(lat, dtype=np.float64), lon=np.asarray(lon, dtype=np.float64),
+             values=np.asarray(values, dtype=np.float64),
+             enhancement=np.asarray(enhancement, dtype=np.float64))
+    cache.set(_points_key(dataset_key), buf.getvalue())
+
+
+def cached_cells(cache, dataset_key: str, zoom: int, shape: str = 'hex',
+                 origin=None) -> Optional[Dict[str, Any]]:
+    """Cells for (dataset, zoom, shape) from the cache, aggregating on a miss; None if the points expired."""
+    zoom = int(min(max(zoom, MAP_ZOOMS[0]), MAP_ZOOMS[-1]))
+    key = _cells_key(dataset_key, zoom, shape)
+    payload = cache.get(key)
+    if payload is not None:
+        return json.loads(payload)
+    raw = cache.get(_points_key(dataset_key))
+    if raw is None:
+        return None
+    with np.load(io.BytesIO(raw)) as pts:
+        cells = aggregate_cells(pts['lat'], pts['lon'], pts['values'], pts['enhancement'],
+                                zoom=zoom, shape=shape, origin=origin)
+    cache.set(key, json.dumps(cells).encode('utf-8'))
+    return cells
@@ -0,0 +1,107 @@
+"""
+memory_profile.py — Per-stage peak memory of an analysis and the memory budget of /upload.
+
+StageMemory records, with tracemalloc, the peak traced memory (numpy buffers and Python
+objects) of consecutive stages:
+
+    mem = StageMemory(enabled=True)
+    mem.stage('parse_merge')
+    ...
+    mem.stage('search')          # closes 'parse_merge'
+    ...
+    report = mem.finish()        # {'peak_mb', 'stages': [{'stage', 'peak_mb', 'retained_mb', 'seconds'}]}
+
+peak_mb is the stage's peak above the memory in use when the analysis started and
+retained_mb what the stage leaves allocated. tracemalloc is process-wide and slows
+allocation-heavy code, so it is only enabled on request (MEMORY_PROFILE=1); with several
+threads per worker the numbers include concurrent requests.
+
+The budget is checked twice, before the expensive work: from the input file sizes
+(parsing) and from the number of merged rows (everything after the merge), with the
+per-byte / per-row peaks measured by StageMemory on synthetic drives (PARSE_PEAK_PER_BYTE,
+ANALYSIS_PEAK_PER_ROW). MEMORY_BUDGET_MB=0 disables the check.
+"""
+
+import os
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+MEMORY_BUDGET_MB = float(os.environ.get('MEMORY_BUDGET_MB', 1024))
+# Tamaño del bloque de muestras del Monte Carlo; definido aquí (sin pandas) y usado por uncertainty.py
+MC_CHUNK_BYTES = int(os.environ.get('MC_CHUNK_BYTES', 16 * 1024 * 1024))
+# Pico del parseo + combinación por byte de los archivos .data + .gpx
+# (medido: 2.4 B/B con 40 000 y 150 000 puntos; el .data solo conserva fecha, hora y gas)
+PARSE_PEAK_PER_BYTE = 3.0
+# Pico del análisis (modelo, búsqueda, transectos, figuras, respuesta) por fila combinada
+# (medido: ~420 B/fila entre 40 000 y 150 000 puntos)
+ANALYSIS_PEAK_PER_ROW = 500.0
+# Memoria fija del análisis: el bloque de muestras del Monte Carlo más figuras y tablas pequeñas
+ANALYSIS_BASE_BYTES = MC_CHUNK_BYTES + 4 * 1024 * 1024
+
+_MB = 1024.0 * 1024.0
+
+
+class StageMemory:
+    """Peak traced memory of consecutive stages; a no-op when not enabled."""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.stages: List[Dict[str, Any]] = []
+        self._current: Optional[str] = None
+        self._own_tracing = False
+        self._base = 0
+        self._t0 = 0.0
+        if enabled:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._own_tracing = True
+            self._base = tracemalloc.get_traced_memory()[0]
+
+    def stage(self, name: str) -> None:
+        """Close the running stage (if any) and start `name`."""
+        if not self.enabled:
+            return
+        self._close()
+        self._current = name
+        self._t0 = time.perf_counter()
+        tracemalloc.reset_peak()
+
+    def _close(self) -> None:
+        if self._current is None:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        self.stages.append({
+            'stage': self._current,
+            'peak_mb': (peak - self._base) / _MB,
+            'retained_mb': (current - self._base) / _MB,
+            'seconds': time.perf_counter() - self._t0,
+        })
+        self._current = None
+
+    def finish(self) -> Optional[Dict[str, Any]]:
+        """Close the last stage, stop tracing (if started here) and return the report."""
+        if not self.enabled:
+            return None
+        self._close()
+        if self._own_tracing:
+            tracemalloc.stop()
+            self._own_tracing = False
+        self.enabled = False
+        return {
+            'peak_mb': max((s['peak_mb'] for s in self.stages), default=0.0),
+            'stages': self.stages,
+        }
+
+
+def predict_parse_bytes(input_bytes: int) -> float:
+    return input_bytes * PARSE_PEAK_PER_BYTE
+
+
+def predict_analysis_bytes(n_rows: int) -> float:
+    return ANALYSIS_BASE_BYTES + n_rows * ANALYSIS_PEAK_PER_ROW
+
+
+def over_budget(predicted_bytes: float, budget_mb: Optional[float] = None) -> bool:
+    budget_mb = MEMORY_BUDGET_MB if budget_mb is None else budget_mb
+    return budget_mb > 0 and predicted_bytes > budget_mb * _MB
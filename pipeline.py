@@ -0,0 +1,1311 @@
+"""
+pipeline.py — Reusable LI-7810 + GPX processing pipeline.
+
+Stages (each usable on its own):
+    parse_gpx_file / parse_data_file  ->  estimate_analyzer_lag
+    ->  merge_gps_and_gas_data   (load_and_merge; load_saved_merge re-reads an exported merge)
+    ->  estimate_model_parameters (source, wind)  +  estimate_background (global or rolling)
+        +  estimate_heights (sensor height above ground from a DEM, see terrain.py)
+        +  measured_meteorology (optional sonic anemometer log, see anemometer.py)
+    ->  build_model_frame (gaussian_ch4 input + statistical filters)
+    ->  search_best_configuration (stability x sector grid, preprocess_and_invert)
+    ->  compute_fit_metrics + uncertainty.monte_carlo_emission (Q distribution under input uncertainty)
+    ->  segment_transects + transect_estimates / mass_balance_transects
+        (per-crossing least-squares and crosswind-integrated Q, combine_transects)
+
+run_pipeline() chains them for one drive (.data + .gpx) and is what both the
+Flask app (codigo_HTML_Gausiana.py) and the batch CLI (batch_process.py) call.
+"""
+
+import hashlib
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from typing import Dict, List, Optional, Any, Tuple
+
+import numpy as np
+import pandas as pd
+import pytz
+from pandas.api.indexers import BaseIndexer
+
+import anemometer
+import binary_upload
+import columnar_export
+import terrain
+from memory_profile import StageMemory
+import uncertainty
+from gaussian_ch4 import (
+    StreamingEmissionEstimator, crosswind_integrated_emission, fit_row_weights, latlon_to_local_xy,
+    plume_kernel, preprocess_and_invert, rotate_to_wind_frame, source_local_xy, wind_frame_inputs,
+)
+
+# Zona horaria UTC-5
+UTC_MINUS_5 = pytz.timezone('America/Bogota')
+
+GAS_UNITS = {'CH4': 'ppb', 'CO2': 'ppm', 'H2O': 'ppm'}
+
+
+class PipelineError(ValueError):
+    """Pipeline failure with a user-facing message, optional suggestion and details."""
+
+    def __init__(self, message: str, suggestion: Optional[str] = None,
+                 details: Optional[Dict[str, Any]] = None):
+        super().__init__(message)
+        self.message = message
+        self.suggestion = suggestion
+        self.details = details
+
+    def to_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {'error': self.message}
+        if self.suggestion:
+            out['suggestion'] = self.suggestion
+        if self.details:
+            out['details'] = self.details
+        return out
+
+
+@dataclass
+class PipelineConfig:
+    """Model options for one analysis run (also used as part of cache/manifest keys)."""
+    gas_type: str = 'CH4'
+    # Clases de estabilidad a probar (ordenadas por probabilidad)
+    stability_classes: List[str] = field(default_factory=lambda: ['D', 'C', 'B', 'E', 'A'])
+    # Sectores MÁS AMPLIOS para capturar más puntos
+    sector_widths: List[float] = field(default_factory=lambda: [180.0, 150.0, 120.0, 90.0])
+    source_height_m: float = 2.0
+    min_points: int = 10
+    # Retardo del analizador: None = estimar automáticamente (FFT), número = fijo en segundos
+    analyzer_lag_s: Optional[float] = None
+    max_lag_s: float = 60.0
+    # Combinación GPS-analizador: 'nearest' (una fila por punto GPS) o 'interpolate'
+    # (una fila por muestra del analizador, posición interpolada)
+    merge_mode: str = 'nearest'
+    max_gap_s: float = 5.0
+    # Background: 'global' (percentil de todo el recorrido), 'time' o 'distance' (ventana móvil)
+    background_mode: str = 'global'
+    background_quantile: float = 0.10
+    background_window_s: float = 300.0
+    background_window_m: float = 500.0
+    # Segmentación en cruces de la pluma (transectos)
+    transect_threshold_sigma: float = 3.0
+    transect_turn_deg: float = 90.0
+    transect_max_gap_s: float = 10.0
+    transect_min_points: int = 4
+    transect_min_r2: float = 0.0
+    # Aceptación de un cruce para combinarlo: puntos ajustados, fracción mínima del ΣG² del
+    # ajuste completo (los que solo ven las colas de la pluma dan Q enormes) y Q_std/Q máximo
+    transect_min_fit_points: int = 8
+    transect_min_gg_fraction: float = 0.01
+    transect_max_rel_std: float = 1.0
+    # Altura sobre el suelo: DEM local (archivo o carpeta de tiles; None = variable DEM_PATH).
+    # Sin DEM (o fuera de cobertura) el sensor se asume a sensor_height_m sobre la vía.
+    dem_path: Optional[str] = None
+    sensor_height_m: float = 1.5
+    # Pérdida de la inversión: 'l2' (mínimos cuadrados) o robusta 'huber' / 'tukey' (IRLS)
+    robust_loss: str = 'l2'
+    # Criterio para elegir la configuración: validación cruzada 'loo' (dejar uno fuera),
+    # 'kfold' (bloques contiguos; opcional: en un recorrido la señal de la pluma suele quedar
+    # en un solo bloque y la búsqueda vuelve a 'loo') o el R² dentro de la muestra 'r2'
+    selection_criterion: str = 'loo'
+    cv_folds: int = 5
+    # Incertidumbre Monte Carlo de viento, altura de la fuente, background y estabilidad
+    # (ver uncertainty.py); 0 muestras = desactivado
+    mc_samples: int = 2000
+    mc_wind_speed_sigma_log: float = 0.5
+    mc_wind_dir_sigma_deg: float = 20.0
+    mc_source_height_range_m: Tuple[float, float] = (0.5, 5.0)
+    mc_seed: int = 0
+    # Anemómetro sónico (ver anemometer.py): bloques al ritmo del analizador (None = intervalo
+    # mediano entre muestras), ventana de turbulencia para sigma_theta / sigma_w y corrección
+    # de la marca de norte del equipo
+    anemometer_block_s: Optional[float] = None
+    anemometer_window_s: float = 600.0
+    anemometer_dir_offset_deg: float = 0.0
+    verbose: bool = True
+
+    def to_dict(self) -> Dict[str, Any]:
+        d = asdict(self)
+        d.pop('verbose', None)
+        return d
+
+
+# -----------------------------
+# Parsing
+# -----------------------------
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    """Streaming SHA-256 of a file (constant memory)."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def parse_gpx_file(gpx_file):
+    """Parse GPX file and extract trackpoints with timestamps"""
+    # Namespace para GPX
+    trkpt_tag = '{http://www.topografix.com/GPX/1/1}trkpt'
+    ns = {'gpx': 'http://www.topografix.com/GPX/1/1'}
+
+    # Lectura incremental: cada trkpt se libera al procesarlo, sin el árbol XML completo en memoria
+    columns = {'lat': [], 'lon': [], 'elevation': [], 'timestamp': []}
+    for _, trkpt in ET.iterparse(gpx_file, events=('end',)):
+        if trkpt.tag != trkpt_tag:
+            continue
+        time_elem = trkpt.find('gpx:time', ns)
+        if time_elem is not None:
+            ele_elem = trkpt.find('gpx:ele', ns)
+            # Parse ISO format timestamp and convert to UTC-5
+            timestamp = datetime.fromisoformat(time_elem.text.replace('Z', '+00:00'))
+            columns['lat'].append(float(trkpt.get('lat')))
+            columns['lon'].append(float(trkpt.get('lon')))
+            columns['elevation'].append(float(ele_elem.text) if ele_elem is not None else 0.0)
+            columns['timestamp'].append(timestamp.astimezone(UTC_MINUS_5))
+        trkpt.clear()
+
+    return pd.DataFrame(columns)
+
+
+def parse_data_file(data_file, gas_type='CH4', verbose=False):
+    """Parse .data file from LI-7810 analyzer"""
+    # Leer el archivo línea a línea buscando la línea que empieza con DATAH (header)
+    with open(data_file, 'r') as f:
+        header_cols = None
+        for line in f:
+            if line.startswith('DATAH'):
+                header_cols = data_header_columns(line)
+                break
+
+        if header_cols is None:
+            raise ValueError("No se encontró el header DATAH en el archivo")
+
+        # Leer datos (DATAU no empieza con 'DATA\t'); solo las columnas que usa gas_frame,
+        # en vez de un str por cada campo de cada fila
+        keep = [i for i, col in enumerate(header_cols) if col in ('DATE', 'TIME', gas_type)]
+        data_rows = []
+        for line in f:
+            if line.startswith('DATA\t'):
+                data_rows.append(data_row_fields(line, keep))
+
+    df = data_rows_frame(data_rows, [header_cols[i] for i in keep])
+    result_df = gas_frame(df, gas_type)
+    if verbose:
+        print(f"=== Parseo .data ({gas_type}): {len(df)} filas, {len(result_df)} válidas ===")
+
+    return result_df
+
+
+def data_header_columns(header_line: str) -> List[str]:
+    """Column names of a DATAH line, without the leading 'DATAH'."""
+    return [col.strip() for col in header_line.strip().split('\t')][1:]
+
+
+def data_row_fields(line: str, keep: List[int]) -> List[Optional[str]]:
+    """
+    Fields `keep` (indices into the DATAH columns) of a DATA line. Short rows are padded
+    with None (-> NaN / NaT, dropped later by gas_frame) and extra fields are ignored.
+    """
+    row = line.strip().split('\t')[1:]  # Quitar 'DATA' del inicio
+    return [row[i] if i < len(row) else None for i in keep]
+
+
+def data_rows_frame(data_rows, columns: List[str]) -> pd.DataFrame:
+    """DATA rows (split on tabs, without 'DATA') -> frame with numeric gas columns and a naive timestamp."""
+    df = pd.DataFrame(data_rows, columns=columns)
+
+    # Convertir columnas numéricas
+    numeric_cols = ['SECONDS', 'H2O', 'CO2', 'CH4']
+    for col in numeric_cols:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+
+    # Combinar DATE y TIME para crear timestamp
+    df['timestamp'] = pd.to_datetime(df['DATE'] + ' ' + df['TIME'], errors='coerce')
+    return df
+
+
+def gas_frame(df: pd.DataFrame, gas_type: str) -> pd.DataFrame:
+    """Analyzer frame (see data_rows_frame) -> timestamp/gas_concentration/gas_type/gas_units rows."""
+    if gas_type not in GAS_UNITS:
+        raise ValueError(f"Tipo de gas no válido: {gas_type}")
+    if gas_type not in df.columns:
+        raise ValueError(f"El archivo no tiene la columna {gas_type}")
+
+    # Convertir a UTC-5 (el archivo dice America/Bogota que es UTC-5)
+    out = pd.DataFrame({'timestamp': df['timestamp'].dt.tz_localize(UTC_MINUS_5)})
+
+    # Mantener las unidades originales (CH4 en ppb, CO2/H2O en ppm)
+    out['gas_concentration'] = df[gas_type]
+    out['gas_type'] = gas_type
+    out['gas_units'] = GAS_UNITS[gas_type]
+    return out.dropna()
+
+
+# -----------------------------
+# Merge
+# -----------------------------
+
+def _as_ns(ts: pd.Series) -> pd.Series:
+    return ts.dt.as_unit('ns') if hasattr(ts.dt, 'as_unit') else ts
+
+
+def merge_gps_and_gas_data(gps_df, gas_df, lag_s: float = 0.0, mode: str = 'nearest',
+                           max_gap_s: float = 5.0):
+    """
+    Merge GPS and gas analyzer data by matching timestamps.
+    lag_s: analyzer transport delay; gas timestamps are moved back by lag_s first,
+    so each concentration is matched to where the air entered the inlet.
+    mode: 'nearest' (one row per GPS fix, nearest analyzer sample within max_gap_s)
+    or 'interpolate' (one row per analyzer sample, see interpolate_gps_onto_gas).
+    """
+    if mode == 'interpolate':
+        return interpolate_gps_onto_gas(gps_df, gas_df, lag_s=lag_s, max_gap_s=max_gap_s)
+    if mode != 'nearest':
+        raise ValueError(f"Modo de combinación no válido: {mode}")
+
+    # Asegurarse de que ambos timestamps estén en UTC-5
+    gps_df['timestamp'] = pd.to_datetime(gps_df['timestamp'])
+    gas_df['timestamp'] = pd.to_datetime(gas_df['timestamp'])
+
+    gas_sorted = gas_df.sort_values('timestamp')
+    if lag_s:
+        gas_sorted = gas_sorted.assign(timestamp=gas_sorted['timestamp'] - pd.Timedelta(seconds=lag_s))
+    # merge_asof exige la misma resolución en ambas claves
+    gps_df['timestamp'] = _as_ns(gps_df['timestamp'])
+    gas_sorted['timestamp'] = _as_ns(gas_sorted['timestamp'])
+
+    # Merge asof (nearest timestamp matching)
+    merged_df = pd.merge_asof(
+        gps_df.sort_values('timestamp'),
+        gas_sorted,
+        on='timestamp',
+        direction='nearest',
+        tolerance=pd.Timedelta(seconds=max_gap_s)  # Tolerancia (5 s por defecto)
+    )
+
+    return merged_df.dropna()
+
+
+def interpolate_gps_onto_gas(gps_df, gas_df, lag_s: float = 0.0, max_gap_s: float = 5.0) -> pd.DataFrame:
+    """
+    Keep every analyzer sample and linearly interpolate GPS lat/lon/elevation onto its
+    (lag-corrected) timestamp with np.interp over int64 epoch nanoseconds, in one
+    vectorized pass (O(N + M), no per-row matching). Samples outside the GPS track or
+    inside a GPS gap longer than max_gap_s are dropped, since their position is unknown.
+    """
+    t_gps = _epoch_ns(gps_df['timestamp'])
+    order = np.argsort(t_gps, kind='stable')
+    t_gps = t_gps[order]
+
+    gas_sorted = gas_df.sort_values('timestamp', kind='stable')
+    t_gas = _epoch_ns(gas_sorted['timestamp']) - int(round(lag_s * 1e9))
+
+    # Posición del intervalo GPS que contiene cada muestra y su duración
+    idx = np.searchsorted(t_gps, t_gas, side='right')
+    inside = (idx > 0) & (idx < len(t_gps))
+    exact_end = t_gas == t_gps[-1]
+    lo = np.clip(idx - 1, 0, len(t_gps) - 1)
+    hi = np.clip(idx, 0, len(t_gps) - 1)
+    gap_ok = (t_gps[hi] - t_gps[lo]) <= int(max_gap_s * 1e9)
+    keep = (inside & gap_ok) | exact_end
+
+    t_keep = t_gas[keep]
+    out = {}
+    for col in ('lat', 'lon', 'elevation'):
+        out[col] = np.interp(t_keep, t_gps, gps_df[col].to_numpy(dtype=float)[order])
+
+    ts = pd.to_datetime(t_keep, unit='ns', utc=True)
+    tz = gas_sorted['timestamp'].dt.tz
+    merged = pd.DataFrame({'timestamp': ts.tz_convert(tz) if tz is not None else ts.tz_localize(None)})
+    for col in ('lat', 'lon', 'elevation'):
+        merged[col] = out[col]
+    for col in gas_sorted.columns:
+        if col != 'timestamp':
+            merged[col] = gas_sorted[col].to_numpy()[keep]
+    return merged.dropna().reset_index(drop=True)
+
+
+# -----------------------------
+# Analyzer lag (FFT cross-correlation)
+# -----------------------------
+
+def _epoch_ns(ts: pd.Series) -> np.ndarray:
+    """tz-aware or naive datetimes -> int64 nanoseconds since epoch (UTC)."""
+    ts = pd.to_datetime(ts)
+    if ts.dt.tz is not None:
+        ts = ts.dt.tz_convert('UTC')
+    return ts.dt.tz_localize(None).to_numpy(dtype='datetime64[ns]').astype(np.int64)
+
+
+def fft_cross_correlation(a: np.ndarray, b: np.ndarray, max_lag: int) -> np.ndarray:
+    """
+    r[k] = sum_t a[t] * b[t - k] for k = 0..max_lag, in O(N log N) via zero-padded FFTs.
+    A peak at k means `a` lags `b` by k samples.
+    """
+    n = len(a)
+    nfft = 1 << int(np.ceil(np.log2(max(2 * n, 2))))
+    spec = np.fft.rfft(a, nfft) * np.conj(np.fft.rfft(b, nfft))
+    return np.fft.irfft(spec, nfft)[:max_lag + 1]
+
+
+def estimate_analyzer_lag(gps_df: pd.DataFrame, gas_df: pd.DataFrame,
+                          max_lag_s: float = 60.0, length_scale_m: float = 15.0,
+                          iterations: int = 4, min_correlation: float = 0.1) -> Dict[str, Any]:
+    """
+    Estimate the analyzer delay by cross-correlating the enhancement series with a
+    spatial proxy, the vehicle's proximity exp(-d^2 / 2L^2) to the hot spot formed by
+    the top 5% samples. When those samples are elongated (a plume crossed at several
+    downwind distances) d is the distance to their principal axis, otherwise to their
+    enhancement-weighted centroid. Passes in opposite directions smear the hot spot
+    to opposite sides, so the axis/centroid is unbiased; it is re-estimated with the
+    current lag for a few iterations.
+
+    Both series are resampled onto a uniform grid at the analyzer rate; the
+    correlation over lags 0..max_lag_s uses FFTs (O(N log N)) and the peak is refined
+    with a parabolic fit. Returns {'lag_s', 'correlation', 'applied'}; 'applied' is
+    False (lag 0) when the normalised correlation peak is below min_correlation.
+    """
+    t_gps = _epoch_ns(gps_df['timestamp'])
+    order = np.argsort(t_gps)
+    t_gps = t_gps[order]
+    lat = gps_df['lat'].to_numpy(dtype=float)[order]
+    lon = gps_df['lon'].to_numpy(dtype=float)[order]
+    t_gas = _epoch_ns(gas_df['timestamp'])
+    order = np.argsort(t_gas)
+    t_gas = t_gas[order]
+    conc = gas_df['gas_concentration'].to_numpy(dtype=float)[order]
+
+    result = {'lag_s': 0.0, 'correlation': 0.0, 'applied': False}
+    if len(t_gas) < 10 or len(t_gps) < 10:
+        return result
+
+    dt_ns = max(int(np.median(np.diff(t_gas))), int(1e8))  # paso del analizador, mínimo 0.1 s
+    t0 = max(t_gas[0], t_gps[0])
+    t1 = min(t_gas[-1], t_gps[-1] + int(max_lag_s * 1e9))
+    if t1 - t0 < 10 * dt_ns:
+        return result
+    grid = np.arange(t0, t1, dt_ns, dtype=np.int64)
+    max_lag = int(max_lag_s * 1e9 // dt_ns)
+
+    c = np.interp(grid, t_gas, conc)
+    c = np.clip(c - np.quantile(c, 0.10), 0.0, None)
+    c_centered = c - c.mean()
+    if not np.any(c_centered):
+        return result
+    top = c >= np.quantile(c, 0.95)
+
+    lat_g = np.interp(grid, t_gps, lat)
+    lon_g = np.interp(grid, t_gps, lon)
+    ref_lat, ref_lon = float(lat_g.mean()), float(lon_g.mean())
+    xg, yg = latlon_to_local_xy(lat_g, lon_g, ref_lat, ref_lon)
+
+    lag_ns = 0
+    peak_corr = 0.0
+    for _ in range(iterations):
+        # Posición del vehículo cuando entró el aire de cada muestra caliente
+        xh, yh = latlon_to_local_xy(np.interp(grid[top] - lag_ns, t_gps, lat),
+                                    np.interp(grid[top] - lag_ns, t_gps, lon), ref_lat, ref_lon)
+        w = c[top] if c[top].sum() > 0 else np.ones(int(top.sum()))
+        cx, cy = np.average(xh, weights=w), np.average(yh, weights=w)
+        cov = np.cov(np.vstack([xh - cx, yh - cy]), aweights=w) if len(xh) > 2 else np.eye(2)
+        evals, evecs = np.linalg.eigh(np.atleast_2d(cov))
+        dx, dy = xg - cx, yg - cy
+        if evals[-1] > 4.0 * max(evals[0], 1e-9):
+            # Puntos calientes alineados (eje de la pluma): distancia perpendicular al eje
+            ax, ay = evecs[:, -1]
+            d2 = (dx * ay - dy * ax) ** 2
+        else:
+            d2 = dx ** 2 + dy ** 2
+        p = np.exp(-d2 / (2.0 * length_scale_m ** 2))
+        p_centered = p - p.mean()
+        if not np.any(p_centered):
+            return result
+
+        r = fft_cross_correlation(c_centered, p_centered, max_lag)
+        k = int(np.argmax(r))
+        norm = np.sqrt(np.sum(c_centered ** 2) * np.sum(p_centered ** 2))
+        peak_corr = float(r[k] / norm) if norm > 0 else 0.0
+        # Refinamiento sub-muestra (parábola por tres puntos)
+        frac = 0.0
+        if 0 < k < len(r) - 1:
+            denom = r[k - 1] - 2.0 * r[k] + r[k + 1]
+            if denom < 0:
+                frac = 0.5 * (r[k - 1] - r[k + 1]) / denom
+        new_lag_ns = int(round((k + frac) * dt_ns))
+        if new_lag_ns == lag_ns:
+            break
+        lag_ns = new_lag_ns
+
+    result['correlation'] = peak_corr
+    if peak_corr >= min_correlation:
+        result['lag_s'] = lag_ns / 1e9
+        result['applied'] = True
+    return result
+
+
+# -----------------------------
+# Background
+# -----------------------------
+
+class _CoordinateWindow(BaseIndexer):
+    """Centered variable-width window over a monotonic coordinate (seconds or meters)."""
+
+    def get_window_bounds(self, num_values=0, min_periods=None, center=None, closed=None, step=None):
+        coord = self.coord
+        start = np.searchsorted(coord, coord - self.half_width, side='left')
+        end = np.searchsorted(coord, coord + self.half_width, side='right')
+        return start.astype(np.int64), end.astype(np.int64)
+
+
+def cumulative_distance_m(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Along-track distance (m) from the first point."""
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    if len(lat) == 0:
+        return np.zeros(0)
+    x, y = latlon_to_local_xy(lat, lon, lat[0], lon[0])
+    return np.concatenate([[0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))])
+
+
+def rolling_background(merged_df: pd.DataFrame, mode: str = 'time', window: float = 300.0,
+                       quantile: float = 0.10) -> np.ndarray:
+    """
+    Per-sample background as a low quantile over a centered moving window, either
+    `window` seconds wide (mode='time') or `window` meters of track (mode='distance').
+    Uses pandas' skiplist rolling quantile with a variable-width window indexer,
+    O(N log w), instead of recomputing a quantile per window. Assumes merged_df is
+    sorted by timestamp (as returned by merge_gps_and_gas_data).
+    """
+    if mode == 'time':
+        coord = _epoch_ns(merged_df['timestamp']) / 1e9
+        coord = coord - coord[0] if len(coord) else coord
+    elif mode == 'distance':
+        coord = cumulative_distance_m(merged_df['lat'].to_numpy(), merged_df['lon'].to_numpy())
+    else:
+        raise ValueError(f"Modo de background no válido: {mode}")
+    indexer = _CoordinateWindow(coord=np.asarray(coord, dtype=float), half_width=window / 2.0)
+    conc = pd.Series(merged_df['gas_concentration'].to_numpy(dtype=float))
+    return conc.rolling(indexer, min_periods=1).quantile(quantile).to_numpy()
+
+
+def estimate_background(merged_df: pd.DataFrame, config: Optional[PipelineConfig] = None):
+    """Scalar (global mode) or per-sample array (time/distance modes) background."""
+    config = config or PipelineConfig()
+    if config.background_mode == 'global':
+        return float(merged_df['gas_concentration'].quantile(config.background_quantile))
+    window = config.background_window_s if config.background_mode == 'time' else config.background_window_m
+    return rolling_background(merged_df, config.background_mode, window, config.background_quantile)
+
+
+# -----------------------------
+# Model parameters and input frame
+# -----------------------------
+
+def _convex_hull(points: np.ndarray) -> np.ndarray:
+    """Monotone-chain convex hull of unique, lexicographically sorted 2-D points."""
+    def half(pts):
+        chain = []
+        for p in pts:
+            while len(chain) >= 2:
+                (ax, ay), (bx, by) = chain[-2], chain[-1]
+                if (bx - ax) * (p[1] - ay) - (by - ay) * (p[0] - ax) > 0:
+                    break
+                chain.pop()
+            chain.append(p)
+        return chain[:-1]
+    pts = [tuple(p) for p in points]
+    return np.array(half(pts) + half(pts[::-1]), dtype=float)
+
+
+def max_pairwise_distance(points, block: int = 1024) -> float:
+    """
+    Exact maximum Euclidean distance within a 2-D point set (same value as
+    max(pairwise_distances(points))), computed on the convex hull in O(N log N)
+    time and O(block * h) memory instead of an N x N matrix.
+    """
+    pts = np.unique(np.asarray(points, dtype=float), axis=0)  # sorted lexicographically
+    if len(pts) < 2:
+        return 0.0
+    hull = _convex_hull(pts) if len(pts) > 3 else pts
+    best = 0.0
+    for start in range(0, len(hull), block):
+        d = hull[start:start + block, None, :] - hull[None, :, :]
+        best = max(best, float(np.max(np.einsum('ijk,ijk->ij', d, d))))
+    return float(np.sqrt(best))
+
+
+def estimate_model_parameters(merged_df: pd.DataFrame) -> Dict[str, float]:
+    """
+    Heuristic background, source location and wind for a merged drive:
+    background = 10th percentile, source = max-concentration point,
+    wind direction from centroid->source vector, wind speed from survey extent.
+    """
+    conc = merged_df['gas_concentration']
+
+    # 1. BACKGROUND DINÁMICO: usar percentil 10 (más robusto que percentil 5)
+    background = float(conc.quantile(0.10))
+
+    # 2. UBICACIÓN DE LA FUENTE: usar el punto de MÁXIMA concentración
+    max_conc_idx = conc.idxmax()
+    source_lat = float(merged_df.loc[max_conc_idx, 'lat'])
+    source_lon = float(merged_df.loc[max_conc_idx, 'lon'])
+
+    # 3. DIRECCIÓN DEL VIENTO: vector desde centroide a máxima concentración
+    centroid_lat = float(merged_df['lat'].mean())
+    centroid_lon = float(merged_df['lon'].mean())
+    dlat = source_lat - centroid_lat
+    dlon = source_lon - centroid_lon
+    bearing_towards_source = (np.degrees(np.arctan2(dlon, dlat)) + 360) % 360
+    # El viento viene desde la dirección opuesta
+    wind_dir = float((bearing_towards_source + 180) % 360)
+
+    # 4. VELOCIDAD DEL VIENTO: estimar desde rango de distancias
+    x, y = latlon_to_local_xy(merged_df['lat'].to_numpy(dtype=float), merged_df['lon'].to_numpy(dtype=float),
+                              centroid_lat, centroid_lon)
+    max_distance_km = max_pairwise_distance(np.column_stack([x, y])) / 1000.0
+    # A mayor dispersión, mayor velocidad (heurística simple)
+    wind_speed = float(np.clip(1.0 + max_distance_km * 5, 1.0, 8.0))
+
+    return {
+        'background': background,
+        'source_lat': source_lat,
+        'source_lon': source_lon,
+        'centroid_lat': centroid_lat,
+        'centroid_lon': centroid_lon,
+        'wind_dir_from_deg': wind_dir,
+        'wind_speed_ms': wind_speed,
+        'max_distance_km': max_distance_km,
+    }
+
+
+def estimate_heights(merged_df: pd.DataFrame, params: Dict[str, float],
+                     config: Optional[PipelineConfig] = None):
+    """
+    Sensor height above ground (the model's z_m) for every sample, plus terrain info.
+
+    The GPS elevation is above sea level, so with a DEM (config.dem_path or DEM_PATH)
+    z = GPS elevation - ground elevation, clipped at 0. Samples the DEM does not cover,
+    or every sample without a DEM, use config.sensor_height_m. A DEM that cannot be
+    opened (missing path, unsupported raster) falls back to the fixed height, with the
+    reason in info['terrain_warning'].
+
+    The plume is terrain-following (simple terrain, as in the reflected-Gaussian model):
+    the sensor and source heights are both taken above their own ground, so the fixed
+    source_height_m is already on the sensors' reference and the ground elevation under
+    the source is not subtracted. It is reported, with ground_relief_m (median ground
+    under the samples minus ground under the source), to flag drives where the relief is
+    large compared with the plume depth and that assumption is doubtful.
+    Returns (z_m array, info dict).
+    """
+    config = config or PipelineConfig()
+    n = len(merged_df)
+    z = np.full(n, float(config.sensor_height_m))
+    info: Dict[str, Any] = {'terrain': 'fixed', 'dem_coverage': 0.0}
+    lat = merged_df['lat'].to_numpy(dtype=float)
+    lon = merged_df['lon'].to_numpy(dtype=float)
+    try:
+        dem = terrain.get_dem(config.dem_path)
+        if dem is None:
+            return z, info
+        ground = dem.elevation(lat, lon)
+        source_ground = dem.elevation(np.array([params['source_lat']]), np.array([params['source_lon']]))[0]
+    except (OSError, ValueError) as e:
+        # DEM mal configurado: se sigue con la altura fija en vez de abortar el análisis
+        info['terrain_warning'] = f'DEM no disponible, se usa la altura fija del sensor: {e}'
+        if config.verbose:
+            print(info['terrain_warning'])
+        return z, info
+    agl = merged_df['elevation'].to_numpy(dtype=float) - ground
+    covered = np.isfinite(agl)
+    z[covered] = np.maximum(agl[covered], 0.0)
+    source_ground_ok = bool(np.isfinite(source_ground))
+    info.update({
+        'terrain': 'dem',
+        'dem_coverage': float(covered.mean()) if n else 0.0,
+        'sensor_agl_median_m': float(np.median(z[covered])) if covered.any() else None,
+        'source_ground_elevation_m': float(source_ground) if source_ground_ok else None,
+        'ground_relief_m': (float(np.median(ground[covered]) - source_ground)
+                            if covered.any() and source_ground_ok else None),
+    })
+    return z, info
+
+
+def measured_meteorology(anemometer_path: str, merged_df: pd.DataFrame,
+                          config: Optional[PipelineConfig] = None):
+    """
+    Wind and stability measured by a sonic anemometer for every merged sample.
+
+    The log is block-averaged to the analyzer rate while it is read (anemometer.py) and
+    each sample takes the block containing its timestamp; turbulence windows give
+    sigma_theta, sigma_w and the Pasquill class. Returns (met_df aligned with merged_df,
+    NaN where the log has no data, info dict for params: mean wind, dominant class,
+    coverage and the windows). Raises PipelineError when the log does not cover the drive.
+    """
+    config = config or PipelineConfig()
+    t_ns = _epoch_ns(merged_df['timestamp'])
+    block_s = config.anemometer_block_s or anemometer.sample_period_s(t_ns)
+    try:
+        # Posición del recorrido para separar ventanas diurnas y nocturnas (altura del sol)
+        met = anemometer.read_anemometer(anemometer_path, block_s=block_s,
+                                         window_s=config.anemometer_window_s, tz=UTC_MINUS_5,
+                                         dir_offset_deg=config.anemometer_dir_offset_deg,
+                                         lat=float(merged_df['lat'].median()),
+                                         lon=float(merged_df['lon'].median()))
+    except ValueError as e:
+        raise PipelineError(str(e), 'Use un registro CSV con tiempo y componentes u, v, w del anemómetro sónico.')
+    met_df = anemometer.align_to_samples(met['blocks'], t_ns, block_s)
+    covered = met_df['wind_speed_ms'].notna().to_numpy()
+    if covered.sum() < config.min_points:
+        blocks = met['blocks'].index
+        raise PipelineError(
+            f'El registro del anemómetro cubre solo {int(covered.sum())} de {len(merged_df)} muestras del recorrido.',
+            'Verifica que el anemómetro haya registrado durante la medición y la zona horaria de su reloj.',
+            details={
+                'anemometer_time_range': f"{pd.Timestamp(blocks[0], tz='UTC')} a {pd.Timestamp(blocks[-1], tz='UTC')}",
+                'drive_time_range': f"{merged_df['timestamp'].min()} a {merged_df['timestamp'].max()}",
+            })
+
+    speed = met_df['wind_speed_ms'].to_numpy(dtype=float)[covered]
+    theta = np.radians(met_df['wind_dir_from_deg'].to_numpy(dtype=float)[covered])
+    classes = met_df['stability'][covered].dropna().value_counts()
+    info = {
+        'met_source': 'anemometer',
+        'wind_speed_ms': float(np.mean(speed)),
+        'wind_dir_from_deg': float((np.degrees(np.arctan2(np.mean(speed * np.sin(theta)),
+                                                          np.mean(speed * np.cos(theta)))) + 360.0) % 360.0),
+        'stability_measured': str(classes.index[0]) if len(classes) else None,
+        'met_coverage': float(covered.mean()),
+        'anemometer_rate_hz': met['rate_hz'],
+        'anemometer_block_s': met['block_s'],
+        'anemometer_window_s': met['window_s'],
+        'met_windows': anemometer.summarize_windows(met['windows']),
+    }
+    return met_df, info
+
+
+def build_model_frame(merged_df: pd.DataFrame, params: Dict[str, float],
+                      source_height_m: float = 2.0, background=None, z_m=None,
+                      met: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    Build the gaussian_ch4 input frame and apply the statistical filters.
+    background: scalar or per-sample array (see estimate_background); defaults to params['background'].
+    z_m: sensor height above ground (see estimate_heights); defaults to the raw GPS elevation.
+    met: measured meteorology aligned with merged_df (see measured_meteorology); per-sample
+    wind speed, direction and stability replace the estimated ones, samples without
+    measurements are dropped and the sigma_theta_deg / sigma_w_ms columns are added.
+    Per-run constants (source position and height, and without `met` the wind direction and
+    stability) are kept once in df.attrs instead of as constant columns; read them with
+    gaussian_ch4.frame_value.
+    """
+    if background is None:
+        background = params['background']
+    if z_m is None:
+        z_m = merged_df['elevation']
+    conc = merged_df['gas_concentration'].to_numpy(dtype=float)
+    background = np.broadcast_to(np.asarray(background, dtype=float), conc.shape)
+    wind_speed = (met['wind_speed_ms'].to_numpy(dtype=float) if met is not None
+                  else np.full(conc.shape, float(params['wind_speed_ms'])))
+
+    # Filtros estadísticos antes de construir el marco: una sola copia de las filas que quedan
+    # Filtro 1: eliminar datos sin gradiente apreciable (0.1% sobre background)
+    keep = conc > background * 1.001
+    # Filtro 2: eliminar datos con viento MUY bajo (o sin medición del anemómetro)
+    keep &= wind_speed > 0.3
+    if met is not None:
+        keep &= met['stability'].notna().to_numpy()
+
+    conc = conc[keep]
+    df = pd.DataFrame({
+        'lat': merged_df['lat'].to_numpy(dtype=float)[keep],
+        'lon': merged_df['lon'].to_numpy(dtype=float)[keep],
+        'z_m': np.asarray(z_m, dtype=float)[keep],
+        'ch4_ppm': conc,  # Usamos esta columna independiente del gas
+        'gas_concentration': conc,
+        'background_ppm': background[keep],
+        'wind_speed_ms': wind_speed[keep],
+    }, index=merged_df.index[keep], copy=False)
+    # Constantes del recorrido: un valor, no una columna por fila
+    df.attrs.update({
+        'source_lat': float(params['source_lat']),
+        'source_lon': float(params['source_lon']),
+        'source_height_m': float(source_height_m),
+    })
+    if met is None:
+        df.attrs.update({'wind_dir_from_deg': float(params['wind_dir_from_deg']),
+                         'stability': 'D'})  # Estabilidad neutral
+    else:
+        met = met[keep]
+        df['wind_dir_from_deg'] = met['wind_dir_from_deg'].to_numpy(dtype=float)
+        df['stability'] = met['stability'].to_numpy()
+        df['sigma_theta_deg'] = met['sigma_theta_deg'].to_numpy(dtype=float)
+        df['sigma_w_ms'] = met['sigma_w_ms'].to_numpy(dtype=float)
+    return df
+
+
+def has_measured_meteorology(df: pd.DataFrame) -> bool:
+    """True for model frames built with measured_meteorology (per-sample stability)."""
+    return 'sigma_theta_deg' in df.columns
+
+
+# -----------------------------
+# Configuration search
+# -----------------------------
+
+# selection_criterion -> score de preprocess_and_invert que se maximiza
+SELECTION_SCORES = {'kfold': 'Q2_kfold', 'loo': 'Q2_loo', 'r2': 'R2'}
+
+def search_best_configuration(df: pd.DataFrame, config: Optional[PipelineConfig] = None):
+    """
+    Try every (stability, sector) combination with preprocess_and_invert and keep the
+    best config.selection_criterion score among fits with at least config.min_points
+    points and R² >= -0.5. The cross-validated scores (closed form, no refits) penalize
+    configurations whose sector keeps only a few easy points, which in-sample R² favors.
+    With config.robust_loss the fits are robust and R² is weighted (outliers excluded).
+    With the 'kfold' criterion, configurations with degenerate folds (cv_degenerate_folds,
+    see gaussian_ch4.cross_validation_scores) are recorded in trials but not selected; when
+    every candidate has them (the plume is seen in a single block of the drive) the search
+    falls back to 'loo' and reports it in selection_criterion.
+    Frames with measured meteorology (see build_model_frame) keep their per-sample
+    stability: only the sectors are searched and results get stability_source='anemometer'.
+    Returns (best_results or None, trials, last_error_message).
+    """
+    config = config or PipelineConfig()
+    if config.selection_criterion not in SELECTION_SCORES:
+        raise ValueError(f"Criterio de selección no válido: {config.selection_criterion}")
+    best_results = None
+    candidates = []
+    error_msg = ""
+    trials = []
+    # La proyección no depende de la estabilidad ni del sector: calcularla una sola vez
+    local_xy = source_local_xy(df) if len(df) else None
+    measured = has_measured_meteorology(df)
+
+    for stability in ([None] if measured else config.stability_classes):
+        for sector_width in config.sector_widths:
+            try:
+                temp_results = preprocess_and_invert(df,
+                                                     stability_override=stability,
+                                                     wind_sector_half_width_deg=sector_width,
+                                                     loss=config.robust_loss,
+                                                     local_xy=local_xy,
+                                                     cv_folds=config.cv_folds)
+            except Exception as e:
+                error_msg = str(e)
+                continue
+
+            trials.append({
+                'stability': temp_results['stability_used'],
+                'sector_half_width_deg': sector_width,
+                'n_points': temp_results['n_points'],
+                'R2': temp_results['R2'],
+                'Q2_loo': temp_results['Q2_loo'],
+                'Q2_kfold': temp_results['Q2_kfold'],
+                'cv_degenerate_folds': temp_results['cv_degenerate_folds'],
+                'Q_hat_gph': temp_results['Q_hat_gph'],
+                'Q_std_gph': temp_results['Q_std_gph'],
+            })
+            # Q_std infinito: los puntos no ven la pluma (ver gaussian_ch4.SUM_GG_TOL)
+            if temp_results['n_points'] >= config.min_points and np.isfinite(temp_results['Q_std_gph']):
+                r2 = temp_results['R2']
+                if config.verbose:
+                    print(f"Estabilidad={temp_results['stability_used']}, Sector={sector_width}° → R²={r2:.3f}, "
+                          f"Q²cv={temp_results['Q2_kfold']:.3f}, Q²loo={temp_results['Q2_loo']:.3f}, "
+                          f"n={temp_results['n_points']}, Q={temp_results['Q_hat_gph']:.1f} g/h"
+                          + (f" ({temp_results['cv_degenerate_folds']} bloques degenerados)"
+                             if temp_results['cv_degenerate_folds'] else ""))
+                if r2 >= -0.5:
+                    temp_results['sector_half_width_deg'] = sector_width
+                    candidates.append(temp_results)
+
+    # Un bloque que concentra casi toda la señal deja el Q²cv sin sentido: se descartan esas
+    # configuraciones y, si lo son todas, se usa dejar-uno-fuera
+    criterion = config.selection_criterion
+    if criterion == 'kfold':
+        valid = [c for c in candidates if not c['cv_degenerate_folds']]
+        if candidates and not valid:
+            criterion = 'loo'
+            if config.verbose:
+                print("Todas las configuraciones tienen bloques degenerados: se elige por Q²loo")
+        else:
+            candidates = valid
+    score_key = SELECTION_SCORES[criterion]
+    for temp_results in candidates:
+        if best_results is None or temp_results[score_key] > best_results[score_key]:
+            best_results = temp_results
+    if best_results is not None:
+        best_results['stability_source'] = 'anemometer' if measured else 'search'
+        best_results['selection_criterion'] = criterion
+
+    return best_results, trials, error_msg
+
+
+def compute_fit_metrics(observed, predicted) -> Dict[str, float]:
+    """MAE, MSE, RMSE and MAPE (%) between observed and predicted anomalies."""
+    observed = np.asarray(observed, dtype=float)
+    predicted = np.asarray(predicted, dtype=float)
+    err = observed - predicted
+    mse = float(np.mean(err ** 2))
+    # MAPE - evitar división por cero
+    nz = observed != 0
+    mape = float(np.mean(np.abs(err[nz] / observed[nz])) * 100) if np.any(nz) else 0.0
+    return {
+        'MAE': float(np.mean(np.abs(err))),
+        'MSE': mse,
+        'RMSE': float(np.sqrt(mse)),
+        'MAPE': mape,
+    }
+
+
+# -----------------------------
+# Transects (plume crossings)
+# -----------------------------
+
+def segment_transects(merged_df: pd.DataFrame, background, threshold_sigma: float = 3.0,
+                      turn_deg: float = 90.0, max_gap_s: float = 10.0, pad: int = 3,
+                      turn_window: int = 5, min_points: int = 5) -> np.ndarray:
+    """
+    Label plume crossings in one vectorized pass over the time-ordered merged series.
+
+    A sample is in-plume when its enhancement over `background` (scalar or per-sample)
+    exceeds the median enhancement by threshold_sigma robust (MAD) standard deviations;
+    in-plume runs are widened by `pad` samples to keep the plume flanks. A crossing ends
+    at the end of a run, at a time gap > max_gap_s or where the heading turns by more
+    than turn_deg over `turn_window` samples (U-turns inside the plume).
+    Returns transect ids (0, 1, ...) aligned with merged_df, -1 outside any crossing
+    or in runs shorter than min_points.
+    """
+    n = len(merged_df)
+    conc = merged_df['gas_concentration'].to_numpy(dtype=float)
+    enh = conc - np.broadcast_to(np.asarray(background, dtype=float), (n,))
+    med = float(np.nanmedian(enh))
+    sigma = 1.4826 * float(np.nanmedian(np.abs(enh - med)))
+    hot = enh > med + threshold_sigma * max(sigma, 1e-9)
+    inside = np.convolve(hot.astype(float), np.ones(2 * pad + 1), mode='same') > 0
+
+    breaks = np.zeros(n, dtype=bool)
+    # Huecos de tiempo
+    t_s = _epoch_ns(merged_df['timestamp']) / 1e9
+    breaks[1:] |= np.diff(t_s) > max_gap_s
+    # Cambios de rumbo (solo pasos > 0.5 m; detenido se conserva el rumbo anterior)
+    lat = merged_df['lat'].to_numpy(dtype=float)
+    lon = merged_df['lon'].to_numpy(dtype=float)
+    if n:
+        # Proyección local del recorrido (gaussian_ch4.LocalProjection): rumbos y pasos en metros
+        x, y = latlon_to_local_xy(lat, lon, np.nanmedian(lat), np.nanmedian(lon))
+    else:
+        x = y = lat
+    dx, dy = np.diff(x), np.diff(y)
+    heading = np.where(np.hypot(dx, dy) > 0.5, np.degrees(np.arctan2(dx, dy)), np.nan)
+    heading = pd.Series(heading).ffill().bfill().to_numpy()
+    if heading.size > turn_window:
+        turn = np.zeros(n, dtype=bool)
+        dh = np.abs((heading[turn_window:] - heading[:-turn_window] + 180.0) % 360.0 - 180.0)
+        turn[turn_window + 1:] = dh > turn_deg
+        # Un solo corte por giro (flanco de subida)
+        breaks[1:] |= turn[1:] & ~turn[:-1]
+
+    prev_inside = np.concatenate(([False], inside[:-1]))
+    starts = inside & (~prev_inside | breaks)
+    ids = np.cumsum(starts) - 1
+    ids[~inside] = -1
+
+    # Descartar cruces demasiado cortos y renumerar
+    if np.any(ids >= 0):
+        counts = np.bincount(ids[ids >= 0])
+        keep = counts >= min_points
+        remap = np.where(keep, np.cumsum(keep) - 1, -1)
+        ids = np.where(ids >= 0, remap[np.maximum(ids, 0)], -1)
+    return ids
+
+
+def transect_estimates(model_df: pd.DataFrame, transect_ids: np.ndarray,
+                       stability: Optional[str], sector_half_width_deg: float,
+                       return_total: bool = False, weights: Optional[np.ndarray] = None):
+    """
+    Single-source fit per transect with the chosen stability (None: the frame's per-sample
+    classes) and sector, from grouped
+    sufficient statistics (one bincount per statistic instead of one solve per
+    transect; each estimator equals invert_emission_rate on that transect's points).
+    transect_ids is aligned with model_df rows; returns one estimator per id, plus the
+    estimator over every in-sector point (the full fit) if return_total.
+    weights: per-row weights aligned with model_df (gaussian_ch4.fit_row_weights of a
+    robust fit), so the transect and total fits use the same loss as that fit; None is L2.
+    """
+    transect_ids = np.asarray(transect_ids)
+    k = int(transect_ids.max()) + 1 if transect_ids.size else 0
+    inp = wind_frame_inputs(model_df, stability, sector_half_width_deg)
+    sel = inp['mask']
+    G = plume_kernel(inp['xw'][sel], inp['yw'][sel], inp['z'][sel], inp['u'][sel], inp['H'],
+                     inp['sigy'][sel], inp['sigz'][sel])
+    yv = inp['dC'][sel]
+    ids = transect_ids[sel]
+    w = np.ones(G.size) if weights is None else np.asarray(weights, dtype=float)[sel]
+    ok = np.isfinite(G)
+    G, yv, ids, w = G[ok], yv[ok], ids[ok], w[ok]
+    wG, wy = w * G, w * yv
+    total = StreamingEmissionEstimator(H_m=inp['H'], stability=inp['stability'], n=int(G.size),
+                                       sum_gg=float(wG @ G), sum_gy=float(wG @ yv),
+                                       sum_y=float(wy.sum()), sum_yy=float(wy @ yv),
+                                       sum_w=float(w.sum()))
+
+    estimators = []
+    if k > 0:
+        in_tr = ids >= 0
+        G, yv, ids, w, wG, wy = G[in_tr], yv[in_tr], ids[in_tr], w[in_tr], wG[in_tr], wy[in_tr]
+        n = np.bincount(ids, minlength=k)
+        sum_gg = np.bincount(ids, weights=wG * G, minlength=k)
+        sum_gy = np.bincount(ids, weights=wG * yv, minlength=k)
+        sum_y = np.bincount(ids, weights=wy, minlength=k)
+        sum_yy = np.bincount(ids, weights=wy * yv, minlength=k)
+        sum_w = np.bincount(ids, weights=w, minlength=k)
+        estimators = [StreamingEmissionEstimator(H_m=inp['H'], stability=inp['stability'], n=int(n[i]),
+                                                 sum_gg=float(sum_gg[i]), sum_gy=float(sum_gy[i]),
+                                                 sum_y=float(sum_y[i]), sum_yy=float(sum_yy[i]),
+                                                 sum_w=float(sum_w[i]))
+                      for i in range(k)]
+    return (estimators, total) if return_total else estimators
+
+
+def transect_accepted(est: StreamingEmissionEstimator, total_sum_gg: float,
+                      config: Optional[PipelineConfig] = None) -> bool:
+    """
+    Whether a transect fit is trusted enough to be pooled: identifiable, with
+    >= max(transect_min_points, transect_min_fit_points) points, at least
+    transect_min_gg_fraction of the full fit's sum G^2 (total_sum_gg), Q > 0 with
+    Q_std/Q <= transect_max_rel_std, and R² >= transect_min_r2.
+    """
+    config = config or PipelineConfig()
+    if not est.identifiable or est.n < max(config.transect_min_points, config.transect_min_fit_points):
+        return False
+    if est.sum_gg < config.transect_min_gg_fraction * total_sum_gg:
+        return False
+    q = est.Q_hat
+    return bool(q > 0 and est.Q_std <= config.transect_max_rel_std * q
+                and est.r2 >= config.transect_min_r2)
+
+
+def combine_transects(transects: List[Dict[str, Any]], exclude=None) -> Dict[str, Any]:
+    """
+    Combined estimate over the transects not listed in `exclude` (transect ids).
+    Least squares: the accepted transects' sufficient statistics are merged, so the pooled
+    fit equals a joint fit over those crossings; the spread of per-transect Q is reported too.
+    Mass balance: median and mean of the per-transect crosswind-integrated Q.
+    """
+    exclude = {int(i) for i in (exclude or [])}
+    kept = [t for t in transects if t['transect'] not in exclude]
+    # Los cruces guardados antes de transect_accepted() pueden traer accepted con Q no identificable
+    used = [t for t in kept if t['accepted'] and StreamingEmissionEstimator(**t['stats']).identifiable]
+    out: Dict[str, Any] = {'n_transects': len(used), 'transects_used': [t['transect'] for t in used],
+                           'excluded': sorted(exclude)}
+    q_mb = np.array([t['Q_mb_gps'] for t in kept if t.get('Q_mb_gps') is not None])
+    if q_mb.size:
+        out.update({
+            'n_transects_mb': int(q_mb.size),
+            'Q_mb_median_gph': float(np.median(q_mb) * 3600.0),
+            'Q_mb_mean_gph': float(np.mean(q_mb) * 3600.0),
+        })
+    if not used:
+        return out
+    pooled = StreamingEmissionEstimator(**used[0]['stats'])
+    for t in used[1:]:
+        pooled.merge(StreamingEmissionEstimator(**t['stats']))
+    q = np.array([t['Q_hat_gps'] for t in used])
+    out.update({
+        'n_points': pooled.n,
+        'Q_hat_gps': pooled.Q_hat,
+        'Q_std_gps': pooled.Q_std,
+        'Q_hat_gph': pooled.Q_hat * 3600.0,
+        'Q_std_gph': pooled.Q_std * 3600.0,
+        'R2': pooled.r2,
+        'Q_median_gph': float(np.median(q) * 3600.0),
+        'Q_spread_gph': float(q.std(ddof=1) * 3600.0) if q.size > 1 else 0.0,
+    })
+    return out
+
+
+def mass_balance_transects(merged_df: pd.DataFrame, params: Dict[str, float], background,
+                           transect_ids: np.ndarray, stability: str = 'D',
+                           source_height_m: float = 2.0, z_m=None) -> Dict[str, np.ndarray]:
+    """
+    Crosswind-integrated Q per transect (gaussian_ch4.crosswind_integrated_emission) over
+    every sample of each crossing, including those below background: no sector filter and
+    no stability search, only sigma_z of the given class. z_m as in build_model_frame.
+    """
+    if z_m is None:
+        z_m = merged_df['elevation']
+    z_m = np.asarray(z_m, dtype=float)
+    x_local, y_local = latlon_to_local_xy(merged_df['lat'].to_numpy(dtype=float),
+                                          merged_df['lon'].to_numpy(dtype=float),
+                                          params['source_lat'], params['source_lon'])
+    xw, yw = rotate_to_wind_frame(x_local, y_local, params['wind_dir_from_deg'])
+    conc = merged_df['gas_concentration'].to_numpy(dtype=float)
+    dC = conc - np.broadcast_to(np.asarray(background, dtype=float), conc.shape)
+    u = np.full(conc.shape, params['wind_speed_ms'])
+    return crosswind_integrated_emission(xw, yw, z_m, u, source_height_m, dC, transect_ids, stability)
+
+
+def analyze_transects(merged_df: pd.DataFrame, model_df: pd.DataFrame, background,
+                      params: Dict[str, float], best_results: Optional[Dict[str, Any]] = None,
+                      config: Optional[PipelineConfig] = None, z_m=None) -> Dict[str, Any]:
+    """
+    Segment the drive into plume crossings and estimate Q on each one twice: least squares
+    with the best configuration (stability and sector of best_results, skipped without a
+    fit) and the crosswind-integrated mass balance (with the best stability, else D).
+    Returns {'transect_ids' (aligned with merged_df), 'transects': [...], 'combined': {...},
+    'loss'}: the least-squares fits reuse the best fit's robust weights, so they share its loss.
+    A transect is accepted per transect_accepted() (points, share of the full fit's sum G^2,
+    relative Q_std, R²); combine_transects() can recombine with other exclusions later.
+    z_m: sensor heights aligned with merged_df (see estimate_heights).
+    """
+    config = config or PipelineConfig()
+    ids = segment_transects(merged_df, background, config.transect_threshold_sigma,
+                            config.transect_turn_deg, config.transect_max_gap_s,
+                            min_points=config.transect_min_points)
+    stability = best_results['stability_used'] if best_results is not None else 'D'
+    mb = mass_balance_transects(merged_df, params, background, ids, stability, config.source_height_m,
+                                z_m=z_m)
+    estimators: List[Optional[StreamingEmissionEstimator]] = [None] * len(mb['Q_gps'])
+    if best_results is not None:
+        ids_model = pd.Series(ids, index=merged_df.index).reindex(model_df.index).fillna(-1).to_numpy(dtype=int)
+        fit_stability = None if best_results.get('stability_source') == 'anemometer' else stability
+        # Misma pérdida que el mejor ajuste: sus pesos IRLS finales (None con L2)
+        row_w = fit_row_weights(model_df, best_results, fit_stability, best_results['sector_half_width_deg'])
+        fitted, total = transect_estimates(model_df, ids_model, fit_stability,
+                                           best_results['sector_half_width_deg'], return_total=True,
+                                           weights=row_w)
+        estimators[:len(fitted)] = fitted
+
+    enh = merged_df['gas_concentration'].to_numpy(dtype=float) - \
+        np.broadcast_to(np.asarray(background, dtype=float), (len(merged_df),))
+    timestamps = merged_df['timestamp']
+    transects = []
+    for i, est in enumerate(estimators):
+        rows = np.flatnonzero(ids == i)
+        q_mb = float(mb['Q_gps'][i]) if np.isfinite(mb['Q_gps'][i]) else None
+        item = {
+            'transect': i,
+            'time_start': str(timestamps.iloc[rows[0]]),
+            'time_end': str(timestamps.iloc[rows[-1]]),
+            'n_samples': int(rows.size),
+            'peak_enhancement': float(np.nanmax(enh[rows])),
+            'x_mean_m': float(mb['x_m'][i]) if np.isfinite(mb['x_m'][i]) else None,
+            'Q_mb_gps': q_mb,
+            'Q_mb_gph': q_mb * 3600.0 if q_mb is not None else None,
+            'n_points': 0,
+            'accepted': False,
+            'stats': None,
+        }
+        if est is not None:
+            # Sin señal de la pluma el Q del cruce no está determinado (Q_std null en el JSON)
+            q_std = est.Q_std if est.identifiable else None
+            item.update({
+                'n_points': est.n,
+                'identifiable': est.identifiable,
+                'Q_hat_gps': est.Q_hat,
+                'Q_std_gps': q_std,
+                'Q_hat_gph': est.Q_hat * 3600.0,
+                'Q_std_gph': q_std * 3600.0 if q_std is not None else None,
+                'R2': est.r2,
+                'gg_fraction': est.sum_gg / total.sum_gg if total.identifiable else 0.0,
+                'accepted': transect_accepted(est, total.sum_gg, config),
+                'stats': asdict(est),
+            })
+        transects.append(item)
+    return {'transect_ids': ids, 'transects': transects, 'combined': combine_transects(transects),
+            'loss': best_results.get('loss', 'l2') if best_results is not None else 'l2'}
+
+
+# -----------------------------
+# End-to-end
+# -----------------------------
+
+def load_and_merge(data_path: str, gpx_path: str,
+                   config: Optional[PipelineConfig] = None):
+    """
+    Parse both instrument files, estimate (or apply the configured) analyzer lag and
+    merge them. Returns (gps_df, gas_df, merged_df, merge_info) where merge_info holds
+    the applied lag. Raises PipelineError for input problems (empty files, no overlap, too few points).
+    """
+    config = config or PipelineConfig()
+    gas_type = config.gas_type
+
+    try:
+        gps_df = parse_gpx_file(gpx_path)
+    except Exception as e:
+        raise PipelineError(f'Error al leer el archivo GPS: {str(e)}',
+                            'Asegúrate de que el archivo .gpx esté en formato válido GPX 1.1')
+    if len(gps_df) == 0:
+        raise PipelineError('El archivo GPS no contiene puntos de rastreo válidos.',
+                            'Verifica que el archivo .gpx contenga datos de track válidos con coordenadas y timestamps.')
+
+    try:
+        gas_df = parse_data_file(data_path, gas_type, verbose=config.verbose)
+    except ValueError as e:
+        raise PipelineError(f'Error al leer el archivo del analizador: {str(e)}',
+                            'Asegúrate de que el archivo .data sea del formato LI-7810 con header DATAH.')
+    except Exception as e:
+        raise PipelineError(f'Error inesperado al procesar el archivo .data: {str(e)}',
+                            'Verifica que el archivo esté completo y no esté corrupto.')
+    if len(gas_df) == 0:
+        raise PipelineError(f'El archivo .data no contiene mediciones válidas de {gas_type}.',
+                            f'Verifica que el archivo contenga datos de {gas_type} del analizador LI-7810.')
+
+    return merge_inputs(gps_df, gas_df, config)
+
+
+def load_and_merge_binary(payload_path: str, config: Optional[PipelineConfig] = None):
+    """
+    Same as load_and_merge for a drive pre-parsed in the browser (see binary_upload.py):
+    the typed arrays are read with np.frombuffer, without text parsing.
+    Returns (gps_df, gas_df, merged_df, merge_info); merge_info also holds the original
+    file names under 'data_filename' / 'gpx_filename'.
+    """
+    config = config or PipelineConfig()
+    gas_type = config.gas_type
+    if gas_type not in GAS_UNITS:
+        raise PipelineError(f'Tipo de gas no válido: {gas_type}')
+
+    with open(payload_path, 'rb') as f:
+        payload = f.read()
+    try:
+        gps_df, gas_df, info = binary_upload.decode(payload, UTC_MINUS_5)
+    except (ValueError, KeyError, TypeError) as e:
+        raise PipelineError(f'Error al leer los datos pre-procesados: {str(e)}',
+                            'Vuelve a cargar los archivos .data y .gpx originales sin el pre-procesado en el navegador.')
+    if info['gas_type'] != gas_type:
+        raise PipelineError(f"Los datos pre-procesados son de {info['gas_type']}, no de {gas_type}.",
+                            'Vuelve a procesar los archivos con el gas seleccionado.')
+    check_parsed_inputs(gps_df, gas_df, gas_type)
+    gas_df['gas_units'] = GAS_UNITS[gas_type]
+
+    gps_df, gas_df, merged_df, merge_info = merge_inputs(gps_df, gas_df, config)
+    merge_info.update(data_filename=info['data_filename'], gpx_filename=info['gpx_filename'])
+    return gps_df, gas_df, merged_df, merge_info
+
+
+def load_saved_merge(merged_path: str, config: Optional[PipelineConfig] = None):
+    """
+    Re-analyze a merge exported as Parquet / Arrow (see columnar_export.py) without
+    re-parsing the instrument files. Returns (None, None, merged_df, merge_info) like
+    load_and_merge; merge_info is the one stored with the export (analyzer lag, file names).
+    """
+    config = config or PipelineConfig()
+    gas_type = config.gas_type
+    try:
+        merged_df, meta = columnar_export.read_merged(merged_path)
+    except (ValueError, OSError) as e:
+        raise PipelineError(f'Error al leer la combinación guardada: {str(e)}',
+                            'Usa un archivo exportado desde "Exportar datos" (tabla merged, .parquet o .arrow).')
+    saved_gas = meta.get('gas_type', gas_type)
+    if saved_gas != gas_type:
+        raise PipelineError(f'La combinación guardada es de {saved_gas}, no de {gas_type}.',
+                            'Selecciona el mismo gas con el que se exportó.')
+
+    merged_df['timestamp'] = pd.to_datetime(merged_df['timestamp'])
+    if merged_df['timestamp'].dt.tz is None:
+        merged_df['timestamp'] = merged_df['timestamp'].dt.tz_localize(UTC_MINUS_5)
+    merged_df = merged_df.dropna(subset=['timestamp', 'lat', 'lon', 'gas_concentration'])
+    merged_df = merged_df.sort_values('timestamp', kind='stable').reset_index(drop=True)
+    if len(merged_df) < config.min_points:
+        raise PipelineError(
+            f'Insuficientes puntos combinados ({len(merged_df)}). Se necesitan al menos {config.min_points} puntos para el análisis.')
+
+    merge_info = {'merge_mode': 'saved', 'analyzer_lag_s': 0.0, 'lag_correlation': None,
+                  'lag_estimated': False, **meta.get('merge_info', {})}
+    return None, None, merged_df, merge_info
+
+
+def check_parsed_inputs(gps_df: pd.DataFrame, gas_df: pd.DataFrame, gas_type: str) -> None:
+    """Raise PipelineError when either parsed input has no usable rows."""
+    if len(gps_df) == 0:
+        raise PipelineError('El archivo GPS no contiene puntos de rastreo válidos.',
+                            'Verifica que el archivo .gpx contenga datos de track válidos con coordenadas y timestamps.')
+    if len(gas_df) == 0:
+        raise PipelineError(f'El archivo .data no contiene mediciones válidas de {gas_type}.',
+                            f'Verifica que el archivo contenga datos de {gas_type} del analizador LI-7810.')
+
+
+def merge_inputs(gps_df: pd.DataFrame, gas_df: pd.DataFrame, config: Optional[PipelineConfig] = None):
+    """Estimate (or apply) the analyzer lag and merge parsed GPS and analyzer frames."""
+    config = config or PipelineConfig()
+    if config.analyzer_lag_s is None:
+        lag = estimate_analyzer_lag(gps_df, gas_df, max_lag_s=config.max_lag_s)
+    else:
+        lag = {'lag_s': float(config.analyzer_lag_s), 'correlation': None, 'applied': True}
+    merge_info = {
+        'merge_mode': config.merge_mode,
+        'analyzer_lag_s': lag['lag_s'],
+        'lag_correlation': lag['correlation'],
+        'lag_estimated': config.analyzer_lag_s is None,
+    }
+    merged_df = merge_gps_and_gas_data(gps_df, gas_df, lag_s=lag['lag_s'],
+                                       mode=config.merge_mode, max_gap_s=config.max_gap_s)
+    if len(merged_df) == 0:
+        raise PipelineError(
+            'No se pudieron combinar los datos GPS y del analizador. Verifica que los archivos correspondan al mismo período de tiempo.',
+            details={
+                'gps_points': len(gps_df),
+                'gas_points': len(gas_df),
+                'gps_time_range': f"{gps_df['timestamp'].min()} a {gps_df['timestamp'].max()}",
+                'gas_time_range': f"{gas_df['timestamp'].min()} a {gas_df['timestamp'].max()}",
+            })
+    if len(merged_df) < config.min_points:
+        raise PipelineError(
+            f'Insuficientes puntos combinados ({len(merged_df)}). Se necesitan al menos {config.min_points} puntos para el análisis.',
+            'Verifica que los archivos GPS y del analizador se hayan grabado al mismo tiempo.')
+
+    return gps_df, gas_df, merged_df, merge_info
+
+
+def run_pipeline(data_path: str, gpx_path: str,
+                 config: Optional[PipelineConfig] = None,
+                 anemometer_path: Optional[str] = None,
+                 profile_memory: bool = False) -> Dict[str, Any]:
+    """
+    Full flow for one drive. Returns a dict with merged_df, merge_info, model_df, params,
+    results (best fit + metrics, or None), trials, last_error and transects
+    (see analyze_transects).
+    anemometer_path: sonic anemometer log; its wind and stability replace the estimated
+    ones (see measured_meteorology) and the stability search is skipped.
+    profile_memory: add the tracemalloc peak of each stage under 'memory' (see memory_profile.py).
+    Raises PipelineError for input problems (see load_and_merge).
+    """
+    config = config or PipelineConfig()
+    mem = StageMemory(profile_memory)
+    try:
+        mem.stage('parse_merge')
+        _, _, merged_df, merge_info = load_and_merge(data_path, gpx_path, config)
+        mem.stage('model_frame')
+        params = estimate_model_parameters(merged_df)
+        met_df = None
+        if anemometer_path:
+            met_df, met_info = measured_meteorology(anemometer_path, merged_df, config)
+            params.update(met_info)
+        z_m, terrain_info = estimate_heights(merged_df, params, config)
+        params.update(terrain_info)
+        background = estimate_background(merged_df, config)
+        model_df = build_model_frame(merged_df, params, config.source_height_m, background, z_m, met_df)
+        mem.stage('search')
+        results, trials, last_error = search_best_configuration(model_df, config)
+        if results is not None:
+            results['metrics'] = compute_fit_metrics(results['observed'], results['predicted'])
+            results['uncertainty'] = uncertainty.monte_carlo_emission(model_df, params, results, config)
+        mem.stage('transects')
+        transects = analyze_transects(merged_df, model_df, background, params, results, config, z_m)
+    finally:
+        # Detener tracemalloc también si la entrada no es válida
+        memory = mem.finish()
+
+    return {
+        'merged_df': merged_df,
+        'merge_info': merge_info,
+        'model_df': model_df,
+        'params': params,
+        'results': results,
+        'trials': trials,
+        'last_error': last_error,
+        'transects': transects,
+        'gas_units': GAS_UNITS[config.gas_type],
+        'memory': memory,
+    }
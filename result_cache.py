@@ -0,0 +1,128 @@
+"""
+result_cache.py — On-disk response cache for /upload, shared by all gunicorn workers.
+
+Entries are keyed on (analyzer file hash, GPS file hash, gas type, model options)
+and hold the final JSON payload (zlib-compressed). The store is a local SQLite
+file, so every worker process on the box sees the same entries.
+
+Eviction:
+    - TTL: entries older than ttl_s are ignored and purged.
+    - Size-bounded LRU: after each insert, least-recently-used entries are removed
+      until the total compressed size is <= max_bytes and the count <= max_entries.
+
+Derived artifacts that later requests read back by dataset key (map points and cells,
+export tables) live in a second ResultCache with its own file and limits
+(ARTIFACT_CACHE_*), so evicting or disabling the response cache does not break them.
+
+Usage:
+    cache = ResultCache('cache/results_cache.db', ttl_s=86400, max_bytes=256 * 2**20)
+    key = make_cache_key(data_hash, gpx_hash, 'CH4', config.to_dict())
+    payload = cache.get(key)            # bytes or None
+    cache.set(key, payload_bytes)
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+from typing import Any, Dict, Optional
+
+DEFAULT_CACHE_PATH = os.environ.get('RESULT_CACHE_DB', os.path.join('cache', 'results_cache.db'))
+DEFAULT_TTL_S = float(os.environ.get('RESULT_CACHE_TTL_S', 24 * 3600))
+DEFAULT_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+DEFAULT_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 500))
+# Puntos/celdas del mapa y tablas de exportación: varias entradas por análisis
+ARTIFACT_CACHE_PATH = os.environ.get('ARTIFACT_CACHE_DB', os.path.join('cache', 'artifacts_cache.db'))
+ARTIFACT_TTL_S = float(os.environ.get('ARTIFACT_CACHE_TTL_S', 24 * 3600))
+ARTIFACT_MAX_BYTES = int(os.environ.get('ARTIFACT_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+ARTIFACT_MAX_ENTRIES = int(os.environ.get('ARTIFACT_CACHE_MAX_ENTRIES', 5000))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key          TEXT PRIMARY KEY,
+    payload      BLOB NOT NULL,
+    size         INTEGER NOT NULL,
+    created_at   REAL NOT NULL,
+    last_access  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cache_access ON cache (last_access);
+"""
+
+
+def make_cache_key(data_hash: str, gpx_hash: str, gas_type: str,
+                   options: Optional[Dict[str, Any]] = None) -> str:
+    """Stable key from both input hashes, the gas and the model options."""
+    blob = json.dumps({'data': data_hash, 'gpx': gpx_hash, 'gas': gas_type,
+                       'options': options or {}}, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """TTL + size-bounded LRU cache of response payloads in a shared SQLite file."""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, ttl_s: float = DEFAULT_TTL_S,
+                 max_bytes: int = DEFAULT_MAX_BYTES, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute('SELECT payload, created_at FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl_s:
+                conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                return None
+            conn.execute('UPDATE cache SET last_access = ? WHERE key = ?', (now, key))
+        return zlib.decompress(row[0])
+
+    def set(self, key: str, payload: bytes) -> None:
+        blob = zlib.compress(payload, 6)
+        if len(blob) > self.max_bytes:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO cache (key, payload, size, created_at, last_access) '
+                         'VALUES (?, ?, ?, ?, ?)', (key, blob, len(blob), now, now))
+            self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute('DELETE FROM cache WHERE created_at < ?', (now - self.ttl_s,))
+        total, count = conn.execute('SELECT COALESCE(SUM(size), 0), COUNT(*) FROM cache').fetchone()
+        if total <= self.max_bytes and count <= self.max_entries:
+            return
+        # Recorrer de menos a más reciente hasta volver a los límites
+        doomed = []
+        for key, size in conn.execute('SELECT key, size FROM cache ORDER BY last_access ASC'):
+            if total <= self.max_bytes and count <= self.max_entries:
+                break
+            doomed.append((key,))
+            total -= size
+            count -= 1
+        conn.executemany('DELETE FROM cache WHERE key = ?', doomed)
+
+    def clear(self) -> None:
+        with self._connect() as conn:
+            conn.execute('DELETE FROM cache')
+
+    def stats(self) -> Dict[str, Any]:
+        with self._connect() as conn:
+            total, count = conn.execute('SELECT COALESCE(SUM(size), 0), COUNT(*) FROM cache').fetchone()
+        return {'entries': count, 'bytes': total, 'max_bytes': self.max_bytes,
+                'max_entries': self.max_entries, 'ttl_s': self.ttl_s}
@@ -0,0 +1,233 @@
+"""
+results_store.py — Persistent SQLite store of analysis runs.
+
+Every /upload (or batch) run is saved with its input hashes, model parameters,
+Q estimate, uncertainty, fit metrics and the observed/predicted arrays, so
+historical results can be listed, filtered and compared without recomputation.
+
+Indexes: (gas_type, source_lat, source_lon) for site lookups, time_start for
+date ranges and inputs_hash for de-duplication. Arrays are stored as raw
+float64 blobs in a separate table so listing runs never loads them.
+
+Usage:
+    store = ResultsStore('results.db')
+    run_id = store.save_run(...)
+    store.list_runs(gas_type='CH4', near=(7.13, -73.125), radius_m=500)
+    store.compare_runs([1, 2, 3])
+"""
+
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_DB_PATH = os.environ.get('RESULTS_DB', 'results.db')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at      TEXT NOT NULL,
+    inputs_hash     TEXT NOT NULL,
+    data_filename   TEXT,
+    gpx_filename    TEXT,
+    gas_type        TEXT NOT NULL,
+    gas_units       TEXT,
+    source_lat      REAL,
+    source_lon      REAL,
+    time_start      TEXT,
+    time_end        TEXT,
+    Q_hat_gps       REAL,
+    Q_std_gps       REAL,
+    R2              REAL,
+    n_points        INTEGER,
+    stability_used  TEXT,
+    params_json     TEXT,
+    metrics_json    TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_runs_site ON runs (gas_type, source_lat, source_lon);
+CREATE INDEX IF NOT EXISTS idx_runs_time ON runs (time_start);
+CREATE INDEX IF NOT EXISTS idx_runs_inputs ON runs (inputs_hash);
+CREATE TABLE IF NOT EXISTS run_arrays (
+    run_id      INTEGER PRIMARY KEY REFERENCES runs(id) ON DELETE CASCADE,
+    observed    BLOB,
+    predicted   BLOB
+);
+"""
+
+_SUMMARY_COLS = ('id', 'created_at', 'inputs_hash', 'data_filename', 'gpx_filename', 'gas_type',
+                 'gas_units', 'source_lat', 'source_lon', 'time_start', 'time_end', 'Q_hat_gps',
+                 'Q_std_gps', 'R2', 'n_points', 'stability_used', 'params_json', 'metrics_json')
+
+# Metros por grado de latitud (para el prefiltro por caja)
+_M_PER_DEG = 111320.0
+
+
+def _to_utc_iso(ts) -> Optional[str]:
+    if ts is None:
+        return None
+    if hasattr(ts, 'to_pydatetime'):
+        # datetime no guarda nanosegundos: truncar antes para evitar el aviso de pandas
+        ts = ts.floor('us').to_pydatetime()
+    if isinstance(ts, datetime):
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        return ts.astimezone(timezone.utc).isoformat()
+    return str(ts)
+
+
+def _row_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    d = dict(row)
+    d['params'] = json.loads(d.pop('params_json') or '{}')
+    d['metrics'] = json.loads(d.pop('metrics_json') or '{}')
+    if d.get('Q_hat_gps') is not None:
+        d['Q_hat_gph'] = d['Q_hat_gps'] * 3600.0
+    if d.get('Q_std_gps') is not None:
+        d['Q_std_gph'] = d['Q_std_gps'] * 3600.0
+    return d
+
+
+class ResultsStore:
+    """Thin wrapper over a local SQLite file; one short-lived connection per call (safe across workers)."""
+
+    def __init__(self, path: str = DEFAULT_DB_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    # -----------------------------
+    # Write
+    # -----------------------------
+
+    def save_run(self, inputs_hash: str, gas_type: str, results: Dict[str, Any],
+                 params: Optional[Dict[str, Any]] = None,
+                 data_filename: Optional[str] = None, gpx_filename: Optional[str] = None,
+                 gas_units: Optional[str] = None,
+                 time_start=None, time_end=None) -> int:
+        """Insert one run and its observed/predicted arrays. Returns the new run id."""
+        params = params or {}
+        observed = np.asarray(results.get('observed', []), dtype=np.float64)
+        predicted = np.asarray(results.get('predicted', []), dtype=np.float64)
+        with self._connect() as conn:
+            cur = conn.execute(
+                """INSERT INTO runs (created_at, inputs_hash, data_filename, gpx_filename, gas_type,
+                                     gas_units, source_lat, source_lon, time_start, time_end,
+                                     Q_hat_gps, Q_std_gps, R2, n_points, stability_used,
+                                     params_json, metrics_json)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (datetime.now(timezone.utc).isoformat(), inputs_hash, data_filename, gpx_filename,
+                 gas_type, gas_units, params.get('source_lat'), params.get('source_lon'),
+                 _to_utc_iso(time_start), _to_utc_iso(time_end),
+                 results.get('Q_hat_gps'), results.get('Q_std_gps'), results.get('R2'),
+                 results.get('n_points'), results.get('stability_used'),
+                 json.dumps(params, default=float), json.dumps(results.get('metrics', {}), default=float)))
+            run_id = int(cur.lastrowid)
+            conn.execute('INSERT INTO run_arrays (run_id, observed, predicted) VALUES (?, ?, ?)',
+                         (run_id, observed.tobytes(), predicted.tobytes()))
+        return run_id
+
+    def delete_run(self, run_id: int) -> bool:
+        with self._connect() as conn:
+            return conn.execute('DELETE FROM runs WHERE id = ?', (run_id,)).rowcount > 0
+
+    # -----------------------------
+    # Read
+    # -----------------------------
+
+    def get_run(self, run_id: int, include_arrays: bool = False) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {', '.join(_SUMMARY_COLS)} FROM runs WHERE id = ?",
+                               (run_id,)).fetchone()
+            if row is None:
+                return None
+            out = _row_to_dict(row)
+            if include_arrays:
+                arr = conn.execute('SELECT observed, predicted FROM run_arrays WHERE run_id = ?',
+                                   (run_id,)).fetchone()
+                if arr is not None:
+                    out['observed'] = np.frombuffer(arr['observed'], dtype=np.float64).tolist()
+                    out['predicted'] = np.frombuffer(arr['predicted'], dtype=np.float64).tolist()
+        return out
+
+    def find_by_inputs(self, inputs_hash: str) -> List[Dict[str, Any]]:
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT {', '.join(_SUMMARY_COLS)} FROM runs WHERE inputs_hash = ? "
+                                "ORDER BY id DESC", (inputs_hash,)).fetchall()
+        return [_row_to_dict(r) for r in rows]
+
+    def list_runs(self, gas_type: Optional[str] = None,
+                  near: Optional[Tuple[float, float]] = None, radius_m: float = 500.0,
+                  time_from: Optional[str] = None, time_to: Optional[str] = None,
+                  min_r2: Optional[float] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Filter runs by gas, site (within radius_m of `near` = (lat, lon)), time range
+        (ISO strings, compared against the drive start in UTC) and minimum R².
+        The site filter uses an indexed bounding box, then an exact haversine check.
+        """
+        where, args = [], []
+        if gas_type:
+            where.append('gas_type = ?')
+            args.append(gas_type)
+        if near is not None:
+            lat0, lon0 = float(near[0]), float(near[1])
+            dlat = radius_m / _M_PER_DEG
+            dlon = radius_m / (_M_PER_DEG * max(np.cos(np.radians(lat0)), 1e-6))
+            where.append('source_lat BETWEEN ? AND ? AND source_lon BETWEEN ? AND ?')
+            args += [lat0 - dlat, lat0 + dlat, lon0 - dlon, lon0 + dlon]
+        if time_from:
+            where.append('time_start >= ?')
+            args.append(_to_utc_iso(_parse_iso(time_from)))
+        if time_to:
+            where.append('time_start <= ?')
+            args.append(_to_utc_iso(_parse_iso(time_to)))
+        if min_r2 is not None:
+            where.append('R2 >= ?')
+            args.append(float(min_r2))
+        sql = f"SELECT {', '.join(_SUMMARY_COLS)} FROM runs"
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY time_start DESC, id DESC LIMIT ?'
+        args.append(int(limit))
+        with self._connect() as conn:
+            rows = [_row_to_dict(r) for r in conn.execute(sql, args).fetchall()]
+        if near is not None:
+            rows = [r for r in rows
+                    if _haversine_m(near[0], near[1], r['source_lat'], r['source_lon']) <= radius_m]
+        return rows
+
+    def compare_runs(self, run_ids: Iterable[int]) -> Dict[str, Any]:
+        """Side-by-side summary of several runs plus the spread of their Q estimates."""
+        runs = [r for r in (self.get_run(int(i)) for i in run_ids) if r is not None]
+        q = np.array([r['Q_hat_gps'] for r in runs if r['Q_hat_gps'] is not None], dtype=float)
+        summary: Dict[str, Any] = {'n_runs': len(runs)}
+        if q.size:
+            summary.update({
+                'Q_mean_gph': float(q.mean() * 3600.0),
+                'Q_std_gph': float(q.std(ddof=1) * 3600.0) if q.size > 1 else 0.0,
+                'Q_min_gph': float(q.min() * 3600.0),
+                'Q_max_gph': float(q.max() * 3600.0),
+            })
+        return {'runs': runs, 'summary': summary}
+
+
+def _parse_iso(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _haversine_m(lat1, lon1, lat2, lon2) -> float:
+    if lat2 is None or lon2 is None:
+        return float('inf')
+    p1, p2 = np.radians(lat1), np.radians(lat2)
+    dphi = p2 - p1
+    dlmb = np.radians(lon2 - lon1)
+    a = np.sin(dphi / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(dlmb / 2) ** 2
+    return float(2 * 6371000.0 * np.arcsin(np.sqrt(a)))
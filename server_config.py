@@ -0,0 +1,92 @@
+"""
+server_config.py — Size gunicorn workers, threads and timeouts from the measured
+CPU/memory profile of the /upload pipeline.
+
+The profile is the JSON written by `python loadtest.py --profile` (default path
+`loadtest_profile.json`, override with LOADTEST_PROFILE):
+    {"cpu_s_per_request": 0.9, "wall_s_p99": 1.4, "peak_rss_mb_per_request": 180,
+     "base_rss_mb": 160}
+
+Rules (the pipeline is CPU-bound numpy/pandas work plus file upload I/O):
+    workers = min(CPU cores, memory budget / (base + per-request peak)), at least 1
+    threads = 2 when uploads are I/O-heavy relative to CPU (wall >> cpu), else 1
+    timeout = max(30 s, 4 x p99 wall time) so long drives are not killed at the 30 s default
+Every value can be forced with WEB_CONCURRENCY, GUNICORN_THREADS and GUNICORN_TIMEOUT.
+"""
+
+import json
+import os
+from typing import Any, Dict, Optional
+
+DEFAULT_PROFILE_PATH = os.environ.get('LOADTEST_PROFILE', 'loadtest_profile.json')
+
+# Valores conservadores cuando no hay perfil medido
+DEFAULT_PROFILE = {
+    'cpu_s_per_request': 1.0,
+    'wall_s_p99': 2.0,
+    'peak_rss_mb_per_request': 250.0,
+    'base_rss_mb': 200.0,
+}
+
+# Fracción de la RAM que pueden usar los workers
+MEMORY_FRACTION = 0.8
+
+
+def load_profile(path: str = DEFAULT_PROFILE_PATH) -> Dict[str, float]:
+    profile = dict(DEFAULT_PROFILE)
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            profile.update({k: float(v) for k, v in json.load(f).items() if k in DEFAULT_PROFILE})
+    return profile
+
+
+def total_memory_mb() -> float:
+    """Physical memory (cgroup limit when running in a container, if lower)."""
+    mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2 ** 20
+    for cgroup_file in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(cgroup_file) as f:
+                raw = f.read().strip()
+            if raw.isdigit():
+                mem = min(mem, int(raw) / 2 ** 20)
+        except OSError:
+            continue
+    return mem
+
+
+def cpu_count() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def recommend(profile: Optional[Dict[str, float]] = None,
+              cpus: Optional[int] = None, memory_mb: Optional[float] = None) -> Dict[str, Any]:
+    """Return {'workers', 'threads', 'timeout', 'basis'} for the given machine and profile."""
+    profile = profile or load_profile()
+    cpus = cpus or cpu_count()
+    memory_mb = memory_mb or total_memory_mb()
+
+    per_worker_mb = profile['base_rss_mb'] + profile['peak_rss_mb_per_request']
+    mem_workers = int((memory_mb * MEMORY_FRACTION) // max(per_worker_mb, 1.0))
+    workers = max(1, min(cpus, mem_workers))
+
+    io_ratio = profile['wall_s_p99'] / max(profile['cpu_s_per_request'], 1e-3)
+    threads = 2 if io_ratio > 1.5 else 1
+    timeout = int(max(30, round(4 * profile['wall_s_p99'])))
+
+    workers = int(os.environ.get('WEB_CONCURRENCY', workers))
+    threads = int(os.environ.get('GUNICORN_THREADS', threads))
+    timeout = int(os.environ.get('GUNICORN_TIMEOUT', timeout))
+    return {
+        'workers': workers,
+        'threads': threads,
+        'timeout': timeout,
+        'basis': {'cpus': cpus, 'memory_mb': round(memory_mb), 'per_worker_mb': per_worker_mb,
+                  'memory_limited_workers': mem_workers, **profile},
+    }
+
+
+if __name__ == "__main__":
+    print(json.dumps(recommend(), indent=2))
@@ -3,6 +3,11 @@
 
 $(document).ready(function() {
     console.log('🚀 Gaussian Emissions Analyzer v2.0 Inicializado');
+
+    // Con una combinación guardada no se necesitan los archivos .data y .gpx
+    $('#merged-file').on('change', function() {
+        $('#data-file, #gpx-file').prop('required', this.files.length === 0);
+    });
     
     // Manejador del formulario de análisis
     $('#analysis-form').submit(function(e) {
@@ -12,45 +17,207 @@ $(document).ready(function() {
         const dataFileInput = document.getElementById('data-file');
         const gpxFileInput = document.getElementById('gpx-file');
         const gasType = document.getElementById('gas-type').value;
+        const mergedFileInput = document.getElementById('merged-file');
+        const mergedFile = mergedFileInput && mergedFileInput.files.length ? mergedFileInput.files[0] : null;
         
-        if (!dataFileInput.files.length) {
+        if (!mergedFile && !dataFileInput.files.length) {
             alert('Por favor selecciona el archivo de datos CSV');
             return;
         }
         
-        if (!gpxFileInput.files.length) {
+        if (!mergedFile && !gpxFileInput.files.length) {
             alert('Por favor selecciona el archivo GPX');
             return;
         }
         
-        // Preparar FormData
+        // Opciones del modelo (iguales para la carga normal y la binaria)
         const formData = new FormData();
-        formData.append('dataFile', dataFileInput.files[0]);
-        formData.append('gpxFile', gpxFileInput.files[0]);
         formData.append('gasType', gasType);
+        formData.append('mergeMode', document.getElementById('merge-mode').value);
+        formData.append('backgroundMode', document.getElementById('background-mode').value);
+        formData.append('robustLoss', document.getElementById('robust-loss').value);
+        formData.append('selectionCriterion', document.getElementById('selection-criterion').value);
+        // Registro del anemómetro sónico (opcional): viento y estabilidad medidos
+        const anemometerInput = document.getElementById('anemometer-file');
+        if (anemometerInput && anemometerInput.files.length) {
+            formData.append('anemometerFile', anemometerInput.files[0]);
+        }
         
         // Mostrar spinner
         $('#loading-spinner').removeClass('d-none');
         $('#results-container').addClass('d-none');
         $('#plots-container').addClass('d-none');
         
-        // Enviar solicitud AJAX
-        $.ajax({
-            url: '/upload',
-            type: 'POST',
-            data: formData,
-            processData: false,
-            contentType: false,
-            success: function(response) {
-                handleSuccess(response);
-            },
-            error: function(xhr, status, error) {
-                handleError(xhr, status, error);
-            }
-        });
+        const clientParse = document.getElementById('client-parse');
+        if (mergedFile) {
+            // Re-analizar una combinación exportada (Parquet/Arrow) sin parsear los instrumentos
+            formData.append('mergedFile', mergedFile);
+            sendAnalysis('/upload', formData);
+        } else if (clientParse && clientParse.checked && window.Worker) {
+            // Pre-procesar en el navegador y subir solo las columnas necesarias
+            parseInWorker(dataFileInput.files[0], gpxFileInput.files[0], gasType, formData);
+        } else if (dataFileInput.files[0].size + gpxFileInput.files[0].size >= CHUNKED_UPLOAD_MIN_BYTES) {
+            // Archivos grandes: carga por fragmentos reanudable
+            uploadInChunks(dataFileInput.files[0], gpxFileInput.files[0], formData);
+        } else {
+            formData.append('dataFile', dataFileInput.files[0]);
+            formData.append('gpxFile', gpxFileInput.files[0]);
+            sendAnalysis('/upload', formData);
+        }
     });
 });
 
+// A partir de este tamaño los archivos se suben por fragmentos (ver chunked_upload.py)
+const CHUNKED_UPLOAD_MIN_BYTES = 8 * 1024 * 1024;
+const CHUNK_RETRIES = 5;
+
+// Tabla CRC32 (polinomio 0xEDB88320, el mismo de zlib.crc32)
+const CRC32_TABLE = (function() {
+    const table = new Uint32Array(256);
+    for (let i = 0; i < 256; i++) {
+        let c = i;
+        for (let k = 0; k < 8; k++) {
+            c = (c & 1) ? (0xEDB88320 ^ (c >>> 1)) : (c >>> 1);
+        }
+        table[i] = c >>> 0;
+    }
+    return table;
+})();
+
+function crc32Hex(bytes) {
+    let crc = 0xFFFFFFFF;
+    for (let i = 0; i < bytes.length; i++) {
+        crc = CRC32_TABLE[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+    }
+    return ((crc ^ 0xFFFFFFFF) >>> 0).toString(16).padStart(8, '0');
+}
+
+function sleep(ms) {
+    return new Promise(function(resolve) { setTimeout(resolve, ms); });
+}
+
+// Subir un archivo por fragmentos; reanuda una carga previa del mismo archivo si existe
+async function uploadFileInChunks(file, kind, onProgress) {
+    const storageKey = `gea-upload:${kind}:${file.name}:${file.size}:${file.lastModified}`;
+    let status = null;
+    const previousId = localStorage.getItem(storageKey);
+    if (previousId) {
+        const resp = await fetch(`/uploads/${previousId}`);
+        if (resp.ok) {
+            status = await resp.json();
+        }
+    }
+    if (!status) {
+        const resp = await fetch('/uploads', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({filename: file.name, size: file.size, kind: kind})
+        });
+        status = await resp.json();
+        if (!resp.ok) {
+            throw new Error(status.error);
+        }
+        localStorage.setItem(storageKey, status.upload_id);
+    }
+
+    let offset = status.offset;
+    let failures = 0;
+    while (offset < file.size) {
+        const bytes = new Uint8Array(await file.slice(offset, offset + status.chunk_size).arrayBuffer());
+        let resp = null;
+        try {
+            resp = await fetch(`/uploads/${status.upload_id}?offset=${offset}`, {
+                method: 'PUT',
+                headers: {'Content-Type': 'application/octet-stream', 'X-Chunk-CRC32': crc32Hex(bytes)},
+                body: bytes
+            });
+        } catch (networkError) {
+            resp = null;
+        }
+        if (resp && resp.ok) {
+            offset = (await resp.json()).offset;
+            failures = 0;
+            onProgress(offset / file.size);
+            continue;
+        }
+        if (resp && resp.status === 409) {
+            // El servidor tiene otro offset: continuar desde ahí
+            offset = (await resp.json()).offset;
+            continue;
+        }
+        if (resp && resp.status !== 400 && resp.status < 500) {
+            throw new Error((await resp.json()).error);
+        }
+        // Red caída, error del servidor o fragmento dañado: reintentar con espera creciente
+        failures++;
+        if (failures > CHUNK_RETRIES) {
+            throw new Error('No se pudo subir el archivo tras varios intentos; vuelve a analizar para reanudar');
+        }
+        await sleep(1000 * Math.pow(2, failures - 1));
+    }
+    return status.upload_id;
+}
+
+// Subir .gpx y .data por fragmentos y analizar con los identificadores de carga
+async function uploadInChunks(dataFile, gpxFile, formData) {
+    const progressText = $('#loading-spinner p');
+    try {
+        const gpxId = await uploadFileInChunks(gpxFile, 'gpx', function(frac) {
+            progressText.text(`Subiendo ${gpxFile.name}: ${(100 * frac).toFixed(0)}%`);
+        });
+        const dataId = await uploadFileInChunks(dataFile, 'data', function(frac) {
+            progressText.text(`Subiendo ${dataFile.name}: ${(100 * frac).toFixed(0)}% (el servidor lo procesa mientras llega)`);
+        });
+        progressText.text('Por favor espere mientras analizamos la información');
+        formData.append('dataUploadId', dataId);
+        formData.append('gpxUploadId', gpxId);
+        sendAnalysis('/upload', formData);
+    } catch (e) {
+        $('#loading-spinner').addClass('d-none');
+        progressText.text('Por favor espere mientras analizamos la información');
+        alert('Error al subir los archivos: ' + e.message);
+    }
+}
+
+// Enviar solicitud AJAX
+function sendAnalysis(url, formData) {
+    $.ajax({
+        url: url,
+        type: 'POST',
+        data: formData,
+        processData: false,
+        contentType: false,
+        success: function(response) {
+            handleSuccess(response);
+        },
+        error: function(xhr, status, error) {
+            handleError(xhr, status, error);
+        }
+    });
+}
+
+// Parsear .data y .gpx en un Web Worker y enviar los arreglos binarios a /upload/binary
+function parseInWorker(dataFile, gpxFile, gasType, formData) {
+    const workerUrl = document.getElementById('analysis-form').dataset.parseWorker;
+    const worker = new Worker(workerUrl);
+    worker.onmessage = function(e) {
+        worker.terminate();
+        if (e.data.error) {
+            // Si el navegador no puede leer los archivos, usar la carga normal
+            console.warn('Pre-procesado en el navegador falló, se suben los archivos completos:', e.data.error);
+            formData.append('dataFile', dataFile);
+            formData.append('gpxFile', gpxFile);
+            sendAnalysis('/upload', formData);
+            return;
+        }
+        console.log(`Pre-procesado: ${e.data.gasPoints} muestras, ${e.data.gpsPoints} puntos GPS, ` +
+                    `${(e.data.originalBytes / 1024).toFixed(0)} KB -> ${(e.data.buffer.byteLength / 1024).toFixed(0)} KB`);
+        formData.append('binaryFile', new Blob([e.data.buffer], {type: 'application/octet-stream'}), 'drive.gea');
+        sendAnalysis('/upload/binary', formData);
+    };
+    worker.postMessage({dataFile: dataFile, gpxFile: gpxFile, gasType: gasType});
+}
+
 // Función para manejar respuesta exitosa
 function handleSuccess(response) {
     console.log('🚀 Respuesta recibida:', response);
@@ -81,9 +248,37 @@ function handleSuccess(response) {
     updateStatistics(response);
     updateMetadata(response);
     updateDataSummary(response);
+    updateTransects(response);
+    updateExports(response);
     createPlots(response);
 }
 
+// Enlaces de descarga de las tablas columnares (ver columnar_export.py)
+const EXPORT_TABLE_LABELS = {
+    merged: 'Datos combinados GPS + analizador',
+    trials: 'Configuraciones evaluadas',
+    residuals: 'Residuos del ajuste'
+};
+
+function updateExports(response) {
+    const container = $('#columnar-exports');
+    if (!response.exports) {
+        container.empty();
+        return;
+    }
+    const key = encodeURIComponent(response.exports.key);
+    const rows = response.exports.tables.map(function(table) {
+        const links = response.exports.formats.map(function(fmt) {
+            return `<a href="/export/${key}/${table}.${fmt}" download>.${fmt}</a>`;
+        }).join(' | ');
+        return `<li><strong>${EXPORT_TABLE_LABELS[table] || table}:</strong> ${links}</li>`;
+    }).join('');
+    container.html(`
+        <strong><i class="fas fa-table"></i> Tablas para análisis (Parquet / Arrow):</strong>
+        <ul style="margin: 8px 0 0 0;">${rows}</ul>
+    `);
+}
+
 // Función para formatear números con máximo 3 decimales
 function formatNumber(num) {
     if (num === null || num === undefined || isNaN(num)) return '0.000';
@@ -202,6 +397,16 @@ function updateStatistics(response) {
     if (response.results.metrics) {
         statsHtml += buildAdditionalMetricsHTML(response.results.metrics, response.data_summary.gas_units);
     }
+
+    // Validación cruzada del mejor ajuste (criterio de elección de la configuración)
+    if (response.results.Q2_kfold !== undefined) {
+        statsHtml += buildCrossValidationHTML(response.results);
+    }
+
+    // Incertidumbre de Q por las entradas meteorológicas (Monte Carlo)
+    if (response.results.uncertainty && response.results.uncertainty.Q_p50_gph !== undefined) {
+        statsHtml += buildUncertaintyHTML(response.results.uncertainty);
+    }
     
     // Mostrar advertencia según R²
     statsHtml += buildR2WarningHTML(response.results);
@@ -239,6 +444,77 @@ function buildAdditionalMetricsHTML(metrics, units) {
     `;
 }
 
+const SELECTION_CRITERION_LABELS = {
+    kfold: 'validación cruzada por bloques',
+    loo: 'dejando uno fuera',
+    r2: 'R² del ajuste'
+};
+
+// Construir HTML de validación cruzada (Q² predictivo)
+function buildCrossValidationHTML(results) {
+    return `
+        <hr style="margin: 15px 0;">
+        <h6 class="mb-2"><i class="fas fa-check-double"></i> Validación Cruzada</h6>
+        <div class="row text-center">
+            <div class="col-4">
+                <div class="stat-label">Q² (${results.cv_folds} bloques)</div>
+                <div style="font-size: 1.2rem; font-weight: 600; color: #3498db;">${results.Q2_kfold.toFixed(3)}</div>
+            </div>
+            <div class="col-4">
+                <div class="stat-label">Q² (dejando uno fuera)</div>
+                <div style="font-size: 1.2rem; font-weight: 600; color: #9b59b6;">${results.Q2_loo.toFixed(3)}</div>
+            </div>
+            <div class="col-4">
+                <div class="stat-label">Q entre bloques</div>
+                <div style="font-size: 1.2rem; font-weight: 600; color: #e67e22;">± ${formatNumber(results.Q_fold_std_gps * 3600)}</div>
+                <small style="color: #7f8c8d; font-size: 0.75rem;">g/h</small>
+            </div>
+        </div>
+        <small style="color: #7f8c8d;">Configuración elegida por ${SELECTION_CRITERION_LABELS[results.selection_criterion] || results.selection_criterion}</small>
+        ${results.cv_degenerate_folds ? `<br><small style="color: #e67e22;">${results.cv_degenerate_folds} bloque(s) concentran casi toda la señal y no entran en el Q² de bloques</small>` : ''}
+    `;
+}
+
+const UNCERTAINTY_INPUT_LABELS = {
+    wind_speed_factor: 'velocidad del viento',
+    wind_dir_offset_deg: 'dirección del viento',
+    source_height_m: 'altura de la fuente',
+    background_offset: 'fondo'
+};
+
+// Construir HTML de incertidumbre Monte Carlo
+function buildUncertaintyHTML(mc) {
+    // Entrada con mayor correlación de rangos (en valor absoluto) con Q
+    const top = Object.keys(mc.sensitivity || {}).sort(function(a, b) {
+        return Math.abs(mc.sensitivity[b]) - Math.abs(mc.sensitivity[a]);
+    })[0];
+    return `
+        <hr style="margin: 15px 0;">
+        <h6 class="mb-2"><i class="fas fa-dice"></i> Incertidumbre Monte Carlo${mc.loss && mc.loss !== 'l2' ? ' <small class="text-muted">(pesos ' + mc.loss + ' del ajuste)</small>' : ''}</h6>
+        <div class="row text-center">
+            <div class="col-4">
+                <div class="stat-label">Q Mediana</div>
+                <div style="font-size: 1.2rem; font-weight: 600; color: #27ae60;">${formatNumber(mc.Q_p50_gph)}</div>
+                <small style="color: #7f8c8d; font-size: 0.75rem;">g/h</small>
+            </div>
+            <div class="col-5">
+                <div class="stat-label">Intervalo 90%</div>
+                <div style="font-size: 1.0rem; font-weight: 600; color: #2c3e50;">[${formatNumber(mc.Q_p05_gph)}, ${formatNumber(mc.Q_p95_gph)}]</div>
+                <small style="color: #7f8c8d; font-size: 0.75rem;">g/h (percentiles 5-95)</small>
+            </div>
+            <div class="col-3">
+                <div class="stat-label">Muestras</div>
+                <div style="font-size: 1.2rem; font-weight: 600; color: #3498db;">${mc.n_valid}/${mc.n_samples}</div>
+                <small style="color: #7f8c8d; font-size: 0.75rem;">(ajuste válido)</small>
+            </div>
+        </div>
+        <small style="color: #7f8c8d;">
+            ± ${formatNumber(mc.Q_std_total_gph)} g/h combinando meteorología y ajuste
+            ${top ? `· mayor influencia: ${UNCERTAINTY_INPUT_LABELS[top] || top} (ρ=${mc.sensitivity[top].toFixed(2)})` : ''}
+        </small>
+    `;
+}
+
 // Construir HTML de advertencia R²
 function buildR2WarningHTML(results) {
     if (results.warning && results.suggestions) {
@@ -325,6 +601,49 @@ function updateMetadata(response) {
     $('#metadata').html(metadataHtml);
 }
 
+// Actualizar tabla de transectos (cruces de la pluma)
+function updateTransects(response) {
+    const tr = response.transects;
+    if (!tr || !tr.transects || !tr.transects.length) {
+        $('#transects-container').addClass('d-none');
+        return;
+    }
+    const rows = tr.transects.map(t => `
+        <tr class="${t.accepted ? '' : 'text-muted'}">
+            <td>${t.transect + 1}</td>
+            <td><small>${t.time_start.substring(11, 19)} - ${t.time_end.substring(11, 19)}</small></td>
+            <td>${t.n_points}</td>
+            <td>${t.Q_hat_gph === undefined ? '-' : (t.identifiable ? formatNumber(t.Q_hat_gph) + ' ± ' + formatNumber(t.Q_std_gph) : '<span title="Los puntos no ven la pluma">no identificable</span>')}</td>
+            <td>${t.Q_mb_gph !== null ? formatNumber(t.Q_mb_gph) : '-'}</td>
+            <td>${t.R2 !== undefined ? t.R2.toFixed(3) : '-'}</td>
+            <td>${t.accepted ? '<i class="fas fa-check text-success"></i>' : '<i class="fas fa-times text-danger"></i>'}</td>
+        </tr>`).join('');
+    const c = tr.combined;
+    const combinedHtml = c.n_transects > 0 ? `
+        <p class="mb-2">
+            <strong>Estimación combinada (${c.n_transects} cruces${tr.loss && tr.loss !== 'l2' ? ', pérdida ' + tr.loss : ''}):</strong>
+            ${formatNumber(c.Q_hat_gph)} ± ${formatNumber(c.Q_std_gph)} g/h
+            | R² = ${c.R2.toFixed(3)}
+            | Dispersión entre cruces: ${formatNumber(c.Q_spread_gph)} g/h
+        </p>` : '<p class="mb-2">Ningún cruce cumple los criterios de aceptación.</p>';
+    const massBalanceHtml = c.Q_mb_median_gph !== undefined ? `
+        <p class="mb-2">
+            <strong>Balance de masa (integración transversal, ${c.n_transects_mb} cruces):</strong>
+            mediana ${formatNumber(c.Q_mb_median_gph)} g/h | media ${formatNumber(c.Q_mb_mean_gph)} g/h
+        </p>` : '';
+    $('#transects').html(`
+        ${combinedHtml}
+        ${massBalanceHtml}
+        <div class="table-responsive">
+            <table class="table table-sm mb-0" style="font-size: 0.9rem;">
+                <thead><tr><th>#</th><th>Tiempo</th><th>Puntos</th><th>Q (g/h)</th><th>Q balance de masa (g/h)</th><th>R²</th><th>Aceptado</th></tr></thead>
+                <tbody>${rows}</tbody>
+            </table>
+        </div>
+    `);
+    $('#transects-container').removeClass('d-none');
+}
+
 // Actualizar resumen de datos
 function updateDataSummary(response) {
     if (!response.data_summary) return;
@@ -365,27 +684,109 @@ function updateDataSummary(response) {
                     <i class="fas fa-map-marker-alt text-warning"></i> <strong>Total de Puntos GPS:</strong> 
                     <span style="font-size: 1.2rem; font-weight: 600; color: #f39c12;">${response.data_summary.total_points}</span>
                 </p>
-                <p style="margin-bottom: 0;">
+                <p style="margin-bottom: 12px;">
                     <i class="fas fa-clock text-secondary"></i> <strong>Período de Medición:</strong><br>
                     <small style="font-size: 0.85rem; color: #7f8c8d;">${response.data_summary.time_range}</small>
                 </p>
+                ${buildWindSummaryHTML(response)}
             </div>
         </div>
     `);
 }
 
+// Viento usado por el modelo: medido por el anemómetro o estimado del recorrido
+function buildWindSummaryHTML(response) {
+    const summary = response.data_summary;
+    if (summary.wind_speed_ms === undefined) return '';
+    const met = response.meteorology;
+    const source = met
+        ? `anemómetro (${met.anemometer_rate_hz.toFixed(1)} Hz, cobertura ${(100 * met.met_coverage).toFixed(0)}%)`
+        : 'estimado del recorrido';
+    let html = `
+        <p style="margin-bottom: 0;">
+            <i class="fas fa-wind text-success"></i> <strong>Viento:</strong>
+            ${summary.wind_dir_from_deg.toFixed(0)}° @ ${summary.wind_speed_ms.toFixed(2)} m/s<br>
+            <small style="font-size: 0.85rem; color: #7f8c8d;">${source}</small>
+        </p>`;
+    if (met && met.met_windows.length) {
+        // Turbulencia y clase de Pasquill de cada ventana del anemómetro
+        html += `<small style="font-size: 0.8rem; color: #7f8c8d;">` +
+            met.met_windows.map(function(w) {
+                const sigmaW = w.sigma_w_ms === null ? '-' : w.sigma_w_ms.toFixed(2);
+                const sigmaTheta = w.sigma_theta_deg === null ? '-' : w.sigma_theta_deg.toFixed(1);
+                return `${w.start.slice(11, 16)} UTC: σθ=${sigmaTheta}°, σw=${sigmaW} m/s → ${w.stability || '-'}`;
+            }).join('<br>') + `</small>`;
+    }
+    return html;
+}
+
+// Gráficas pendientes de dibujar: se dibujan al entrar en pantalla (IntersectionObserver)
+const pendingPlots = {};
+const renderedPlots = new Set();
+let plotObserver = null;
+let resizeTimer = null;
+
+function renderPlot(id) {
+    const plot = pendingPlots[id];
+    if (!plot) {
+        return;
+    }
+    delete pendingPlots[id];
+    // Plotly.react reutiliza la gráfica existente en lugar de destruirla y crearla de nuevo
+    Plotly.react(id, plot.figure.data, plot.figure.layout, plot.config);
+    renderedPlots.add(id);
+    if (plot.onRender) {
+        plot.onRender(document.getElementById(id));
+    }
+}
+
+function lazyPlot(id, figure, config, onRender) {
+    pendingPlots[id] = {figure: figure, config: config, onRender: onRender};
+    if (!('IntersectionObserver' in window)) {
+        renderPlot(id);
+        return;
+    }
+    if (!plotObserver) {
+        plotObserver = new IntersectionObserver(function(entries) {
+            entries.forEach(function(entry) {
+                if (entry.isIntersecting) {
+                    plotObserver.unobserve(entry.target);
+                    renderPlot(entry.target.id);
+                }
+            });
+        }, {rootMargin: '200px 0px'});
+    }
+    // Reservar la altura de la gráfica para que las de más abajo no entren en pantalla antes de tiempo
+    const el = document.getElementById(id);
+    el.style.minHeight = ((figure.layout && figure.layout.height) || 450) + 'px';
+    // Volver a observar: el observador avisa enseguida si ya está visible
+    plotObserver.unobserve(el);
+    plotObserver.observe(el);
+}
+
+// Un solo manejador de resize para todas las gráficas ya dibujadas
+window.addEventListener('resize', function() {
+    clearTimeout(resizeTimer);
+    resizeTimer = setTimeout(function() {
+        renderedPlots.forEach(function(id) {
+            Plotly.Plots.resize(id);
+        });
+    }, 150);
+});
+
 // Crear gráficas
 function createPlots(response) {
     try {
-        // Crear gráfico de observado vs modelado si está disponible
+        // Gráfico de observado vs modelado si está disponible
         if (response.obs_vs_pred) {
-            console.log('Creando gráfico observado vs modelado...');
             $('#obs-vs-pred-container').removeClass('d-none');
-            Plotly.newPlot('obs-vs-pred-plot', response.obs_vs_pred.data, response.obs_vs_pred.layout, {responsive: true});
+            lazyPlot('obs-vs-pred-plot', response.obs_vs_pred, {responsive: true});
+        } else if (renderedPlots.has('obs-vs-pred-plot')) {
+            $('#obs-vs-pred-container').addClass('d-none');
+            Plotly.purge('obs-vs-pred-plot');
+            renderedPlots.delete('obs-vs-pred-plot');
         }
         
-        console.log('Creando mapa interactivo...');
-        
         // Configuración para el mapa interactivo con responsividad
         const heatmapConfig = {
             responsive: true,
@@ -404,43 +805,67 @@ function createPlots(response) {
             }
         }
         
-        Plotly.newPlot('heatmap-plot', response.heatmap.data, response.heatmap.layout, heatmapConfig);
-        
-        console.log('Creando rosa de vientos...');
+        lazyPlot('heatmap-plot', response.heatmap, heatmapConfig, function(plot) {
+            // Quitar el manejador de zoom del análisis anterior
+            plot.removeAllListeners('plotly_relayout');
+            // Mapa agregado en el servidor: pedir las celdas del nuevo nivel de zoom
+            if (response.map && response.map.aggregated) {
+                bindAggregatedMap(response.map, response.data_summary.gas_type);
+            }
+        });
         
         // Ajustar altura de rosa de vientos
         if (response.wind_rose.layout && window.innerWidth < 768) {
             response.wind_rose.layout.height = 350;
         }
         
-        Plotly.newPlot('wind-rose', response.wind_rose.data, response.wind_rose.layout, {responsive: true});
-        
-        console.log('Creando serie temporal...');
+        lazyPlot('wind-rose', response.wind_rose, {responsive: true});
         
         // Ajustar altura de serie temporal
         if (response.timeseries.layout && window.innerWidth < 768) {
             response.timeseries.layout.height = 300;
         }
         
-        Plotly.newPlot('timeseries-plot', response.timeseries.data, response.timeseries.layout, {responsive: true});
-        
-        // Hacer que las gráficas se redimensionen cuando cambie el tamaño de ventana
-        window.addEventListener('resize', function() {
-            if (response.obs_vs_pred) {
-                Plotly.Plots.resize('obs-vs-pred-plot');
-            }
-            Plotly.Plots.resize('heatmap-plot');
-            Plotly.Plots.resize('wind-rose');
-            Plotly.Plots.resize('timeseries-plot');
-        });
+        lazyPlot('timeseries-plot', response.timeseries, {responsive: true});
         
-        console.log('✅ Todas las gráficas creadas exitosamente');
+        console.log('✅ Gráficas programadas (se dibujan al hacerse visibles)');
     } catch(e) {
         console.error('Error al crear gráficas:', e);
         alert('Error al crear las gráficas: ' + e.message);
     }
 }
 
+// Recalcular las celdas del mapa (agregadas en el servidor) cuando cambia el zoom
+function bindAggregatedMap(mapInfo, gasType) {
+    const plot = document.getElementById('heatmap-plot');
+    let currentZoom = mapInfo.zoom;
+    let requestId = 0;
+    plot.on('plotly_relayout', function(eventData) {
+        if (!eventData || eventData['mapbox.zoom'] === undefined) {
+            return;
+        }
+        const zoom = Math.round(eventData['mapbox.zoom']);
+        if (zoom === currentZoom) {
+            return;
+        }
+        currentZoom = zoom;
+        const thisRequest = ++requestId;
+        $.getJSON('/map/cells', {key: mapInfo.key, zoom: zoom, shape: mapInfo.shape, gas: gasType})
+            .done(function(cells) {
+                // Ignorar respuestas de un zoom que ya no es el actual
+                if (thisRequest !== requestId) {
+                    return;
+                }
+                Plotly.restyle(plot, {lat: [cells.lat], lon: [cells.lon], z: [cells.mean]}, [0]);
+                Plotly.restyle(plot, {lat: [cells.lat], lon: [cells.lon], 'marker.color': [cells.mean],
+                                      text: [cells.text]}, [1]);
+            })
+            .fail(function(xhr) {
+                console.warn('No se pudieron cargar las celdas del mapa:', xhr.responseText);
+            });
+    });
+}
+
 // Función para manejar errores
 function handleError(xhr, status, error) {
     $('#loading-spinner').addClass('d-none');
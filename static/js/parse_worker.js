@@ -0,0 +1,160 @@
+// Gaussian Emissions Analyzer - Web Worker de pre-procesado
+// Lee el .data del LI-7810 y el .gpx en el navegador y arma la carga binaria compacta
+// (formato GEA1, ver binary_upload.py): solo DATE+TIME, la columna del gas y lat/lon/ele/time.
+
+const MAGIC = [0x47, 0x45, 0x41, 0x31];  // 'GEA1'
+const VERSION = 1;
+
+self.onmessage = function(e) {
+    const msg = e.data;
+    Promise.all([msg.dataFile.text(), msg.gpxFile.text()])
+        .then(function(texts) {
+            const gas = parseDataText(texts[0], msg.gasType);
+            const gps = parseGpxText(texts[1]);
+            const buffer = encodePayload(gas, gps, msg.gasType, msg.dataFile.name, msg.gpxFile.name);
+            self.postMessage({
+                buffer: buffer,
+                gasPoints: gas.t.length,
+                gpsPoints: gps.t.length,
+                originalBytes: msg.dataFile.size + msg.gpxFile.size
+            }, [buffer]);
+        })
+        .catch(function(err) {
+            self.postMessage({error: err.message || String(err)});
+        });
+};
+
+// DATE (AAAA-MM-DD) + TIME (HH:MM:SS[.fff]) como milisegundos, reloj local leído como UTC
+function wallClockMs(date, time) {
+    const d = date.split('-');
+    const t = time.split(':');
+    if (d.length !== 3 || t.length < 3) {
+        return NaN;
+    }
+    const seconds = parseFloat(t[2]);
+    return Date.UTC(+d[0], +d[1] - 1, +d[2], +t[0], +t[1], 0) + seconds * 1000;
+}
+
+function parseDataText(text, gasType) {
+    let start = text.indexOf('DATAH');
+    if (start < 0) {
+        throw new Error('No se encontró el header DATAH en el archivo .data');
+    }
+    const headerEnd = text.indexOf('\n', start);
+    const header = text.slice(start, headerEnd).trim().split('\t').map(function(c) { return c.trim(); });
+    const iDate = header.indexOf('DATE');
+    const iTime = header.indexOf('TIME');
+    const iGas = header.indexOf(gasType);
+    if (iDate < 0 || iTime < 0 || iGas < 0) {
+        throw new Error('El archivo .data no tiene las columnas DATE, TIME y ' + gasType);
+    }
+
+    // Recorrer las líneas sin crear un arreglo con todas ellas
+    let t = new Float64Array(1 << 16);
+    let v = new Float64Array(1 << 16);
+    let n = 0;
+    let pos = headerEnd + 1;
+    while (pos < text.length) {
+        let end = text.indexOf('\n', pos);
+        if (end < 0) {
+            end = text.length;
+        }
+        if (text.startsWith('DATA\t', pos)) {
+            const row = text.slice(pos, end).replace(/\r$/, '').split('\t');
+            const ms = wallClockMs(row[iDate] || '', row[iTime] || '');
+            const value = parseFloat(row[iGas]);
+            if (isFinite(ms) && isFinite(value)) {
+                if (n === t.length) {
+                    t = grow(t, Float64Array);
+                    v = grow(v, Float64Array);
+                }
+                t[n] = ms;
+                v[n] = value;
+                n++;
+            }
+        }
+        pos = end + 1;
+    }
+    return {t: t.subarray(0, n), value: v.subarray(0, n)};
+}
+
+function parseGpxText(text) {
+    // Sin DOMParser en los workers: expresiones regulares sobre cada <trkpt>
+    const trkpt = /<trkpt\b([^>]*)>([\s\S]*?)<\/trkpt>/g;
+    const latRe = /\blat="([^"]+)"/;
+    const lonRe = /\blon="([^"]+)"/;
+    const eleRe = /<ele>\s*([^<]+?)\s*<\/ele>/;
+    const timeRe = /<time>\s*([^<]+?)\s*<\/time>/;
+    let t = new Float64Array(1 << 14);
+    let lat = new Float64Array(1 << 14);
+    let lon = new Float64Array(1 << 14);
+    let ele = new Float64Array(1 << 14);
+    let n = 0;
+    let m;
+    while ((m = trkpt.exec(text)) !== null) {
+        const timeMatch = timeRe.exec(m[2]);
+        const latMatch = latRe.exec(m[1]);
+        const lonMatch = lonRe.exec(m[1]);
+        if (!timeMatch || !latMatch || !lonMatch) {
+            continue;
+        }
+        const ms = Date.parse(timeMatch[1]);
+        if (!isFinite(ms)) {
+            continue;
+        }
+        if (n === t.length) {
+            t = grow(t, Float64Array);
+            lat = grow(lat, Float64Array);
+            lon = grow(lon, Float64Array);
+            ele = grow(ele, Float64Array);
+        }
+        const eleMatch = eleRe.exec(m[2]);
+        t[n] = ms;
+        lat[n] = parseFloat(latMatch[1]);
+        lon[n] = parseFloat(lonMatch[1]);
+        ele[n] = eleMatch ? parseFloat(eleMatch[1]) : 0.0;
+        n++;
+    }
+    return {t: t.subarray(0, n), lat: lat.subarray(0, n), lon: lon.subarray(0, n), ele: ele.subarray(0, n)};
+}
+
+function grow(arr, Type) {
+    const bigger = new Type(arr.length * 2);
+    bigger.set(arr);
+    return bigger;
+}
+
+function pad8(n) {
+    return (n + 7) & ~7;
+}
+
+function encodePayload(gas, gps, gasType, dataName, gpxName) {
+    const arrays = [
+        ['gas_t_ms', 'f8', gas.t],
+        ['gas', 'f8', gas.value],
+        ['gps_t_ms', 'f8', gps.t],
+        ['lat', 'f8', gps.lat],
+        ['lon', 'f8', gps.lon],
+        ['ele', 'f8', gps.ele]
+    ];
+    const header = new TextEncoder().encode(JSON.stringify({
+        version: VERSION,
+        gas_type: gasType,
+        data_filename: dataName,
+        gpx_filename: gpxName,
+        arrays: arrays.map(function(a) { return {name: a[0], dtype: a[1], n: a[2].length}; })
+    }));
+    let offset = pad8(8 + header.length);
+    const total = arrays.reduce(function(acc, a) { return acc + pad8(a[2].byteLength); }, offset);
+    const buffer = new ArrayBuffer(total);
+    const bytes = new Uint8Array(buffer);
+    bytes.set(MAGIC, 0);
+    new DataView(buffer).setUint32(4, header.length, true);
+    bytes.set(header, 8);
+    // Los typed arrays usan el orden de bytes de la plataforma (little-endian en la práctica)
+    arrays.forEach(function(a) {
+        bytes.set(new Uint8Array(a[2].buffer, a[2].byteOffset, a[2].byteLength), offset);
+        offset += pad8(a[2].byteLength);
+    });
+    return buffer;
+}
@@ -0,0 +1,250 @@
+"""
+terrain.py — Ground elevation from local DEM rasters (memory-mapped) and heights above ground.
+
+The GPS `elevation` is meters above sea level; the plume model needs the sensor and
+source heights above the ground. This module samples a digital elevation model at
+every point of a drive in one vectorized call (bilinear interpolation) and derives
+height above ground level (AGL).
+
+Supported rasters (geographic lat/lon grids, e.g. SRTM / Copernicus / USGS 3DEP):
+    - SRTM .hgt tiles (N07W074.hgt, 1201 or 3601 samples, big-endian int16)
+    - ESRI GridFloat .flt + .hdr and ESRI .bil + .hdr
+    - GeoTIFF .tif (optional, requires rasterio; read into memory, not memory-mapped)
+Raw formats are opened with np.memmap, so only the pages around the sampled points
+are read. Opened tiles are kept in a small LRU cache shared by the whole process
+(and, with gunicorn --preload, by the workers), so repeated sites do not reload them.
+
+Usage:
+    dem = DEM('dem/')                         # a file or a directory of tiles
+    ground = dem.elevation(lat, lon)          # NaN outside coverage / nodata
+    agl = height_above_ground(lat, lon, gps_elevation, dem)
+
+DEM_PATH (environment) sets the default raster file or directory.
+"""
+
+import os
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_DEM_PATH = os.environ.get('DEM_PATH')
+DEM_EXTENSIONS = ('.hgt', '.flt', '.bil', '.tif', '.tiff')
+# Máximo de rásteres abiertos a la vez (LRU)
+TILE_CACHE_SIZE = int(os.environ.get('DEM_TILE_CACHE_SIZE', 16))
+
+_HGT_NAME = re.compile(r'([NS])(\d{2})([EW])(\d{3})', re.IGNORECASE)
+
+
+@dataclass
+class DEMRaster:
+    """One north-up raster: data[row, col], top-left corner (x0, y0) and cell size in degrees."""
+    path: str
+    data: np.ndarray
+    x0: float
+    y0: float
+    dx: float
+    dy: float
+    nodata: Optional[float] = None
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        """(west, south, east, north) of the pixel-center grid (the interpolable area)."""
+        rows, cols = self.data.shape
+        return (self.x0 + 0.5 * self.dx, self.y0 - (rows - 0.5) * self.dy,
+                self.x0 + (cols - 0.5) * self.dx, self.y0 - 0.5 * self.dy)
+
+    def sample(self, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        """Bilinear ground elevation at (lat, lon); NaN outside the raster or next to nodata."""
+        rows, cols = self.data.shape
+        c = (lon - self.x0) / self.dx - 0.5
+        r = (self.y0 - lat) / self.dy - 0.5
+        inside = (c >= 0) & (c <= cols - 1) & (r >= 0) & (r <= rows - 1) & np.isfinite(c) & np.isfinite(r)
+        out = np.full(lat.shape, np.nan)
+        if not np.any(inside):
+            return out
+        c, r = c[inside], r[inside]
+        c0 = np.minimum(np.floor(c).astype(np.intp), cols - 2)
+        r0 = np.minimum(np.floor(r).astype(np.intp), rows - 2)
+        fc, fr = c - c0, r - r0
+        # Cuatro vecinos: con memmap solo se leen las páginas necesarias
+        z00 = self.data[r0, c0].astype(float)
+        z01 = self.data[r0, c0 + 1].astype(float)
+        z10 = self.data[r0 + 1, c0].astype(float)
+        z11 = self.data[r0 + 1, c0 + 1].astype(float)
+        if self.nodata is not None:
+            for z in (z00, z01, z10, z11):
+                z[z == self.nodata] = np.nan
+        out[inside] = ((z00 * (1 - fc) + z01 * fc) * (1 - fr) +
+                       (z10 * (1 - fc) + z11 * fc) * fr)
+        return out
+
+
+# -----------------------------
+# Readers
+# -----------------------------
+
+def _read_header(path: str) -> Dict[str, str]:
+    header = {}
+    with open(path, 'r', encoding='ascii', errors='ignore') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2:
+                header[parts[0].lower()] = parts[1]
+    return header
+
+
+def _open_hgt(path: str) -> DEMRaster:
+    m = _HGT_NAME.search(os.path.basename(path))
+    if m is None:
+        raise ValueError(f"Nombre de tile SRTM no válido: {path} (se espera p. ej. N07W074.hgt)")
+    lat0 = int(m.group(2)) * (1 if m.group(1).upper() == 'N' else -1)
+    lon0 = int(m.group(4)) * (1 if m.group(3).upper() == 'E' else -1)
+    n = int(round(np.sqrt(os.path.getsize(path) / 2)))
+    data = np.memmap(path, dtype='>i2', mode='r', shape=(n, n))
+    step = 1.0 / (n - 1)
+    # Los tiles SRTM están registrados en los nodos: el centro del píxel (0, 0) es (lat0 + 1, lon0)
+    return DEMRaster(path, data, lon0 - step / 2, lat0 + 1 + step / 2, step, step, nodata=-32768)
+
+
+def _open_gridfloat(path: str) -> DEMRaster:
+    h = _read_header(os.path.splitext(path)[0] + '.hdr')
+    ncols, nrows = int(h['ncols']), int(h['nrows'])
+    cell = float(h['cellsize'])
+    endian = '>' if h.get('byteorder', 'LSBFIRST').upper().startswith('MSB') else '<'
+    data = np.memmap(path, dtype=endian + 'f4', mode='r', shape=(nrows, ncols))
+    x0 = float(h.get('xllcorner', h.get('xllcenter', 0.0)))
+    y_ll = float(h.get('yllcorner', h.get('yllcenter', 0.0)))
+    if 'xllcenter' in h:
+        x0 -= cell / 2
+        y_ll -= cell / 2
+    nodata = float(h['nodata_value']) if 'nodata_value' in h else None
+    return DEMRaster(path, data, x0, y_ll + nrows * cell, cell, cell, nodata=nodata)
+
+
+def _open_bil(path: str) -> DEMRaster:
+    h = _read_header(os.path.splitext(path)[0] + '.hdr')
+    nrows, ncols = int(h['nrows']), int(h['ncols'])
+    nbits = int(h.get('nbits', 16))
+    pixeltype = h.get('pixeltype', 'SIGNEDINT').upper()
+    kind = 'f' if pixeltype == 'FLOAT' else ('u' if pixeltype == 'UNSIGNEDINT' else 'i')
+    endian = '>' if h.get('byteorder', 'I').upper() in ('M', 'MSBFIRST') else '<'
+    data = np.memmap(path, dtype=f'{endian}{kind}{nbits // 8}', mode='r', shape=(nrows, ncols))
+    dx, dy = float(h['xdim']), float(h['ydim'])
+    # ULXMAP/ULYMAP son el centro del píxel superior izquierdo
+    x0 = float(h['ulxmap']) - dx / 2
+    y0 = float(h['ulymap']) + dy / 2
+    nodata = float(h['nodata']) if 'nodata' in h else None
+    return DEMRaster(path, data, x0, y0, dx, dy, nodata=nodata)
+
+
+def _open_geotiff(path: str) -> DEMRaster:
+    try:
+        import rasterio
+    except ImportError:
+        raise ValueError(f"Leer GeoTIFF requiere rasterio (pip install rasterio): {path}")
+    with rasterio.open(path) as ds:
+        t = ds.transform
+        data = ds.read(1)
+        return DEMRaster(path, data, t.c, t.f, t.a, -t.e, nodata=ds.nodata)
+
+
+_READERS = {'.hgt': _open_hgt, '.flt': _open_gridfloat, '.bil': _open_bil,
+            '.tif': _open_geotiff, '.tiff': _open_geotiff}
+
+_tile_cache: 'OrderedDict[str, DEMRaster]' = OrderedDict()
+_tile_lock = Lock()
+
+
+def open_raster(path: str) -> DEMRaster:
+    """Open (or reuse from the LRU tile cache) one DEM raster."""
+    path = os.path.abspath(path)
+    with _tile_lock:
+        raster = _tile_cache.get(path)
+        if raster is not None:
+            _tile_cache.move_to_end(path)
+            return raster
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in _READERS:
+        raise ValueError(f"Formato de DEM no soportado: {path}")
+    raster = _READERS[ext](path)
+    with _tile_lock:
+        _tile_cache[path] = raster
+        while len(_tile_cache) > TILE_CACHE_SIZE:
+            _tile_cache.popitem(last=False)
+    return raster
+
+
+def clear_tile_cache() -> None:
+    with _tile_lock:
+        _tile_cache.clear()
+
+
+# -----------------------------
+# DEM (one raster or a directory of tiles)
+# -----------------------------
+
+class DEM:
+    """Ground elevation lookups over a raster file or a directory of tiles."""
+
+    def __init__(self, path: str):
+        if not os.path.exists(path):
+            raise ValueError(f"No existe el DEM configurado: {path}")
+        if os.path.isdir(path):
+            self.paths = sorted(os.path.join(dirpath, f)
+                                for dirpath, _, files in os.walk(path)
+                                for f in files if f.lower().endswith(DEM_EXTENSIONS))
+        elif path.lower().endswith(DEM_EXTENSIONS):
+            self.paths = [path]
+        else:
+            raise ValueError(f"Formato de DEM no soportado: {path}")
+        if not self.paths:
+            raise ValueError(f"No se encontraron rásteres DEM en {path}")
+        self._bounds: Dict[str, Tuple[float, float, float, float]] = {}
+
+    def _tile_bounds(self, path: str) -> Tuple[float, float, float, float]:
+        # Solo se abre el tile para leer su extensión una vez (el memmap no lee datos)
+        if path not in self._bounds:
+            self._bounds[path] = open_raster(path).bounds
+        return self._bounds[path]
+
+    def elevation(self, lat, lon) -> np.ndarray:
+        """Ground elevation (m) at every point; NaN where no tile covers the point."""
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        out = np.full(lat.shape, np.nan)
+        if lat.size == 0:
+            return out
+        box = (np.nanmin(lon), np.nanmin(lat), np.nanmax(lon), np.nanmax(lat))
+        for path in self.paths:
+            w, s, e, n = self._tile_bounds(path)
+            if box[0] > e or box[2] < w or box[1] > n or box[3] < s:
+                continue
+            todo = np.isnan(out) & (lon >= w) & (lon <= e) & (lat >= s) & (lat <= n)
+            if np.any(todo):
+                out[todo] = open_raster(path).sample(lat[todo], lon[todo])
+        return out
+
+
+_dem_cache: Dict[str, DEM] = {}
+
+
+def get_dem(path: Optional[str] = None) -> Optional[DEM]:
+    """
+    DEM for `path` (default DEM_PATH), reused across requests; None when not configured.
+    Raises ValueError when the path does not exist or holds no supported raster.
+    """
+    path = path or DEFAULT_DEM_PATH
+    if not path:
+        return None
+    if path not in _dem_cache:
+        _dem_cache[path] = DEM(path)
+    return _dem_cache[path]
+
+
+def height_above_ground(lat, lon, elevation, dem: DEM) -> np.ndarray:
+    """GPS elevation minus DEM ground elevation (NaN where the DEM has no data)."""
+    return np.asarray(elevation, dtype=float) - dem.elevation(lat, lon)
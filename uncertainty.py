@@ -0,0 +1,271 @@
+"""
+uncertainty.py — Monte Carlo propagation of meteorological input uncertainty to Q.
+
+The wind speed, wind direction and background come from heuristics
+(pipeline.estimate_model_parameters), the source height is a fixed guess, and the
+stability class is only chosen by R². The fit's Q_std ignores all of that. This module
+draws thousands of (u, wind direction, H, background offset, stability) samples and
+re-solves the inversion for each one.
+
+Q is linear in the plume kernel G (dC = G Q), so every draw has the closed form
+    Q_s = sum(m_s G_s dC_s) / sum(m_s G_s^2)
+where m_s is the downwind / in-sector mask of draw s (times the final IRLS weight of
+each point when the fit used a robust loss, so the spread is that of the same
+estimator, see gaussian_ch4.fit_row_weights); draws whose R² is below MIN_R2
+(the plume misses the data, so Q blows up) are discarded like in the configuration
+search. All draws are evaluated as
+(draws x points) array operations, in chunks of draws sized to MC_CHUNK_BYTES, with
+no per-draw Python loop.
+
+Input distributions (see PipelineConfig.mc_*):
+    wind speed       u * lognormal(0, mc_wind_speed_sigma_log)
+    wind direction   normal(dir, mc_wind_dir_sigma_deg)
+    source height    uniform(mc_source_height_range_m)
+    background       + normal(0, sigma_b), sigma_b = half the spread between the 5th and
+                     20th concentration percentiles (how much the background quantile matters)
+    stability        uniform over config.stability_classes
+
+Usage:
+    mc = monte_carlo_emission(model_df, params, results, config)
+    mc['Q_p05_gph'], mc['Q_p50_gph'], mc['Q_p95_gph']
+"""
+
+import time
+from typing import Any, Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from gaussian_ch4 import SIGMA_TABLE, SUM_GG_TOL, fit_row_weights, frame_value, source_local_xy
+# Un solo valor para el tamaño de bloque y el presupuesto de memoria de /upload
+from memory_profile import MC_CHUNK_BYTES
+# Arreglos temporales de (draws x puntos) vivos a la vez en un bloque
+_LIVE_ARRAYS = 8
+MIN_POINTS = 5
+MIN_R2 = -0.5
+HIST_BINS = 30
+
+
+def _draw_inputs(rng: np.random.Generator, n: int, config, background_sigma: float) -> Dict[str, np.ndarray]:
+    classes = np.asarray(config.stability_classes)
+    h_lo, h_hi = config.mc_source_height_range_m
+    return {
+        'wind_speed_factor': np.exp(rng.normal(0.0, config.mc_wind_speed_sigma_log, n)),
+        'wind_dir_offset_deg': rng.normal(0.0, config.mc_wind_dir_sigma_deg, n),
+        'source_height_m': rng.uniform(h_lo, h_hi, n),
+        'background_offset': rng.normal(0.0, background_sigma, n),
+        'stability': classes[rng.integers(0, len(classes), n)],
+    }
+
+
+def _sigma_coefficients(classes: np.ndarray) -> Dict[str, np.ndarray]:
+    return {name: np.array([getattr(SIGMA_TABLE[str(s)], name) for s in classes])
+            for name in ('a_y', 'b_y', 'a_z', 'b_z')}
+
+
+def _solve_chunk(x: np.ndarray, y: np.ndarray, bearing: np.ndarray, z: np.ndarray,
+                 u0: np.ndarray, dC0: np.ndarray, wind_dir0: np.ndarray, sector_half_width: float,
+                 draws: Dict[str, np.ndarray], sl: slice,
+                 row_sigma: Optional[Dict[str, np.ndarray]] = None,
+                 row_weights: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Closed-form Q (g/s) for draws[sl], vectorized over (draws, points). row_sigma: per-point
+    sigma coefficients (measured stability), instead of the drawn class of each draw.
+    row_weights: per-point weights of the sums (robust fit), None for plain least squares.
+    Works in place so that at most _LIVE_ARRAYS (draws x points) float arrays are alive.
+    """
+    # Dirección hacia la que sopla el viento (grados) de cada muestra
+    to_deg = wind_dir0 + draws['wind_dir_offset_deg'][sl][:, None]
+    to_deg += 180.0
+    to_deg %= 360.0
+    ang_diff = bearing - to_deg
+    ang_diff += 180.0
+    ang_diff %= 360.0
+    ang_diff -= 180.0
+    mask = np.abs(ang_diff, out=ang_diff) <= sector_half_width
+    del ang_diff
+
+    theta = np.radians(to_deg, out=to_deg)
+    cos_t = np.cos(theta)
+    sin_t = np.sin(theta, out=theta)
+    xw = cos_t * x
+    yw = np.multiply(sin_t, y)
+    xw += yw
+    np.multiply(cos_t, y, out=yw)
+    sin_t *= x
+    yw -= sin_t
+    del cos_t, sin_t, theta, to_deg
+    mask &= xw > 0
+
+    if row_sigma is not None:
+        a_y, b_y, a_z, b_z = (row_sigma[k] for k in ('a_y', 'b_y', 'a_z', 'b_z'))
+    else:
+        coef = _sigma_coefficients(draws['stability'][sl])
+        a_y, b_y, a_z, b_z = (coef[k][:, None] for k in ('a_y', 'b_y', 'a_z', 'b_z'))
+    xd = np.abs(xw, out=xw)
+    np.maximum(xd, 1.0, out=xd)
+    sigy = xd ** b_y
+    sigy *= a_y
+    np.maximum(sigy, 0.01, out=sigy)
+    sigz = np.power(xd, b_z, out=xd)
+    sigz *= a_z
+    np.maximum(sigz, 0.01, out=sigz)
+    del xw, xd
+
+    # G = exp(-yw²/2σy²) [exp(-(z-H)²/2σz²) + exp(-(z+H)²/2σz²)] / (2π u σy σz)
+    H = draws['source_height_m'][sl][:, None]
+    G = np.square(yw, out=yw)
+    two_s2 = np.square(sigy)
+    two_s2 *= -2.0
+    G /= two_s2
+    np.exp(G, out=G)
+    np.square(sigz, out=two_s2)
+    two_s2 *= -2.0
+    vert = np.square(z - H)
+    vert /= two_s2
+    np.exp(vert, out=vert)
+    reflected = np.square(z + H)
+    reflected /= two_s2
+    vert += np.exp(reflected, out=reflected)
+    del reflected
+    G *= vert
+    u = np.multiply(u0, draws['wind_speed_factor'][sl][:, None], out=vert)
+    np.maximum(u, 0.1, out=u)
+    u *= sigy
+    u *= sigz
+    u *= 2.0 * np.pi
+    G /= u
+    del sigy, sigz, two_s2, u, vert
+    G *= mask
+
+    dC = dC0 - draws['background_offset'][sl][:, None]
+    dC *= mask
+    n = mask.sum(axis=1)
+    if row_weights is None:
+        sgg = np.einsum('ij,ij->i', G, G)
+        sgy = np.einsum('ij,ij->i', G, dC)
+        syy = np.einsum('ij,ij->i', dC, dC)
+        sy = dC.sum(axis=1)
+        sw = n
+    else:
+        sgg = np.einsum('ij,ij,j->i', G, G, row_weights)
+        sgy = np.einsum('ij,ij,j->i', G, dC, row_weights)
+        syy = np.einsum('ij,ij,j->i', dC, dC, row_weights)
+        sy = dC @ row_weights
+        sw = mask @ row_weights
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Q = np.where(sgg > SUM_GG_TOL, sgy / sgg, np.nan)
+        # R² de cada muestra, como en search_best_configuration: descarta los vientos y
+        # alturas con los que la pluma no pasa por los datos (Q enorme con G ~ 0)
+        ss_res = syy - sgy * Q
+        ss_tot = syy - sy ** 2 / sw
+        r2 = 1.0 - ss_res / ss_tot
+    Q[(n < MIN_POINTS) | ~(r2 >= MIN_R2)] = np.nan
+    return Q
+
+
+def monte_carlo_emission(model_df: pd.DataFrame, params: Dict[str, float],
+                         results: Optional[Dict[str, Any]], config,
+                         n_samples: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    Distribution of Q under the input uncertainty, around the best fit (its sector).
+    Returns percentiles and a robust std (half the 16-84 % range) in g/h, the number of
+    draws with a valid fit, a log10 histogram, rank correlations of Q with each continuous input and the combined
+    (meteorology + fit) standard deviation; None when there is nothing to propagate.
+    With measured meteorology (pipeline.measured_meteorology) the per-sample wind direction
+    and stability of model_df are perturbed / kept instead of the fitted single values.
+    A robust fit (results['robust_weights']) keeps its final IRLS weights in every draw.
+    """
+    n_samples = config.mc_samples if n_samples is None else n_samples
+    if n_samples <= 0 or len(model_df) < MIN_POINTS:
+        return None
+    t0 = time.perf_counter()
+    results = results or {}
+    sector = float(results.get('sector_half_width_deg', max(config.sector_widths)))
+
+    local_xy = source_local_xy(model_df)
+    x, y = local_xy
+    bearing = (np.degrees(np.arctan2(x, y)) + 360.0) % 360.0
+    z = model_df['z_m'].to_numpy(dtype=float)
+    u0 = model_df['wind_speed_ms'].to_numpy(dtype=float)
+    conc = model_df['ch4_ppm'].to_numpy(dtype=float)
+    dC0 = conc - model_df['background_ppm'].to_numpy(dtype=float)
+    wind_dir0 = np.broadcast_to(np.asarray(frame_value(model_df, 'wind_dir_from_deg'), dtype=float), z.shape)
+    ok = np.isfinite(dC0) & np.isfinite(u0) & np.isfinite(z) & np.isfinite(wind_dir0)
+    x, y, bearing, z, u0, dC0, wind_dir0 = x[ok], y[ok], bearing[ok], z[ok], u0[ok], dC0[ok], wind_dir0[ok]
+    # Estabilidad medida por muestra (anemómetro): no se sortea la clase
+    measured = results.get('stability_source') == 'anemometer'
+    # Pesos IRLS finales del ajuste robusto (None con L2): misma pérdida en cada muestra
+    row_weights = fit_row_weights(model_df, results, None if measured else results.get('stability_used'),
+                                  sector, local_xy) if 'robust_weights' in results else None
+    if row_weights is not None:
+        row_weights = row_weights[ok]
+    row_sigma = ({k: v[None, :] for k, v in _sigma_coefficients(model_df['stability'].to_numpy()[ok]).items()}
+                 if measured else None)
+
+    q05, q20 = np.quantile(conc[ok], [0.05, 0.20]) if ok.any() else (0.0, 0.0)
+    background_sigma = float(max(q20 - q05, 0.0) / 2.0)
+
+    rng = np.random.default_rng(config.mc_seed)
+    draws = _draw_inputs(rng, n_samples, config, background_sigma)
+    chunk = max(1, MC_CHUNK_BYTES // (8 * _LIVE_ARRAYS * max(len(x), 1)))
+    Q = np.empty(n_samples)
+    for start in range(0, n_samples, chunk):
+        sl = slice(start, min(start + chunk, n_samples))
+        Q[sl] = _solve_chunk(x, y, bearing, z, u0, dC0, wind_dir0, sector, draws, sl, row_sigma,
+                             row_weights)
+
+    valid = np.isfinite(Q)
+    out: Dict[str, Any] = {
+        'n_samples': int(n_samples),
+        'n_valid': int(valid.sum()),
+        'sector_half_width_deg': sector,
+        'loss': results.get('loss', 'l2'),
+        'background_sigma': background_sigma,
+        'elapsed_s': 0.0,
+    }
+    if valid.sum() < 2:
+        out['elapsed_s'] = time.perf_counter() - t0
+        return out
+
+    q_gph = Q[valid] * 3600.0
+    p = np.percentile(q_gph, [2.5, 5, 15.87, 25, 50, 75, 84.13, 95, 97.5])
+    # Q escala con 1/G: la distribución tiene colas largas (vientos que apenas tocan los datos),
+    # así que la dispersión se resume con percentiles y no con media/desviación estándar
+    std = float((p[6] - p[2]) / 2.0)
+    fit_std = float(results.get('Q_std_gph', 0.0) or 0.0)
+    # Histograma en escala logarítmica entre los percentiles 1 y 99
+    lo, hi = np.percentile(q_gph, [1, 99])
+    positive = q_gph[(q_gph >= lo) & (q_gph <= hi) & (q_gph > 0)]
+    counts, edges = np.histogram(np.log10(positive), bins=HIST_BINS) if positive.size else (np.zeros(0), np.zeros(0))
+    out.update({
+        'Q_p025_gph': float(p[0]), 'Q_p05_gph': float(p[1]), 'Q_p25_gph': float(p[3]),
+        'Q_p50_gph': float(p[4]), 'Q_p75_gph': float(p[5]), 'Q_p95_gph': float(p[7]),
+        'Q_p975_gph': float(p[8]),
+        # Desviación equivalente (mitad del rango 16-84 %), robusta a las colas
+        'Q_std_gph': std,
+        # Incertidumbre meteorológica + la del ajuste (ruido de las mediciones)
+        'Q_std_total_gph': float(np.sqrt(std ** 2 + fit_std ** 2)),
+        'histogram': {'counts': counts.tolist(), 'log10_edges': edges.tolist()},
+        'sensitivity': _rank_correlations(q_gph, {k: v[valid] for k, v in draws.items() if k != 'stability'}),
+    })
+    if not measured:
+        out['by_stability'] = {str(s): float(np.median(q_gph[draws['stability'][valid] == s]))
+                               for s in np.unique(draws['stability'][valid])}
+    out['elapsed_s'] = time.perf_counter() - t0
+    return out
+
+
+def _rank_correlations(q: np.ndarray, inputs: Dict[str, np.ndarray]) -> Dict[str, float]:
+    """Spearman correlation of Q with each input: which assumption drives the spread."""
+    def ranks(a):
+        r = np.empty(a.size)
+        r[np.argsort(a, kind='stable')] = np.arange(a.size)
+        return r
+    rq = ranks(q)
+    out = {}
+    for name, values in inputs.items():
+        rv = ranks(values)
+        c = np.corrcoef(rq, rv)[0, 1]
+        out[name] = float(c) if np.isfinite(c) else 0.0
+    return out